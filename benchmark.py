@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+""" End-to-end benchmark of the provisioning and location scripts.
+
+This script starts the stand-in phpIPAM server (see ipamfake) with a
+simulated round trip time and runs the following scenarios against it:
+    - spoke: createSpoke for a number of accounts, one after the other
+    - landingzone: createSsVpc plus createvEdgeVpc for a number of regions
+    - render: the spoke and landing zone templates
+    - locations: import, export and a sync without changes of a location sheet
+
+For every scenario it reports the wall time, the number of API calls, the
+latency per endpoint as percentiles and a histogram, and the throughput. The
+results are written to a JSON baseline file with a stable layout, so a
+release can be compared to the previous one with a plain diff, or with
+--compare to print the changes in wall time and call count.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import argparse
+import csv
+import json
+import time
+import tempfile
+import threading
+import urllib.parse
+import importlib.util
+import ipamfake
+import ipamclient
+import get_locations
+import import_locations
+import update_locations
+from concurrent.futures import ThreadPoolExecutor
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5] # Upper bounds of the histogram buckets in seconds
+RTT = 0.02 # Default simulated round trip time in seconds
+SPOKES = 20 # Default number of spokes
+LANDINGZONES = 2 # Default number of landing zones
+RENDERS = 50 # Default number of renders per template
+LOCATIONS = 200 # Default number of locations
+
+class Recorder:
+    '''
+    Collect the latency of every API call of a scenario
+    '''
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def hook(self, r, *args, **kwargs):
+        '''
+        Response hook of the requests session
+        '''
+
+        path = urllib.parse.urlsplit(r.request.url).path
+        parts = [part for part in path.split('/') if part][2:]
+        key = ipamfake.Profile.key(r.request.method, parts)
+        with self.lock:
+            self.samples.setdefault(key, []).append(r.elapsed.total_seconds())
+
+    def report(self):
+        '''
+        Summarise the latencies per endpoint
+
+        :return: Calls, percentiles and histogram by endpoint
+        :rtype: dict
+        '''
+
+        endpoints = {}
+        for key, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            histogram = {}
+            for sample in samples:
+                bucket = next((f"<={bound}" for bound in BUCKETS if sample <= bound), f">{BUCKETS[-1]}")
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+            endpoints[key] = {
+                'calls': len(samples),
+                'p50': samples[len(samples) // 2],
+                'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                'max': samples[-1],
+                'histogram': histogram
+            }
+        return endpoints
+
+def loadScript(name, config):
+    '''
+    Load one of the scripts as a module, configured for the stand-in server
+
+    :param str name: File name of the script
+    :param dict config: Configuration to use
+    :return: Script module
+    '''
+
+    spec = importlib.util.spec_from_file_location(name.replace('-', '').replace('.py', ''), os.path.join(DIRECTORY, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.config = config
+    return module
+
+def runScenario(client, function):
+    '''
+    Run a scenario and measure it
+
+    :param IpamClient client: phpIPAM client used by the scenario
+    :param function function: Scenario, returning the number of units done and failed
+    :return: Wall time, calls and latency per endpoint
+    :rtype: dict
+    '''
+
+    recorder = Recorder()
+    client.session.hooks['response'].append(recorder.hook)
+    starttime = time.time()
+    try:
+        units, failed = function()
+    finally:
+        wall = time.time() - starttime
+        client.session.hooks['response'].remove(recorder.hook)
+
+    endpoints = recorder.report()
+    return {
+        'wall': wall,
+        'units': units,
+        'failed': failed,
+        'perMinute': units / wall * 60 if wall else 0,
+        'calls': sum(endpoint['calls'] for endpoint in endpoints.values()),
+        'endpoints': endpoints
+    }
+
+def spokeScenario(spokedev, count):
+    '''
+    Scenario provisioning spokes one after the other
+
+    :param module spokedev: spoke-dev.py loaded as a module
+    :param int count: Number of spokes
+    :return: Scenario, see runScenario
+    :rtype: function
+    '''
+
+    def run():
+        failed = 0
+        for number in range(count):
+            if spokedev.createSpoke('eu-west-1', f"Benchmark{number}", spokedev.SPOKESIZE)['code'] != 200:
+                failed += 1
+        return count, failed
+    return run
+
+def landingzoneScenario(landingzone, count):
+    '''
+    Scenario provisioning the Shared Services and vEdge VPCs of landing zones, round-robin over the regions
+
+    :param module landingzone: landingzone-v2.py loaded as a module
+    :param int count: Number of landing zones
+    :return: Scenario, see runScenario
+    :rtype: function
+    '''
+
+    regions = list(landingzone.regionalSettings)
+    def run():
+        failed = 0
+        for number in range(count):
+            region = regions[number % len(regions)]
+            if landingzone.createSsVpc(region, True)['code'] != 200 or landingzone.createvEdgeVpc(region)['code'] != 200:
+                failed += 1
+        return count, failed
+    return run
+
+def renderScenario(spokedev, landingzone, count):
+    '''
+    Scenario rendering the spoke and landing zone templates
+
+    :param module spokedev: spoke-dev.py loaded as a module
+    :param module landingzone: landingzone-v2.py loaded as a module
+    :param int count: Number of renders of each template
+    :return: Scenario, see runScenario
+    :rtype: function
+    '''
+
+    # Provision once up front, only the renders are measured
+    spoke = spokedev.createSpoke('eu-west-2', 'Render', spokedev.SPOKESIZE)
+    zone = [landingzone.createSsVpc('eu-west-2', True)['data'], landingzone.createvEdgeVpc('eu-west-2')['data']]
+    def run():
+        for number in range(count):
+            spokedev.renderTemplate('eu-west-2', 'Render', spoke, os.path.join(DIRECTORY, 'spoke-dev.tf'))
+            landingzone.createCfYaml('eu-west-2', zone, os.path.join(DIRECTORY, 'landingzone-v2.yaml'), True)
+        return count * 2, 0
+    return run
+
+def locationScenario(client, count, workers, workdir):
+    '''
+    Scenario importing locations, exporting them to a sheet and syncing that back
+
+    :param IpamClient client: phpIPAM client
+    :param int count: Number of locations
+    :param int workers: Number of parallel imports
+    :param str workdir: Directory for the exported sheet
+    :return: Scenario, see runScenario
+    :rtype: function
+    '''
+
+    def run():
+        limiter = ipamclient.RateLimiter(0)
+        rows = [{'name': f"Location {number}", 'description': 'Benchmark', 'address': f"Street {number}",
+            'lat': str(number), 'long': str(number)} for number in range(count)]
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(lambda row: import_locations.importLocation(client, limiter, row), rows))
+        failed = sum(1 for result in results if result['success'] != 'true')
+
+        # Export to a sheet and sync it back, which should change nothing
+        filename = os.path.join(workdir, 'locations.csv')
+        with open(filename, 'w', newline='', encoding='utf-8-sig') as data_file:
+            csv_writer = csv.writer(data_file)
+            for number, item in enumerate(get_locations.iterLocations(client)):
+                if number == 0:
+                    csv_writer.writerow(item.keys())
+                csv_writer.writerow(item.values())
+        with open(filename, 'r', encoding='utf-8-sig') as data_file:
+            data = {line['id']: line for line in csv.DictReader(data_file)}
+        current = {str(location['id']): location for location in get_locations.iterLocations(client)}
+        changes, missing = update_locations.diffLocations(current, data)
+        return count + len(data), failed + len(changes) + len(missing)
+    return run
+
+def compare(baseline, results):
+    '''
+    Compare results to a baseline
+
+    :param dict baseline: Earlier results
+    :param dict results: New results
+    :return: Relative change of wall time and calls by scenario
+    :rtype: dict
+    '''
+
+    changes = {}
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        changes[name] = {
+            'wall': result['wall'] / before['wall'] - 1 if before['wall'] else None,
+            'calls': result['calls'] - before['calls']
+        }
+    return changes
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Benchmark the provisioning and location scripts against a stand-in phpIPAM.')
+    argp.add_argument('--output', type=str, default='benchmark.json', help='JSON file to write the results to')
+    argp.add_argument('--compare', type=str, default=None, help='JSON baseline to compare the results to')
+    argp.add_argument('--rtt', type=float, default=RTT, help='Simulated round trip time in seconds')
+    argp.add_argument('--jitter', type=float, default=0, help='Simulated jitter in seconds')
+    argp.add_argument('--profile', type=str, default=None, help='JSON file with latency, jitter and errorRate per endpoint')
+    argp.add_argument('--spokes', type=int, default=SPOKES, help='Number of spokes')
+    argp.add_argument('--landingzones', type=int, default=LANDINGZONES, help='Number of landing zones')
+    argp.add_argument('--renders', type=int, default=RENDERS, help='Number of renders per template')
+    argp.add_argument('--locations', type=int, default=LOCATIONS, help='Number of locations')
+    argp.add_argument('--workers', type=int, default=4, help='Number of parallel API calls')
+    args = argp.parse_args()
+
+    settings = {}
+    if args.profile:
+        with open(args.profile) as profile_file:
+            settings = json.load(profile_file)
+    settings.setdefault('default', {'latency': args.rtt, 'jitter': args.jitter})
+
+    server = ipamfake.FakeServer(('127.0.0.1', 0), profile = ipamfake.Profile(settings))
+    port = server.start()
+    workdir = tempfile.mkdtemp(prefix = 'phpipam-benchmark-')
+    config = {
+        'scheme': 'http',
+        'server': f"127.0.0.1:{port}",
+        'app': 'benchmark',
+        'token': 'benchmark',
+        'workers': args.workers,
+        'lockPath': os.path.join(workdir, 'locks'),
+        'templateCache': os.path.join(workdir, 'templates')
+    }
+    client = ipamclient.getClient(config)
+    spokedev = loadScript('spoke-dev.py', config)
+    landingzone = loadScript('landingzone-v2.py', config)
+
+    results = {
+        'settings': {
+            'rtt': args.rtt,
+            'jitter': args.jitter,
+            'profile': settings,
+            'workers': args.workers
+        },
+        'scenarios': {}
+    }
+    results['scenarios']['spoke'] = runScenario(client, spokeScenario(spokedev, args.spokes))
+    results['scenarios']['landingzone'] = runScenario(client, landingzoneScenario(landingzone, args.landingzones))
+    results['scenarios']['render'] = runScenario(client, renderScenario(spokedev, landingzone, args.renders))
+    results['scenarios']['locations'] = runScenario(client, locationScenario(client, args.locations, args.workers, workdir))
+    server.shutdown()
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent = 2, sort_keys = True)
+
+    output = {name: {'wall': result['wall'], 'calls': result['calls'], 'perMinute': result['perMinute'],
+        'failed': result['failed']} for name, result in results['scenarios'].items()}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            output['changes'] = compare(json.load(baseline_file), results)
+    return output
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
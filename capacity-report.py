@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+""" This script reports the capacity left in the regional supernets.
+
+This script loads all subnets of the sections holding the regional
+supernets of spokes and landing zones (see ipamregions), one call per
+section, and the addresses of every subnet without subnets below it, in
+parallel. For
+every supernet it reports:
+    - utilization: the share of the supernet taken by subnets
+    - addressUtilization: the share of the addresses in use in those subnets
+    - largestFree: the largest free block
+    - freeBlocks: the number of free blocks by prefix length
+    - spokes and landingZones: how many more of them still fit
+
+The numbers are computed on arrays of the network and broadcast addresses
+as integers, with NumPy when it is installed and in plain Python otherwise.
+The report is printed as JSON and written as CSV, one row per supernet.
+
+Given --snapshot, the subnets and addresses are read from a snapshot
+written by get_snapshot.py instead of from phpIPAM.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
+import argparse
+import csv
+import ipaddress
+import json
+import ipamclient
+import ipamscheduler
+import ipamregions
+import get_snapshot
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+WORKERS = 4 # Default number of parallel API calls
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def bounds(subnet):
+    '''
+    Return the network and broadcast address of a subnet as integers
+
+    :param dict subnet: phpIPAM subnet object
+    :return: IP version, network, broadcast and address width
+    :rtype: tuple
+    '''
+
+    address = ipaddress.ip_address(subnet['subnet'])
+    host = address.max_prefixlen - int(subnet['mask'])
+    start = int(address) >> host << host
+    return address.version, start, start + (1 << host) - 1, address.max_prefixlen
+
+def columns(subnets, addresses):
+    '''
+    Turn subnets into columns of integers, NumPy arrays where they fit
+
+    :param list subnets: phpIPAM subnet objects
+    :param dict addresses: Number of addresses in use by subnet ID, for the subnets without subnets below them
+    :return: Columns 'version', 'start', 'end', 'leaf' and 'used', one entry per subnet
+    :rtype: dict
+    '''
+
+    table = {'version': [], 'start': [], 'end': [], 'leaf': [], 'used': []}
+    for subnet in subnets:
+        version, start, end, width = bounds(subnet)
+        table['version'].append(version)
+        table['start'].append(start)
+        table['end'].append(end)
+        table['leaf'].append(str(subnet['id']) in addresses)
+        table['used'].append(addresses.get(str(subnet['id']), 0))
+    if numpy is not None and 6 not in table['version']:
+        table = {name: numpy.asarray(column, dtype = bool if name == 'leaf' else numpy.int64) for name, column in table.items()}
+    return table
+
+def gaps(starts, ends, low, high):
+    '''
+    Find the free ranges between subnets inside a supernet
+
+    :param list starts: Network addresses of the subnets
+    :param list ends: Broadcast addresses of the subnets
+    :param int low: Network address of the supernet
+    :param int high: Broadcast address of the supernet
+    :return: Addresses taken, and first and last address of every free range
+    :rtype: tuple
+    '''
+
+    if numpy is not None and not isinstance(starts, list):
+        order = numpy.argsort(starts, kind = 'stable')
+        starts = starts[order]
+        ends = ends[order]
+        if starts.size:
+            # The highest address taken before every subnet
+            previous = numpy.concatenate(([low - 1], numpy.maximum(numpy.maximum.accumulate(ends)[:-1], low - 1)))
+            taken = int(numpy.clip(ends - numpy.maximum(starts, previous + 1) + 1, 0, None).sum())
+            last = max(int(ends.max()), low - 1)
+        else:
+            previous = starts
+            taken = 0
+            last = low - 1
+        gapStarts = numpy.append(previous + 1, last + 1)
+        gapEnds = numpy.append(starts - 1, high)
+        keep = gapEnds >= gapStarts
+        return taken, gapStarts[keep], gapEnds[keep]
+
+    taken = 0
+    covered = low - 1
+    gapStarts = []
+    gapEnds = []
+    for start, end in sorted(zip(starts, ends)):
+        if start > covered + 1:
+            gapStarts.append(covered + 1)
+            gapEnds.append(start - 1)
+        if end > covered:
+            taken += end - max(start, covered + 1) + 1
+            covered = end
+    if covered < high:
+        gapStarts.append(covered + 1)
+        gapEnds.append(high)
+    return taken, gapStarts, gapEnds
+
+def freeBlocks(gapStarts, gapEnds, width):
+    '''
+    Split free ranges into the largest aligned blocks, i.e. CIDRs
+
+    :param list gapStarts: First address of every free range
+    :param list gapEnds: Last address of every free range
+    :param int width: Address width of the IP version
+    :return: Number of free blocks by prefix length
+    :rtype: dict
+    '''
+
+    counts = {}
+    if numpy is not None and not isinstance(gapStarts, list):
+        starts = gapStarts
+        sizes = gapEnds - gapStarts + 1
+        while starts.size:
+            # The alignment of the start, and the largest power of two that fits
+            align = numpy.where(starts == 0, numpy.int64(1) << width, starts & -starts)
+            fit = numpy.left_shift(numpy.int64(1), numpy.floor(numpy.log2(sizes)).astype(numpy.int64))
+            blocks = numpy.minimum(align, fit)
+            prefixes, found = numpy.unique(width - numpy.log2(blocks).astype(numpy.int64), return_counts = True)
+            for prefix, count in zip(prefixes.tolist(), found.tolist()):
+                counts[prefix] = counts.get(prefix, 0) + count
+            keep = sizes > blocks
+            starts = (starts + blocks)[keep]
+            sizes = (sizes - blocks)[keep]
+        return dict(sorted(counts.items()))
+
+    for start, end in zip(gapStarts, gapEnds):
+        while start <= end:
+            block = start & -start if start else 1 << width
+            while block > end - start + 1:
+                block >>= 1
+            prefix = width - block.bit_length() + 1
+            counts[prefix] = counts.get(prefix, 0) + 1
+            start += block
+    return dict(sorted(counts.items()))
+
+def loadSubnets(client, supernets):
+    '''
+    Load all subnets of the sections holding the supernets
+
+    :param IpamClient client: phpIPAM client
+    :param dict supernets: Regions by supernet ID
+    :return: phpIPAM subnet objects by ID
+    :rtype: dict
+    '''
+
+    sections = set()
+    for masterId in supernets:
+        r = client.getCached(f"subnets/{masterId}/")
+        if r.get('code') == 200:
+            sections.add(str(r['data']['sectionId']))
+
+    subnets = {}
+    for sectionId in sorted(sections):
+        r = client.request('GET', f"sections/{sectionId}/subnets/").json()
+        for subnet in r.get('data') or []:
+            if str(subnet.get('isFolder', 0)) != '1' and subnet.get('subnet'):
+                subnets[str(subnet['id'])] = subnet
+    return subnets
+
+def countAddresses(client, subnetIds, workers = WORKERS):
+    '''
+    Count the addresses in use in subnets, in parallel
+
+    :param IpamClient client: phpIPAM client
+    :param list subnetIds: IDs of the subnets
+    :param int workers: Maximum number of parallel API calls
+    :return: Number of addresses by subnet ID
+    :rtype: dict
+    '''
+
+    def count(subnetId):
+        r = client.getAddresses(subnetId)
+        return len(r.get('data') or []) if r.get('code') == 200 else 0
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        return dict(zip(subnetIds, executor.map(count, subnetIds)))
+
+def loadSnapshot(directory, supernets):
+    '''
+    Read the subnets and address counts from a snapshot
+
+    :param str directory: Snapshot directory, see get_snapshot
+    :param dict supernets: Regions by supernet ID
+    :return: phpIPAM subnet objects by ID of the sections holding the supernets, and number of addresses by subnet ID
+    :rtype: tuple
+    '''
+
+    rows = {str(row['id']): row for row in get_snapshot.readRows(directory, 'subnets')
+        if not row['isFolder'] and row['subnet']}
+    sections = {row['sectionId'] for subnetId, row in rows.items() if subnetId in supernets}
+    subnets = {subnetId: dict(row, id = subnetId, masterSubnetId = str(row['masterSubnetId']))
+        for subnetId, row in rows.items() if row['sectionId'] in sections}
+    addresses = {}
+    for row in get_snapshot.readRows(directory, 'addresses'):
+        addresses[str(row['subnetId'])] = addresses.get(str(row['subnetId']), 0) + 1
+    return subnets, addresses
+
+def reportSupernet(supernet, table, sizes):
+    '''
+    Compute the capacity of one supernet
+
+    :param dict supernet: phpIPAM subnet object of the supernet
+    :param dict table: Columns of all subnets, see columns
+    :param dict sizes: Prefix lengths to project the remaining capacity for, by name
+    :return: Capacity of the supernet
+    :rtype: dict
+    '''
+
+    version, low, high, width = bounds(supernet)
+    if isinstance(table['start'], list):
+        inside = [index for index in range(len(table['start'])) if table['version'][index] == version
+            and low <= table['start'][index] and table['end'][index] <= high
+            and (table['start'][index], table['end'][index]) != (low, high)]
+        starts = [table['start'][index] for index in inside]
+        ends = [table['end'][index] for index in inside]
+        leaves = [index for index in inside if table['leaf'][index]]
+        leafSize = sum(table['end'][index] - table['start'][index] + 1 for index in leaves)
+        used = sum(table['used'][index] for index in leaves)
+    else:
+        inside = (table['version'] == version) & (table['start'] >= low) & (table['end'] <= high) \
+            & ((table['start'] != low) | (table['end'] != high))
+        starts = table['start'][inside]
+        ends = table['end'][inside]
+        leaves = inside & table['leaf']
+        leafSize = int((table['end'][leaves] - table['start'][leaves] + 1).sum())
+        used = int(table['used'][leaves].sum())
+
+    taken, gapStarts, gapEnds = gaps(starts, ends, low, high)
+    blocks = freeBlocks(gapStarts, gapEnds, width)
+    output = {
+        'id': str(supernet['id']),
+        'subnet': f"{supernet['subnet']}/{supernet['mask']}",
+        'description': supernet.get('description', ''),
+        'size': high - low + 1,
+        'allocated': taken,
+        'utilization': taken / (high - low + 1),
+        'subnets': len(starts),
+        'addresses': used,
+        'addressUtilization': used / leafSize if leafSize else 0,
+        'largestFree': f"/{min(blocks)}" if blocks else None,
+        'freeBlocks': {f"/{prefix}": count for prefix, count in blocks.items()}
+    }
+    for name, size in sizes.items():
+        output[name] = sum(count << (size - prefix) for prefix, count in blocks.items() if prefix <= size)
+    return output
+
+def buildReport(client, supernets, workers = WORKERS, snapshot = None):
+    '''
+    Compute the capacity of all regional supernets
+
+    :param IpamClient client: phpIPAM client
+    :param dict supernets: Regions by supernet ID
+    :param int workers: Maximum number of parallel API calls
+    :param str snapshot: Snapshot directory to read instead of phpIPAM, or None
+    :return: Capacity by supernet, in supernet ID order
+    :rtype: list
+    '''
+
+    if snapshot is not None:
+        subnets, addresses = loadSnapshot(snapshot, supernets)
+    else:
+        subnets = loadSubnets(client, supernets)
+    parents = {str(subnet.get('masterSubnetId')) for subnet in subnets.values()}
+    leaves = [subnetId for subnetId in subnets if subnetId not in parents]
+    if snapshot is not None:
+        addresses = {subnetId: addresses.get(subnetId, 0) for subnetId in leaves}
+    else:
+        addresses = countAddresses(client, leaves, workers)
+    table = columns(list(subnets.values()), addresses)
+
+    sizes = {
+        'spokes': ipamscheduler.loadLayout('spoke')['size'],
+        'landingZones': ipamscheduler.loadLayout('sharedservices')['size']
+    }
+    report = []
+    for masterId in sorted((masterId for masterId in supernets if masterId in subnets), key = int):
+        output = reportSupernet(subnets[masterId], table, sizes)
+        output['regions'] = supernets[masterId]
+        report.append(output)
+    return report
+
+def writeCsv(filename, report):
+    '''
+    Write the report as CSV, one row per supernet
+
+    :param str filename: CSV file name
+    :param list report: Capacity by supernet
+    '''
+
+    prefixes = sorted({prefix for output in report for prefix in output['freeBlocks']}, key = lambda prefix: int(prefix[1:]))
+    header = ['id', 'subnet', 'description', 'regions', 'size', 'allocated', 'utilization', 'subnets', 'addresses',
+        'addressUtilization', 'largestFree', 'spokes', 'landingZones'] + [f"free{prefix}" for prefix in prefixes]
+    with open(filename, 'w', newline='', encoding='utf-8-sig') as data_file:
+        csv_writer = csv.writer(data_file)
+        csv_writer.writerow(header)
+        for output in report:
+            row = dict(output, regions = ' '.join(output['regions']))
+            row.update({f"free{prefix}": output['freeBlocks'].get(prefix, 0) for prefix in prefixes})
+            csv_writer.writerow([row[column] for column in header])
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Report the capacity left in the regional supernets.')
+    argp.add_argument('--csv', type=str, default='capacity.csv', help='CSV file to write')
+    argp.add_argument('--workers', type=int, default=WORKERS, help='Number of parallel API calls')
+    argp.add_argument('--snapshot', type=str, default=None, help='Snapshot directory to read instead of phpIPAM')
+    args = argp.parse_args()
+
+    client = ipamclient.getClient(loadConfig()) if args.snapshot is None else None
+    report = buildReport(client, ipamregions.supernets(ipamregions.SPOKES, ipamregions.LANDINGZONES), args.workers, args.snapshot)
+    writeCsv(args.csv, report)
+    return {'code': 200, 'success': 'true', 'engine': 'numpy' if numpy is not None else 'python', 'data': report}
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
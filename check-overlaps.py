@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+""" This script finds overlaps between phpIPAM and other CIDR lists.
+
+This script reads the subnets in phpIPAM and any number of local files with
+CIDRs, e.g. on-premises ranges, partner networks or AWS describe-vpcs dumps
+of VPCs created outside phpIPAM, and reports every overlap between ranges
+of different sources. Given --cidr, it only reports what the given CIDRs
+overlap, e.g. to check a new VPC before onboarding.
+
+With --index, the ranges of the local files are saved as the index the
+provisioning scripts check planned VPCs against, see ipamoverlap.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
+import argparse
+import json
+import ipamclient
+import ipamoverlap
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Find overlaps between phpIPAM and other CIDR lists.')
+    argp.add_argument('files', type=str, nargs='*', help='Files with one CIDR per line, or AWS describe-vpcs JSON dumps')
+    argp.add_argument('--sections', type=str, default=None, help='Comma-separated phpIPAM section IDs, all sections by default')
+    argp.add_argument('--no-phpipam', action='store_true', help="Don't read the subnets in phpIPAM")
+    argp.add_argument('--cidr', type=str, action='append', default=[], help='Only check this CIDR, may be repeated')
+    argp.add_argument('--index', type=str, default=None, help='Save the ranges of the files as an index for the provisioning scripts')
+    args = argp.parse_args()
+
+    try:
+        external = [found for filename in args.files for found in ipamoverlap.loadFile(filename)]
+    except (IOError, ValueError) as e:
+        return {'code': 400, 'success': 'false', 'data': {'description': str(e)}}
+    if args.index:
+        ipamoverlap.OverlapIndex(external).save(args.index)
+
+    ranges = list(external)
+    if not args.no_phpipam:
+        sections = args.sections.split(',') if args.sections else None
+        ranges.extend(ipamoverlap.loadPhpipam(ipamclient.getClient(loadConfig()), sections))
+
+    if args.cidr:
+        index = ipamoverlap.OverlapIndex(ranges)
+        overlaps = [{'range': ipamoverlap.makeRange(cidr, 'cidr'), 'overlaps': found, 'relation': ipamoverlap.relation(ipamoverlap.makeRange(cidr, 'cidr'), found)}
+            for cidr in args.cidr for found in index.overlaps(cidr)]
+    else:
+        overlaps = ipamoverlap.findOverlaps(ranges)
+
+    output = {'code': 200, 'success': 'true', 'ranges': len(ranges)}
+    output['data'] = [{'cidr': overlap['range']['cidr'], 'source': overlap['range']['source'], 'label': overlap['range']['label'],
+        'relation': overlap['relation'], 'overlapsCidr': overlap['overlaps']['cidr'], 'overlapsSource': overlap['overlaps']['source'],
+        'overlapsLabel': overlap['overlaps']['label']} for overlap in overlaps]
+    if output['data']:
+        output['code'] = 409
+        output['success'] = 'false'
+    return output
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
@@ -1,32 +1,199 @@
 #!/usr/bin/env python3
-import json
+""" This script exports the phpIPAM locations to a CSV file.
+
+The response is parsed incrementally and every location is written to the
+CSV file as soon as it has arrived, so memory use stays bounded however large
+the location table grows. Compressed (gzip) responses are decoded on the fly.
+
+With --page-size the locations are requested in pages using limit and
+offset, for servers that support it. A server ignoring these parameters is
+detected by a page being larger than asked for, or by a page starting with
+the same location as the first page.
+
+A request phpIPAM refuses, or an answer without a data array, fails the
+export with the API message instead of leaving an empty CSV file.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import re
+import sys
+import argparse
+import codecs
 import csv
-import http.client
-import mimetypes
-
-with open('config.json') as json_config_file:
-    config = json.load(json_config_file)
-
-conn = http.client.HTTPSConnection(config['server'])
-payload = ''
-headers = {
-  'token': config['token'],
-}
-conn.request('GET', '/api/' + config['app'] + '/tools/locations/', payload, headers)
-res = conn.getresponse()
-data = res.read().decode('utf-8')
-
-with open('data_file.csv', 'w', newline='', encoding='utf-8-sig') as data_file:
-    csv_writer = csv.writer(data_file)
-
-    # Use a counter for the headers
-    count = 0
-    	
-    for item in json.loads(data)['data']:
-        # Only for the 1st line write the header (keys)
-        if count == 0:
-            header = item.keys()
-            csv_writer.writerow(header)
-            count += 1
-    
-        csv_writer.writerow(item.values())
+import json
+import ipamclient
+
+CHUNKSIZE = 65536 # Bytes read from the response at a time
+
+class ExportError(Exception):
+    '''
+    phpIPAM refused the export or answered without locations
+    '''
+
+def apiMessage(text, default):
+    '''
+    Pick the message out of a phpIPAM error response
+
+    :param str text: Response body
+    :param str default: Message when the body has none
+    :return: Message
+    :rtype: str
+    '''
+
+    try:
+        return json.loads(text).get('message') or default
+    except (ValueError, AttributeError):
+        return default
+
+def iterItems(chunks, key = 'data'):
+    '''
+    Yield the objects of a top-level JSON array as soon as they are complete
+
+    :param iterable chunks: Raw chunks of a JSON document
+    :param str key: Key of the array in the top-level object
+    :return: Generator of the objects in the array
+    :rtype: generator
+    :raises ExportError: If the document has no such array
+    '''
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    skip = re.compile(r'[\s,]*')
+    buffer = ''
+    inArray = False
+
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        if not inArray:
+            match = start.search(buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            inArray = True
+
+        position = 0
+        while True:
+            position = skip.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The next object hasn't fully arrived yet
+                break
+            yield item
+        buffer = buffer[position:]
+
+    if not inArray:
+        raise ExportError(apiMessage(buffer, f"No {key} array in the response."))
+
+def iterLocations(client, pageSize = 0):
+    '''
+    Yield all locations, page by page if asked for
+
+    :param IpamClient client: phpIPAM client
+    :param int pageSize: Number of locations per page, 0 for a single request
+    :return: Generator of locations
+    :rtype: generator
+    :raises ExportError: If phpIPAM refused a request or answered without locations
+    '''
+
+    offset = 0
+    firstId = None
+    while True:
+        endpoint = 'tools/locations/'
+        if pageSize:
+            endpoint += f"?limit={pageSize}&offset={offset}"
+
+        r = client.request('GET', endpoint, stream = True)
+        count = 0
+        try:
+            if r.status_code == 404:
+                # phpIPAM answers an empty table, or a page past the last one, with not found
+                return
+            if not r.ok:
+                raise ExportError(f"{r.status_code}: {apiMessage(r.text, r.reason)}")
+            for item in iterItems(r.iter_content(CHUNKSIZE)):
+                if count == 0 and offset == 0:
+                    firstId = item.get('id')
+                elif count == 0 and item.get('id') == firstId:
+                    return
+                count += 1
+                yield item
+        finally:
+            r.close()
+
+        # Stop at the last page, or when the server returned everything at once
+        if not pageSize or count != pageSize:
+            return
+        offset += count
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Export locations to a CSV file.')
+    argp.add_argument('outfile', type=str, nargs='?', default='data_file.csv', help='CSV file to write')
+    argp.add_argument('--page-size', type=int, default=0, help='Request the locations in pages of this size')
+    args = argp.parse_args()
+
+    client = ipamclient.getClient(loadConfig())
+
+    try:
+        with open(args.outfile, 'w', newline='', encoding='utf-8-sig') as data_file:
+            csv_writer = csv.writer(data_file)
+
+            # Use a counter for the headers
+            count = 0
+
+            for item in iterLocations(client, args.page_size):
+                # Only for the 1st line write the header (keys)
+                if count == 0:
+                    header = item.keys()
+                    csv_writer.writerow(header)
+                    count += 1
+
+                csv_writer.writerow(item.values())
+    except ExportError as e:
+        # Don't leave a CSV file behind that looks complete
+        os.remove(args.outfile)
+        sys.exit(json.dumps({'code': 500, 'success': 'false', 'data': {'description': f"Export failed, {e}"}}))
+
+if __name__ == "__main__":
+    main()
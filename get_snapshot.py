@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+""" This script exports a snapshot of the whole phpIPAM to columnar files.
+
+This script pulls the sections, subnets, addresses, nameservers and
+locations with parallel requests and writes every one of them as a typed
+table in a new snapshot directory, with a manifest.json describing the
+tables. Network, broadcast and host addresses are stored as integers next
+to their text form, so ranges can be compared without parsing. IPv6
+addresses don't fit the integer columns and are only kept as text.
+
+The tables are written as uncompressed Arrow IPC files by default, which
+can be memory-mapped, or as Parquet files. Both need pyarrow; without it
+the tables are written as CSV files.
+
+Other scripts read a snapshot with readRows instead of calling the API,
+e.g. capacity-report.py --snapshot.
+
+With --incremental, an existing snapshot is brought up to date instead. The
+manifest records the latest editDate of every table as its high-water mark,
+with the IDs of the rows edited at exactly that time. Only the addresses are
+synced incrementally: the sections, the subnet lists (one call per section),
+the nameservers and the locations are pulled in full on every run, as the
+API can't list just the objects edited or deleted since a date. The subnet
+lists also show the subnets that were deleted. The addresses are only
+fetched for the subnets that are new,
+were edited after the mark, or whose address count in their usage differs
+from the snapshot; the addresses of the other subnets are kept on trust and
+their number is reported. An address edited in place, without a change of
+the count or of its subnet, is caught by a full pull, which an incremental
+run falls back to once the last one is older than --reconcile hours.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import sys
+import argparse
+import csv
+import ipaddress
+import json
+import time
+import ipamclient
+import get_locations
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+WORKERS = 4 # Default number of parallel API calls
+RECONCILE = 24 # Default hours between full pulls in incremental mode
+EXTENSIONS = {'arrow': '.arrow', 'parquet': '.parquet', 'csv': '.csv'}
+
+# Columns and their types by table, 'ip' being an IPv4 address as an unsigned integer
+SCHEMAS = {
+    'sections': [('id', 'int'), ('name', 'str'), ('description', 'str'), ('masterSection', 'int')],
+    'subnets': [('id', 'int'), ('sectionId', 'int'), ('masterSubnetId', 'int'), ('subnet', 'str'), ('mask', 'int'),
+        ('version', 'int'), ('start', 'ip'), ('end', 'ip'), ('description', 'str'), ('nameserverId', 'int'),
+        ('vlanId', 'int'), ('location', 'int'), ('allowRequests', 'bool'), ('isFolder', 'bool'), ('editDate', 'str')],
+    'addresses': [('id', 'int'), ('subnetId', 'int'), ('ip', 'str'), ('address', 'ip'), ('hostname', 'str'),
+        ('description', 'str'), ('is_gateway', 'bool'), ('tag', 'int'), ('editDate', 'str')],
+    'nameservers': [('id', 'int'), ('name', 'str'), ('namesrv1', 'str'), ('description', 'str'), ('editDate', 'str')],
+    'locations': [('id', 'int'), ('name', 'str'), ('description', 'str'), ('address', 'str'), ('lat', 'float'),
+        ('long', 'float'), ('editDate', 'str')]
+}
+
+def convert(value, kind):
+    '''
+    Convert a value from the API to the type of its column
+
+    :param value: Value as returned by the API
+    :param str kind: 'int', 'ip', 'float', 'bool' or 'str'
+    :return: Converted value, None when empty
+    '''
+
+    if value is None or value == '':
+        return None
+    if kind in ('int', 'ip'):
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    if kind == 'bool':
+        return str(value).lower() in ('1', 'true')
+    return str(value)
+
+def ipv4(value):
+    '''
+    Return an IPv4 address as an integer
+
+    :param str value: IP address
+    :return: Integer, None for an IPv6 address
+    :rtype: int
+    '''
+
+    address = ipaddress.ip_address(value)
+    return int(address) if address.version == 4 else None
+
+def subnetRow(subnet):
+    '''
+    Add the version, network and broadcast address to a subnet
+
+    :param dict subnet: phpIPAM subnet object
+    :return: Row of the subnets table
+    :rtype: dict
+    '''
+
+    row = dict(subnet)
+    if subnet.get('subnet') and str(subnet.get('isFolder', 0)) != '1':
+        network = ipaddress.ip_network(f"{subnet['subnet']}/{subnet['mask']}", strict = False)
+        row['version'] = network.version
+        if network.version == 4:
+            row['start'] = int(network.network_address)
+            row['end'] = int(network.broadcast_address)
+    return row
+
+def addressRow(address):
+    '''
+    Add the integer form to an address
+
+    :param dict address: phpIPAM address object
+    :return: Row of the addresses table
+    :rtype: dict
+    '''
+
+    return dict(address, address = ipv4(address['ip']) if address.get('ip') else None)
+
+def highWater(tables):
+    '''
+    Return the latest editDate of every table
+
+    :param dict tables: Rows by table name
+    :return: Latest editDate by table name, None for a table without any
+    :rtype: dict
+    '''
+
+    return {name: max((str(row['editDate']) for row in rows if row.get('editDate')), default = None)
+        for name, rows in tables.items()}
+
+def markedIds(tables, marks):
+    '''
+    Return the IDs of the rows of every table edited at its high-water mark
+
+    :param dict tables: Rows by table name
+    :param dict marks: High-water marks by table name, see highWater
+    :return: Sorted IDs by table name
+    :rtype: dict
+    '''
+
+    return {name: sorted(str(row['id']) for row in rows if marks.get(name) and str(row.get('editDate') or '') == marks[name])
+        for name, rows in tables.items()}
+
+def changed(subnet, known, counts, mark, seen):
+    '''
+    Tell whether the addresses of a subnet may differ from an earlier snapshot
+
+    :param dict subnet: phpIPAM subnet object, with its usage
+    :param set known: IDs of the subnets in the earlier snapshot
+    :param dict counts: Number of addresses by subnet ID in the earlier snapshot
+    :param str mark: High-water mark of the subnets in the earlier snapshot
+    :param set seen: IDs of the subnets edited at the mark, already in the earlier snapshot
+    :return: Whether the addresses have to be fetched
+    :rtype: bool
+    '''
+
+    subnetId = str(subnet['id'])
+    if subnetId not in known:
+        return True
+    edited = str(subnet.get('editDate') or '')
+    if edited and (mark is None or edited > mark or (edited == mark and subnetId not in seen)):
+        return True
+    # Addresses added or deleted change the usage, not the editDate of the subnet
+    used = (subnet.get('usage') or {}).get('used')
+    return used is None or int(used) != counts.get(subnetId, 0)
+
+def fetch(client, workers = WORKERS, previous = None, marks = None, seen = None):
+    '''
+    Pull all sections, subnets, addresses, nameservers and locations
+
+    Given an earlier snapshot, the addresses are only fetched for the subnets
+    whose addresses may have changed since, see changed. Everything else is
+    pulled in full either way.
+
+    :param IpamClient client: phpIPAM client
+    :param int workers: Maximum number of parallel API calls
+    :param dict previous: Rows by table name of an earlier snapshot, or None for a full pull
+    :param dict marks: High-water marks of the earlier snapshot, see highWater
+    :param dict seen: IDs edited at the high-water marks of the earlier snapshot, see markedIds
+    :return: Rows by table name, the number of subnets whose addresses were fetched and of those kept on trust
+    :rtype: tuple
+    '''
+
+    def data(endpoint):
+        r = client.request('GET', endpoint).json()
+        return (r.get('data') or []) if r.get('code') == 200 else []
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        nameservers = executor.submit(data, 'tools/nameservers/')
+        locations = executor.submit(lambda: list(get_locations.iterLocations(client)))
+        sections = data('sections/')
+        subnets = [subnet for found in executor.map(lambda section: data(f"sections/{section['id']}/subnets/"), sections)
+            for subnet in found]
+        subnets = [subnet for subnet in subnets if str(subnet.get('isFolder', 0)) != '1']
+
+        stale = subnets
+        kept = []
+        if previous is not None:
+            known = {str(subnet['id']) for subnet in previous['subnets']}
+            counts = {}
+            for address in previous['addresses']:
+                counts[str(address['subnetId'])] = counts.get(str(address['subnetId']), 0) + 1
+            stale = [subnet for subnet in subnets if changed(subnet, known, counts, (marks or {}).get('subnets'),
+                set((seen or {}).get('subnets', [])))]
+            # Keep the addresses of the other subnets, the deleted ones' go
+            fresh = {str(subnet['id']) for subnet in stale}
+            current = {str(subnet['id']) for subnet in subnets}
+            kept = [address for address in previous['addresses']
+                if str(address['subnetId']) in current and str(address['subnetId']) not in fresh]
+
+        addresses = [address for found in executor.map(lambda subnet: data(f"subnets/{subnet['id']}/addresses/"), stale)
+            for address in found]
+        return {
+            'sections': sections,
+            'subnets': [subnetRow(subnet) for subnet in subnets],
+            'addresses': kept + [addressRow(address) for address in addresses],
+            'nameservers': nameservers.result(),
+            'locations': locations.result()
+        }, len(stale), len(subnets) - len(stale)
+
+def writeTable(filename, rows, schema, fileFormat):
+    '''
+    Write the rows of a table as a typed columnar file
+
+    :param str filename: File name
+    :param list rows: Rows
+    :param list schema: Column names and types
+    :param str fileFormat: 'arrow', 'parquet' or 'csv'
+    '''
+
+    # Replace the file in one step, readers keep the old one while they have it open
+    temporary = filename + '.tmp'
+    columns = {name: [convert(row.get(name), kind) for row in rows] for name, kind in schema}
+    if fileFormat == 'csv':
+        with open(temporary, 'w', newline='', encoding='utf-8') as data_file:
+            csv_writer = csv.writer(data_file)
+            csv_writer.writerow([name for name, kind in schema])
+            csv_writer.writerows(zip(*columns.values()) if rows else [])
+        os.replace(temporary, filename)
+        return
+
+    types = {'int': pyarrow.int64(), 'ip': pyarrow.uint32(), 'float': pyarrow.float64(), 'bool': pyarrow.bool_(),
+        'str': pyarrow.string()}
+    table = pyarrow.table({name: pyarrow.array(columns[name], type = types[kind]) for name, kind in schema})
+    if fileFormat == 'parquet':
+        pyarrow.parquet.write_table(table, temporary)
+    else:
+        pyarrow.feather.write_feather(table, temporary, compression = 'uncompressed')
+    os.replace(temporary, filename)
+
+def writeSnapshot(directory, tables, fileFormat, reconciled = None):
+    '''
+    Write all tables and the manifest of a snapshot
+
+    :param str directory: Snapshot directory, created if needed
+    :param dict tables: Rows by table name
+    :param str fileFormat: 'arrow', 'parquet' or 'csv'
+    :param float reconciled: Unix timestamp of the last full pull, now by default
+    :return: Manifest
+    :rtype: dict
+    '''
+
+    os.makedirs(directory, exist_ok = True)
+    marks = highWater(tables)
+    manifest = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'format': fileFormat,
+        'reconciled': reconciled or time.time(),
+        'highWater': marks,
+        'highWaterIds': markedIds(tables, marks),
+        'tables': {}
+    }
+    for name, rows in tables.items():
+        filename = name + EXTENSIONS[fileFormat]
+        writeTable(os.path.join(directory, filename), rows, SCHEMAS[name], fileFormat)
+        manifest['tables'][name] = {'file': filename, 'rows': len(rows), 'columns': dict(SCHEMAS[name])}
+    # The manifest goes last, so it never points at tables that aren't written yet
+    temporary = os.path.join(directory, 'manifest.json.tmp')
+    with open(temporary, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2)
+    os.replace(temporary, os.path.join(directory, 'manifest.json'))
+    return manifest
+
+def readManifest(directory):
+    '''
+    Read the manifest of a snapshot
+
+    :param str directory: Snapshot directory
+    :return: Manifest
+    :rtype: dict
+    :raises IOError: If there is no snapshot in the directory
+    '''
+
+    with open(os.path.join(directory, 'manifest.json')) as manifest_file:
+        return json.load(manifest_file)
+
+def readRows(directory, name):
+    '''
+    Read a table of a snapshot
+
+    :param str directory: Snapshot directory
+    :param str name: Table name, e.g. 'subnets'
+    :return: Rows with typed values
+    :rtype: list
+    :raises IOError: If the snapshot or the table can't be read
+    '''
+
+    manifest = readManifest(directory)
+    table = manifest['tables'][name]
+    filename = os.path.join(directory, table['file'])
+    if manifest['format'] == 'csv':
+        with open(filename, 'r', encoding='utf-8') as data_file:
+            return [{column: convert(value, table['columns'][column]) for column, value in row.items()}
+                for row in csv.DictReader(data_file)]
+    if pyarrow is None:
+        raise IOError(f"Reading {filename} needs pyarrow.")
+    if manifest['format'] == 'parquet':
+        return pyarrow.parquet.read_table(filename).to_pylist()
+    return pyarrow.feather.read_table(filename, memory_map = True).to_pylist()
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Export a snapshot of phpIPAM to columnar files.')
+    argp.add_argument('directory', type=str, nargs='?', default=None, help='Snapshot directory, snapshot-<time> by default')
+    argp.add_argument('--format', type=str, choices=sorted(EXTENSIONS), default='arrow', help='File format, csv without pyarrow')
+    argp.add_argument('--workers', type=int, default=WORKERS, help='Number of parallel API calls')
+    argp.add_argument('--incremental', action='store_true', help='Bring the snapshot in the directory up to date')
+    argp.add_argument('--reconcile', type=float, default=RECONCILE, help='Hours after which an incremental run pulls everything')
+    args = argp.parse_args()
+
+    fileFormat = args.format if pyarrow is not None else 'csv'
+    if args.incremental and not args.directory:
+        return {'code': 400, 'success': 'false', 'data': {'description': 'An incremental run needs the snapshot directory.'}}
+    directory = args.directory or time.strftime('snapshot-%Y%m%d-%H%M%S')
+
+    client = ipamclient.getClient(loadConfig())
+
+    starttime = time.time()
+    previous = None
+    marks = None
+    seen = None
+    reconciled = None
+    if args.incremental:
+        try:
+            manifest = readManifest(directory)
+            if time.time() - manifest['reconciled'] < args.reconcile * 3600:
+                fileFormat = manifest['format']
+                previous = {name: readRows(directory, name) for name in ('subnets', 'addresses')}
+                marks = manifest['highWater']
+                seen = manifest.get('highWaterIds', {})
+                reconciled = manifest['reconciled']
+        except (IOError, KeyError, ValueError):
+            # No usable snapshot yet, start with a full pull
+            previous = None
+
+    tables, refreshed, trusted = fetch(client, args.workers, previous, marks, seen)
+    manifest = writeSnapshot(directory, tables, fileFormat, reconciled)
+    return {'code': 200, 'success': 'true', 'directory': directory, 'mode': 'full' if previous is None else 'incremental',
+        'refreshed': refreshed, 'trusted': trusted, 'data': manifest, 'time': time.time() - starttime}
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
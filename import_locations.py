@@ -6,6 +6,11 @@ This file parses a UTF8 encoded and signed CSV file containing
 location ('sites') information and 
 imports them into phpIPAM.
 
+Rows are imported in parallel by a bounded pool of workers sharing pooled
+connections, optionally under a ceiling of requests per second. The outcome
+of every row (success, id and error message) is written to a results CSV
+file, and failed rows don't stop the import.
+
 --
 
 This program is free software: you can redistribute it and/or modify it under
@@ -24,48 +29,107 @@ __author__ = "Peet van de Sande"
 __contact__ = "pvandesande@tmhcc.com"
 __license__ = "GPLv3"
 
+import sys
 import argparse
 import csv
-import requests
 import json
 import urllib.parse
+import ipamclient
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+WORKERS = 4 # Default number of parallel imports
+
+def importLocation(client, limiter, line):
+    '''
+    Create one location from a CSV row
+
+    :param IpamClient client: phpIPAM client
+    :param RateLimiter limiter: Rate ceiling shared by all workers
+    :param dict line: CSV row
+    :return: Result with name, success, id and message
+    :rtype: dict
+    '''
+
+    payload = ""
+    name = ""
+    for key, value in line.items():
+        if value == 'null':
+            value = ''
+        else:
+            value = urllib.parse.quote(value)
+        payload = payload + f"&{key}={value}"
+        if key == "name":
+            name = value
+
+    result = {'name': urllib.parse.unquote(name), 'success': 'false', 'id': '', 'message': ''}
+    limiter.wait()
+    try:
+        response = client.request("POST", "tools/locations/", payload, headers={'Content-Type': 'text/plain'}).json()
+    except Exception as e:
+        result['message'] = str(e)
+        return result
+
+    result['success'] = 'true' if response.get('success') else 'false'
+    result['id'] = response.get('id', '')
+    result['message'] = response.get('message', '')
+    return result
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
 
 def main():
     # Read input arguments
     argp = argparse.ArgumentParser(description = 'Import locations based on CSV input.')
     argp.add_argument('infile', type=str, nargs=1, help='UTF8 encoded input CSV file')
+    argp.add_argument('--results', type=str, default='import_results.csv', help='CSV file to write the result per row to')
+    argp.add_argument('--workers', type=int, default=WORKERS, help='Number of parallel imports')
+    argp.add_argument('--rate', type=float, default=0, help='Maximum number of requests per second')
     args = argp.parse_args()
 
-    # Clean library of locations
-    locations = {}
+    client = ipamclient.getClient(loadConfig())
+    limiter = ipamclient.RateLimiter(args.rate)
 
-    url = "https://phpipam.hcch.com/api/PeetScript/tools/locations/"
-    headers = {
-        'token': 'dvQGBJIh14g17wgtzVLiZYUhFffo-yzu',
-        'Content-Type': 'text/plain'
-    }
-
-    # Open infile
-    with open(args.infile[0], 'r', encoding='utf-8-sig') as data_file:
+    # Open infile and the results file
+    with open(args.infile[0], 'r', encoding='utf-8-sig') as data_file, \
+            open(args.results, 'w', newline='', encoding='utf-8-sig') as results_file:
         csv_reader = csv.DictReader(data_file)
+        csv_writer = csv.DictWriter(results_file, ['row', 'name', 'success', 'id', 'message'])
+        csv_writer.writeheader()
+        counts = {'true': 0, 'false': 0}
+
+        # Keep a bounded number of rows in flight so large files don't pile up in memory
+        with ThreadPoolExecutor(max_workers = args.workers) as executor:
+            running = {}
+            for row, line in enumerate(csv_reader, 1):
+                if len(running) >= args.workers * 2:
+                    done, _ = wait(running, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        result['row'] = running.pop(future)
+                        csv_writer.writerow(result)
+                        counts[result['success']] += 1
+                running[executor.submit(importLocation, client, limiter, line)] = row
+
+            for future in list(running):
+                result = future.result()
+                result['row'] = running.pop(future)
+                csv_writer.writerow(result)
+                counts[result['success']] += 1
 
-        for line in csv_reader:
-            payload = ""
-            name = ""
-            for key, value in line.items():
-                if value == 'null':
-                    value = ''
-                else:
-                    value = urllib.parse.quote(value)
-                payload = payload + f"&{key}={value}"
-                if key == "name":
-                    name = value
-
-            r = requests.request("POST", url, headers=headers, data=payload)
-            response = json.loads(r.text)
-            print(f"{name}: {response['success']}")
-            if 'message' in response:
-                print(response['message'])
+    print(json.dumps({'imported': counts['true'], 'failed': counts['false'], 'results': args.results}))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+""" Best-fit allocator for the regional supernets.
+
+Spokes are taken from the start of a regional supernet and transit and vEdge
+blocks from its end, so over time the mixed allocations leave holes of all
+sizes. This allocator keeps the free space of every supernet it plans in as
+free lists by size class, like a buddy system: every free block is aligned
+to its size and listed under its prefix length. A request takes the
+tightest-fitting free block, i.e. the smallest class that holds it, and
+splits off what it doesn't need, which leaves the large blocks whole.
+Releasing a block merges it with its buddy again where that is free.
+
+Allocating and releasing touch one entry per size class on the way, so they
+take time in the order of the prefix length, not of the number of subnets.
+
+BuddyTrie is a PrefixTrie (see ipamtrie), so it can be given to
+provisionLayout as its trie. Set the optional 'allocator' key in config.json
+to 'bestfit' to have the provisioning scripts plan with it.
+
+Run this script with supernet IDs to see how fragmented they are.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
+import argparse
+import bisect
+import json
+import time
+import threading
+import ipamclient
+import ipamtrie
+
+MAXAGE = 300 # Default seconds before a loaded section is loaded again
+
+tries = {}
+triesLock = threading.Lock()
+
+class BuddyTrie(ipamtrie.PrefixTrie):
+    '''
+    Prefix trie with free lists by size class for the supernets it plans in
+    '''
+
+    def __init__(self):
+        super().__init__()
+        # Free lists by supernet CIDR, each a dict of sorted addresses by prefix length
+        self.pools = {}
+
+    def manage(self, cidr):
+        '''
+        Start keeping the free lists of a supernet
+
+        :param str cidr: CIDR of the supernet
+        :return: Free lists of the supernet
+        :rtype: dict
+        '''
+
+        version, address, length, width = self.key(cidr)
+        cidr = self.network(version, address, length)
+        with self.lock:
+            if cidr in self.pools:
+                return self.pools[cidr]
+            lists = {}
+            nodes = self.path(cidr)
+            if len(nodes) == length + 1:
+                stack = [(nodes[-1], address, length)]
+            else:
+                # Nothing is stored inside the supernet
+                stack = []
+                lists[length] = [address]
+            while stack:
+                node, prefix, depth = stack.pop()
+                for bit, child in enumerate(node.children):
+                    childPrefix = prefix | (bit << (width - depth - 1))
+                    if child is None:
+                        lists.setdefault(depth + 1, []).append(childPrefix)
+                    elif not child.stored:
+                        stack.append((child, childPrefix, depth + 1))
+            for blocks in lists.values():
+                blocks.sort()
+            self.pools[cidr] = lists
+            return lists
+
+    def pool(self, version, address, length):
+        '''
+        Return the managed supernet a prefix is inside of
+
+        :return: Supernet key and its free lists, None if it isn't managed
+        :rtype: tuple
+        '''
+
+        for cidr, lists in self.pools.items():
+            poolVersion, poolAddress, poolLength, width = self.key(cidr)
+            if poolVersion == version and poolLength < length and self.truncate(address, poolLength, width) == poolAddress:
+                return (poolLength, width), lists
+        return None
+
+    @staticmethod
+    def take(lists, length, address):
+        '''
+        Take a block off a free list
+
+        :return: Whether the block was free
+        :rtype: bool
+        '''
+
+        blocks = lists.get(length)
+        if not blocks:
+            return False
+        index = bisect.bisect_left(blocks, address)
+        if index == len(blocks) or blocks[index] != address:
+            return False
+        del blocks[index]
+        return True
+
+    def insert(self, cidr, data = None):
+        '''
+        Store a subnet and take its space off the free lists
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            super().insert(cidr, data)
+            found = self.pool(version, address, length)
+            if found is None:
+                return
+            (poolLength, width), lists = found
+
+            # Split the free block it was taken from
+            for blockLength in range(length, poolLength, -1):
+                if self.take(lists, blockLength, self.truncate(address, blockLength, width)):
+                    for depth in range(blockLength + 1, length + 1):
+                        buddy = self.truncate(address, depth, width) ^ (1 << (width - depth))
+                        bisect.insort(lists.setdefault(depth, []), buddy)
+                    return
+
+            # Otherwise it holds subnets already, and the free space between them
+            end = address + (1 << (width - length))
+            for blockLength, blocks in lists.items():
+                if blockLength > length:
+                    blocks[bisect.bisect_left(blocks, address):bisect.bisect_left(blocks, end)] = []
+
+    def remove(self, cidr):
+        '''
+        Remove a subnet and give its free space back, merging buddies
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            nodes = self.path(cidr)
+            found = self.pool(version, address, length)
+            super().remove(cidr)
+            if found is None:
+                self.pools.pop(self.network(version, address, length), None)
+                return
+            (poolLength, width), lists = found
+            if any(node.stored for node in nodes[poolLength + 1:length]):
+                # Inside a subnet that is still there
+                return
+
+            nodes = self.path(cidr)
+            if len(nodes) == length + 1:
+                # The subnets inside it stay, only the space between them is freed
+                stack = [(nodes[-1], address, length)]
+                while stack:
+                    node, prefix, depth = stack.pop()
+                    for bit, child in enumerate(node.children):
+                        childPrefix = prefix | (bit << (width - depth - 1))
+                        if child is None:
+                            bisect.insort(lists.setdefault(depth + 1, []), childPrefix)
+                        elif not child.stored:
+                            stack.append((child, childPrefix, depth + 1))
+                return
+
+            while length > poolLength + 1 and self.take(lists, length, address ^ (1 << (width - length))):
+                length -= 1
+                address = self.truncate(address, length, width)
+            bisect.insort(lists.setdefault(length, []), address)
+
+    def freeBlock(self, cidr, size, position = 'first'):
+        '''
+        Find the tightest-fitting free block of a size inside a supernet
+
+        Of the smallest free blocks that hold the size, the first or last
+        one is taken, and the block is carved from its start or end.
+
+        :param str cidr: CIDR of the supernet
+        :param int size: Prefix length of the block
+        :param str position: 'first' or 'last' free block
+        :return: CIDR of the free block, None if there is none
+        :rtype: str
+        '''
+
+        version, address, length, width = self.key(cidr)
+        if size <= length or size > width:
+            return None
+        with self.lock:
+            lists = self.manage(cidr)
+            for blockLength in range(size, length, -1):
+                blocks = lists.get(blockLength)
+                if not blocks:
+                    continue
+                if position == 'last':
+                    block = blocks[-1] + (1 << (width - blockLength)) - (1 << (width - size))
+                else:
+                    block = blocks[0]
+                return self.network(version, block, size)
+            return None
+
+    def fragmentation(self, cidr):
+        '''
+        Measure the fragmentation of the free space of a supernet
+
+        The fragmentation is the share of the free space outside the largest
+        free block: 0 when all free space is in one block, close to 1 when it
+        is scattered over many small ones.
+
+        :param str cidr: CIDR of the supernet
+        :return: Free addresses, largest free block, free blocks by size class and fragmentation
+        :rtype: dict
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            lists = self.manage(cidr)
+            blocks = {blockLength: len(addresses) for blockLength, addresses in sorted(lists.items()) if addresses}
+        free = sum(count << (width - blockLength) for blockLength, count in blocks.items())
+        largest = min(blocks) if blocks else None
+        return {
+            'free': free,
+            'largest': f"/{largest}" if largest is not None else None,
+            'blocks': {f"/{blockLength}": count for blockLength, count in blocks.items()},
+            'fragmentation': 1 - (1 << (width - largest)) / free if free else 0
+        }
+
+def getTrie(client, masterId, maxAge = MAXAGE):
+    '''
+    Return the best-fit trie of the section of a supernet, loaded once per process
+
+    :param IpamClient client: phpIPAM client
+    :param int masterId: Subnet ID of the regional supernet
+    :param float maxAge: Seconds before the section is loaded again
+    :return: Trie of the section
+    :rtype: BuddyTrie
+    '''
+
+    sectionId = str(client.getCached(f"subnets/{masterId}/")['data']['sectionId'])
+    with triesLock:
+        loaded, trie = tries.get(sectionId, (0, None))
+        if trie is None or time.time() - loaded > maxAge:
+            trie = ipamtrie.loadSection(client, sectionId, BuddyTrie())
+            tries[sectionId] = (time.time(), trie)
+        return trie
+
+def configuredTrie(config, client, masterId, trie = None):
+    '''
+    Return the trie to plan in as configured
+
+    :param dict config: Loaded config.json
+    :param IpamClient client: phpIPAM client
+    :param int masterId: Subnet ID of the regional supernet
+    :param PrefixTrie trie: Trie given by the caller, which takes precedence
+    :return: Trie, None to let phpIPAM find the free blocks
+    :rtype: PrefixTrie
+    '''
+
+    if trie is None and config.get('allocator') == 'bestfit':
+        trie = getTrie(client, masterId, config.get('allocatorMaxAge', MAXAGE))
+    return trie
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Show the free space and fragmentation of regional supernets.')
+    argp.add_argument('supernets', type=int, nargs='+', help='Subnet IDs of the regional supernets')
+    args = argp.parse_args()
+
+    client = ipamclient.getClient(loadConfig())
+    output = {'code': 200, 'success': 'true', 'data': {}}
+    for masterId in args.supernets:
+        trie = getTrie(client, masterId)
+        cidr = trie.ids.get(str(masterId))
+        if cidr is None:
+            output['code'] = 404
+            output['success'] = 'false'
+            continue
+        output['data'][str(masterId)] = dict(trie.fragmentation(cidr), subnet = cidr)
+    return output
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
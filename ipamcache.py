@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+""" Read-through TTL cache for read-mostly phpIPAM lookups.
+
+Nameserver sets and regional supernets almost never change, yet every
+render looks them up. This cache keeps the responses of such GET calls by
+endpoint, in memory and optionally in a JSON file shared between processes.
+
+An entry younger than the TTL of its endpoint is served as is. An entry that
+is older, but still within the stale window, is served immediately while a
+background thread fetches a fresh copy. Older entries are fetched before
+they are served. Only successful responses are stored.
+
+The following optional keys in config.json tune the cache:
+    - cacheTtl: TTL in seconds by endpoint prefix, e.g. {"tools/nameservers/": 3600}
+    - cacheStale: seconds an expired entry may still be served (default 86400)
+    - cacheFile: JSON file to share the cache between processes
+
+Run this script with a cache file, and optionally an endpoint prefix, to
+invalidate entries on disk.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import argparse
+import json
+import time
+import tempfile
+import threading
+
+TTLS = {
+    'tools/nameservers/': 3600,
+    'subnets/': 3600
+}
+TTL = 300 # TTL in seconds for endpoints not listed in TTLS
+STALE = 86400 # Seconds an expired entry may still be served while refreshing
+
+class TtlCache:
+    '''
+    Read-through cache of API responses by endpoint
+    '''
+
+    def __init__(self, fetch, ttls = None, stale = STALE, filename = None):
+        '''
+        Set up the cache and load the entries stored on disk
+
+        :param function fetch: Function fetching the response of an endpoint
+        :param dict ttls: TTL in seconds by endpoint prefix
+        :param int stale: Seconds an expired entry may still be served
+        :param str filename: JSON file to store the entries in
+        '''
+
+        self.fetch = fetch
+        self.ttls = dict(TTLS)
+        self.ttls.update(ttls or {})
+        self.stale = stale
+        self.filename = filename
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.entries.update(self.load())
+
+    def ttl(self, endpoint):
+        '''
+        Return the TTL of an endpoint, using its longest matching prefix
+
+        :param str endpoint: API endpoint
+        :return: TTL in seconds
+        :rtype: int
+        '''
+
+        prefixes = [prefix for prefix in self.ttls if endpoint.startswith(prefix)]
+        if not prefixes:
+            return TTL
+        return self.ttls[max(prefixes, key = len)]
+
+    def load(self):
+        '''
+        Read the entries stored on disk
+
+        :return: Entries by endpoint
+        :rtype: dict
+        '''
+
+        if self.filename is None:
+            return {}
+        try:
+            with open(self.filename) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        '''
+        Merge the entries into the file on disk, replacing it atomically
+        '''
+
+        if self.filename is None:
+            return
+        entries = self.load()
+        with self.lock:
+            for endpoint, entry in self.entries.items():
+                if endpoint not in entries or entries[endpoint]['time'] < entry['time']:
+                    entries[endpoint] = entry
+        self.write(entries)
+
+    def write(self, entries):
+        '''
+        Replace the file on disk atomically
+
+        :param dict entries: Entries by endpoint
+        '''
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with tempfile.NamedTemporaryFile('w', dir = directory, delete = False) as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(cache_file.name, self.filename)
+
+    def refresh(self, endpoint):
+        '''
+        Fetch an endpoint and store the response if it succeeded
+
+        :param str endpoint: API endpoint
+        :return: Server response
+        :rtype: dict
+        '''
+
+        try:
+            r = self.fetch(endpoint)
+            if r.get('code') == 200:
+                with self.lock:
+                    self.entries[endpoint] = {'time': time.time(), 'response': r}
+                self.save()
+            return r
+        finally:
+            with self.lock:
+                self.refreshing.discard(endpoint)
+
+    def get(self, endpoint):
+        '''
+        Return the response of an endpoint from the cache where possible
+
+        :param str endpoint: API endpoint
+        :return: Server response
+        :rtype: dict
+        '''
+
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            if entry is not None:
+                age = time.time() - entry['time']
+                if age < self.ttl(endpoint):
+                    return entry['response']
+                if age < self.ttl(endpoint) + self.stale:
+                    if endpoint not in self.refreshing:
+                        self.refreshing.add(endpoint)
+                        threading.Thread(target = self.refresh, args = (endpoint,), daemon = True).start()
+                    return entry['response']
+        return self.refresh(endpoint)
+
+    def invalidate(self, prefix = ''):
+        '''
+        Drop all entries whose endpoint starts with a prefix
+
+        :param str prefix: Endpoint prefix, all entries by default
+        '''
+
+        with self.lock:
+            for endpoint in [endpoint for endpoint in self.entries if endpoint.startswith(prefix)]:
+                del self.entries[endpoint]
+        if self.filename is not None:
+            entries = self.load()
+            self.write({endpoint: entry for endpoint, entry in entries.items() if not endpoint.startswith(prefix)})
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Invalidate cached phpIPAM lookups.')
+    argp.add_argument('cachefile', type=str, help='JSON cache file')
+    argp.add_argument('prefix', type=str, nargs='?', default='', help='Endpoint prefix to invalidate, e.g. tools/nameservers/')
+    args = argp.parse_args()
+
+    TtlCache(None, filename = args.cachefile).invalidate(args.prefix)
+
+if __name__ == "__main__":
+    main()
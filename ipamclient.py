@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+""" Shared HTTP client for the phpIPAM REST API.
+
+Every script talks to phpIPAM through a single requests.Session per server so
+that all calls of one run reuse the same keep-alive TCP/TLS connections
+instead of opening a new connection per call.
+
+The following optional keys in config.json tune the client:
+    - scheme: 'http' to talk to a test server such as ipamfake (default https)
+    - poolSize: maximum number of pooled connections (default 10)
+    - timeout: per-call timeout in seconds (default 30)
+    - retries: number of retries on connection errors (default 3)
+    - backoff: backoff factor between retries in seconds (default 0.5)
+
+Read-mostly lookups go through a TTL cache, see ipamcache for its keys.
+
+Only connection errors are retried for POST and PATCH calls, as those are not
+idempotent. GET and DELETE calls are retried on 502, 503 and 504 as well.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import json
+import time
+import threading
+import requests
+import ipamcache
+import ipamtrace
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOLSIZE = 10 # Default number of pooled connections
+TIMEOUT = 30 # Default per-call timeout in seconds
+RETRIES = 3 # Default number of retries on connection errors
+BACKOFF = 0.5 # Default backoff factor between retries
+
+clients = {}
+clientsLock = threading.Lock()
+
+class IpamClient:
+    '''
+    Pooled keep-alive connection to a phpIPAM server
+    '''
+
+    def __init__(self, config):
+        '''
+        Set up the session and its connection pool
+
+        :param dict config: Loaded config.json
+        '''
+
+        appId = config.get('appid', config.get('app'))
+        self.baseUrl = f"{config.get('scheme', 'https')}://{config['server']}/api/{appId}/"
+        self.timeout = config.get('timeout', TIMEOUT)
+
+        retries = config.get('retries', RETRIES)
+        retry = Retry(
+            total = retries,
+            connect = retries,
+            read = retries,
+            status = retries,
+            backoff_factor = config.get('backoff', BACKOFF),
+            status_forcelist = (502, 503, 504),
+            allowed_methods = frozenset(['GET', 'HEAD', 'DELETE', 'OPTIONS']),
+            raise_on_status = False
+        )
+        adapter = HTTPAdapter(
+            pool_connections = 1,
+            pool_maxsize = config.get('poolSize', POOLSIZE),
+            max_retries = retry,
+            pool_block = True
+        )
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'token': config['token'],
+            'Content-Type': 'application/json'
+        })
+
+        self.cache = ipamcache.TtlCache(
+            lambda endpoint: self.request("GET", endpoint).json(),
+            config.get('cacheTtl'),
+            config.get('cacheStale', ipamcache.STALE),
+            config.get('cacheFile')
+        )
+
+    def request(self, method, endpoint, data = '', headers = None, timeout = None, stream = False):
+        '''
+        Call an API endpoint over the pooled session
+
+        :param str method: HTTP method
+        :param str endpoint: Path relative to the API base, e.g. 'subnets/74/'
+        :param str data: Request body
+        :param dict headers: Headers to add to or override the session defaults
+        :param float timeout: Timeout in seconds, overrides the configured timeout
+        :param bool stream: Whether to leave the response body to be read in chunks
+        :return: Server response
+        :rtype: requests.Response
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
+        with ipamtrace.span('http', method = method, endpoint = endpoint) as span:
+            r = self.session.request(method, self.baseUrl + endpoint, data=data, headers=headers, timeout=timeout, stream=stream)
+            span['status'] = r.status_code
+            span['bytes'] = int(r.headers.get('Content-Length', 0)) if stream else len(r.content)
+        return r
+
+    def getCached(self, endpoint):
+        '''
+        Get a read-mostly endpoint through the TTL cache
+
+        :param str endpoint: Path relative to the API base, e.g. 'tools/nameservers/2/'
+        :return: Server response
+        :rtype: dict
+        '''
+
+        return self.cache.get(endpoint)
+
+    def getSubnet(self, subnetId):
+        '''
+        Get the details of a subnet
+
+        :param int subnetId: ID of the subnet
+        :return: Server response
+        :rtype: dict
+        '''
+
+        return self.request("GET", f"subnets/{subnetId}/").json()
+
+    def getChildren(self, subnetId):
+        '''
+        Get the subnets directly inside a subnet
+
+        :param int subnetId: ID of the subnet
+        :return: Server response
+        :rtype: dict
+        '''
+
+        return self.request("GET", f"subnets/{subnetId}/slaves/").json()
+
+    def getAddresses(self, subnetId):
+        '''
+        Get the addresses in a subnet
+
+        :param int subnetId: ID of the subnet
+        :return: Server response, code 404 if there are none
+        :rtype: dict
+        '''
+
+        return self.request("GET", f"subnets/{subnetId}/addresses/").json()
+
+    def findSubnet(self, masterId, size, position = 'first'):
+        '''
+        Find the first or last free subnet of a size in a supernet without creating it
+
+        :param int masterId: Subnet ID of the supernet
+        :param int size: Size of the subnet in bits (1 - 31)
+        :param str position: Where in the supernet to look
+        :return: Server response with the CIDR as data
+        :rtype: dict
+        '''
+
+        return self.request("GET", f"subnets/{masterId}/{position}_subnet/{size}/").json()
+
+    def requestSubnet(self, masterId, size, description, nameserverId = 0, allowRequests = 1, position = 'first'):
+        '''
+        Request the first or last free subnet of a size from a supernet
+
+        :param int masterId: Subnet ID of the supernet
+        :param int size: Size of the requested subnet in bits (1 - 31)
+        :param str description: Human-readable description of what this subnet is used for
+        :param int nameserverId: ID of nameserver set in phpIPAM
+        :param int allowRequests: Define whether IP addresses may be requested from this subnet
+        :param str position: Where in the supernet sits the requested subnet
+        :return: Server response
+        :rtype: dict
+        '''
+
+        payload = json.dumps({
+            'description': description,
+            'pingSubnet': '0',
+            'allowRequests': str(allowRequests),
+            'nameserverId': str(nameserverId)
+        })
+        return self.request("POST", f"subnets/{masterId}/{position}_subnet/{size}/", payload).json()
+
+    def createSubnet(self, masterId, sectionId, subnet, description, nameserverId = 0, allowRequests = 1):
+        '''
+        Create a subnet with an explicit CIDR in a supernet
+
+        :param int masterId: Subnet ID of the supernet
+        :param int sectionId: Section ID of the supernet
+        :param str subnet: CIDR of the subnet
+        :param str description: Human-readable description of what this subnet is used for
+        :param int nameserverId: ID of nameserver set in phpIPAM
+        :param int allowRequests: Define whether IP addresses may be requested from this subnet
+        :return: Server response
+        :rtype: dict
+        '''
+
+        network, mask = subnet.split('/')
+        payload = json.dumps({
+            'subnet': network,
+            'mask': mask,
+            'sectionId': str(sectionId),
+            'masterSubnetId': str(masterId),
+            'description': description,
+            'pingSubnet': '0',
+            'allowRequests': str(allowRequests),
+            'nameserverId': str(nameserverId)
+        })
+        return self.request("POST", "subnets/", payload).json()
+
+    def updateSubnet(self, subnetId, fields):
+        '''
+        Change fields of a subnet, e.g. its description
+
+        :param int subnetId: ID of the subnet
+        :param dict fields: Fields to change
+        :return: Server response
+        :rtype: dict
+        '''
+
+        return self.request("PATCH", f"subnets/{subnetId}/", json.dumps(fields)).json()
+
+    def deleteSubnet(self, subnetId):
+        '''
+        Delete a subnet
+
+        :param int subnetId: ID of the subnet
+        :return: Server response
+        :rtype: dict
+        '''
+
+        return self.request("DELETE", f"subnets/{subnetId}/").json()
+
+    def createAddress(self, subnetId, ip, description, isGateway = 0):
+        '''
+        Create a specific IP address in a subnet
+
+        :param int subnetId: ID of the subnet
+        :param str ip: IP address to create
+        :param str description: Human-readable description of what this address is used for
+        :param int isGateway: Define whether the device is a gateway (router)
+        :return: Server response
+        :rtype: dict
+        '''
+
+        payload = json.dumps({
+            'subnetId': str(subnetId),
+            'ip': ip,
+            'description': description,
+            'is_gateway': str(isGateway)
+        })
+        return self.request("POST", "addresses/", payload).json()
+
+    def close(self):
+        '''
+        Close all pooled connections
+        '''
+
+        self.session.close()
+
+class RateLimiter:
+    '''
+    Spread calls evenly so they stay under a rate ceiling across threads
+    '''
+
+    def __init__(self, rate):
+        '''
+        :param float rate: Maximum number of calls per second, 0 for no limit
+        '''
+
+        self.interval = 1.0 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Block until the next call is allowed
+        '''
+
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+def getClient(config):
+    '''
+    Return the shared client for the server in the configuration
+
+    :param dict config: Loaded config.json
+    :return: Client shared by every caller using the same server and app
+    :rtype: IpamClient
+    '''
+
+    key = (config['server'], config.get('appid', config.get('app')), config['token'])
+    with clientsLock:
+        if key not in clients:
+            clients[key] = IpamClient(config)
+        return clients[key]
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+""" Stand-in phpIPAM API server for offline testing and benchmarking.
+
+This server implements the phpIPAM REST endpoints the scripts in this
+repository use, on top of a real in-memory address space:
+    - GET subnets/{id}/, subnets/{id}/slaves/, subnets/{id}/addresses/,
+      sections/, sections/{id}/subnets/
+    - GET and POST subnets/{id}/first_subnet|last_subnet/{size}/
+    - POST subnets/, PATCH and DELETE subnets/{id}/
+    - POST addresses/, addresses/first_free/ and addresses/first_free/{id}/
+    - GET tools/nameservers/{id}/
+    - GET, POST, PATCH and DELETE tools/locations/
+
+Point a script at it with a config.json like:
+    {"scheme": "http", "server": "127.0.0.1:8080", "app": "fake", "token": "fake"}
+
+Subnets are answered with their address usage, like phpIPAM does.
+
+Every endpoint can be given a latency, a jitter and an error rate, in a JSON
+profile keyed by method and path with every numeric path segment written as
+{id}, e.g.:
+    {"default": {"latency": 0.02}, "POST subnets/": {"latency": 0.2, "jitter": 0.05, "errorRate": 0.1}}
+
+The address space starts with the regional supernets of the spoke and
+landing zone scripts, or with the subnets, nameservers and locations of a
+JSON seed file with the same structure as the state of FakeIpam.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import re
+import time
+import json
+import random
+import argparse
+import ipaddress
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+HOST = '127.0.0.1' # Default address to listen on
+PORT = 8080 # Default port to listen on
+
+SEED = {
+    'sections': [{'id': '1', 'name': 'AWS'}],
+    'subnets': [
+        {'id': '74', 'subnet': '10.74.0.0', 'mask': '16', 'sectionId': '1', 'masterSubnetId': '0', 'description': 'us-east-1'},
+        {'id': '75', 'subnet': '10.75.0.0', 'mask': '16', 'sectionId': '1', 'masterSubnetId': '0', 'description': 'eu-west-2'},
+        {'id': '76', 'subnet': '10.76.0.0', 'mask': '16', 'sectionId': '1', 'masterSubnetId': '0', 'description': 'eu-west-1'},
+        {'id': '106', 'subnet': '10.106.0.0', 'mask': '16', 'sectionId': '1', 'masterSubnetId': '0', 'description': 'ap-southeast-2'},
+        {'id': '918', 'subnet': '10.91.0.0', 'mask': '16', 'sectionId': '1', 'masterSubnetId': '0', 'description': 'eu-central-1'}
+    ],
+    'nameservers': [
+        {'id': '2', 'name': 'Americas', 'namesrv1': '10.74.0.2;10.106.0.2', 'description': ''},
+        {'id': '3', 'name': 'Europe', 'namesrv1': '10.76.0.2;10.75.0.2', 'description': ''}
+    ],
+    'locations': []
+}
+
+class ApiError(Exception):
+    '''
+    Error answered to the client with a code and a message
+    '''
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+class FakeIpam:
+    '''
+    In-memory phpIPAM state and the API endpoints working on it
+    '''
+
+    def __init__(self, seed = None):
+        '''
+        :param dict seed: Sections, subnets, nameservers and locations to start with
+        '''
+
+        seed = json.loads(json.dumps(seed or SEED))
+        self.sections = {str(section['id']): section for section in seed.get('sections', [])}
+        self.subnets = {str(subnet['id']): subnet for subnet in seed.get('subnets', [])}
+        self.addresses = {}
+        self.nameservers = {str(nameserver['id']): nameserver for nameserver in seed.get('nameservers', [])}
+        self.locations = {str(location['id']): location for location in seed.get('locations', [])}
+        self.nextId = max([int(key) for table in (self.subnets, self.locations) for key in table] + [1000]) + 1
+        self.lock = threading.Lock()
+
+    def newId(self):
+        self.nextId += 1
+        return str(self.nextId - 1)
+
+    @staticmethod
+    def network(subnet):
+        return ipaddress.ip_network(f"{subnet['subnet']}/{subnet['mask']}")
+
+    def subnet(self, subnetId):
+        if subnetId not in self.subnets:
+            raise ApiError(404, 'Subnet does not exist')
+        return self.subnets[subnetId]
+
+    def slaves(self, subnetId):
+        return [subnet for subnet in self.subnets.values() if str(subnet['masterSubnetId']) == subnetId]
+
+    def withUsage(self, subnet):
+        '''
+        Add the address usage phpIPAM reports with a subnet
+        '''
+
+        used = sum(1 for address in self.addresses.values() if address['subnetId'] == subnet['id'])
+        if str(subnet.get('isFolder', 0)) == '1' or not subnet.get('subnet'):
+            return dict(subnet)
+        maxhosts = max(self.network(subnet).num_addresses - 2, 0)
+        return dict(subnet, usage = {'used': str(used), 'maxhosts': str(maxhosts), 'freehosts': str(max(maxhosts - used, 0))})
+
+    def freeSubnet(self, masterId, size, position):
+        '''
+        Find the first or last free block of a size in a subnet
+        '''
+
+        master = self.network(self.subnet(masterId))
+        size = int(size)
+        if size <= master.prefixlen or size > master.max_prefixlen:
+            raise ApiError(400, 'Invalid mask')
+        taken = [self.network(subnet) for subnet in self.slaves(masterId)]
+        candidates = master.subnets(new_prefix = size)
+        if position == 'last':
+            candidates = reversed(list(candidates))
+        for candidate in candidates:
+            if not any(candidate.overlaps(network) for network in taken):
+                return str(candidate)
+        raise ApiError(404, 'No subnets found')
+
+    def addSubnet(self, data):
+        '''
+        Create a subnet after the same checks phpIPAM does
+        '''
+
+        if 'subnet' not in data or 'mask' not in data:
+            raise ApiError(400, 'Subnet and mask are required')
+        masterId = str(data.get('masterSubnetId', '0'))
+        network = ipaddress.ip_network(f"{data['subnet']}/{data['mask']}")
+        if masterId != '0':
+            master = self.subnet(masterId)
+            if not network.subnet_of(self.network(master)):
+                raise ApiError(409, 'Subnet is not within the master subnet')
+        for sibling in self.slaves(masterId):
+            if self.network(sibling).overlaps(network):
+                raise ApiError(409, f"Subnet overlaps with {sibling['subnet']}/{sibling['mask']} ({sibling.get('description', '')})")
+
+        subnet = {
+            'id': self.newId(),
+            'subnet': str(network.network_address),
+            'mask': str(network.prefixlen),
+            'sectionId': str(data.get('sectionId', '1')),
+            'masterSubnetId': masterId,
+            'description': data.get('description', ''),
+            'nameserverId': str(data.get('nameserverId', '0')),
+            'allowRequests': str(data.get('allowRequests', '0')),
+            'isFolder': '0',
+            'editDate': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self.subnets[subnet['id']] = subnet
+        return subnet
+
+    def deleteSubnet(self, subnetId):
+        self.subnet(subnetId)
+        for slave in self.slaves(subnetId):
+            self.deleteSubnet(slave['id'])
+        for addressId in [key for key, address in self.addresses.items() if address['subnetId'] == subnetId]:
+            del self.addresses[addressId]
+        del self.subnets[subnetId]
+
+    def addAddress(self, subnetId, data):
+        subnet = self.subnet(subnetId)
+        network = self.network(subnet)
+        taken = {address['ip'] for address in self.addresses.values() if address['subnetId'] == subnetId}
+        if data.get('ip'):
+            ip = data['ip']
+            if ipaddress.ip_address(ip) not in network:
+                raise ApiError(400, 'IP address not in selected subnet')
+            if ip in taken:
+                raise ApiError(409, 'IP address already exists')
+        else:
+            ip = next((str(host) for host in network.hosts() if str(host) not in taken), None)
+            if ip is None:
+                raise ApiError(404, 'No free addresses found')
+        address = {
+            'id': self.newId(),
+            'subnetId': subnetId,
+            'ip': ip,
+            'description': data.get('description', ''),
+            'is_gateway': str(data.get('is_gateway', '0')),
+            'editDate': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self.addresses[address['id']] = address
+        return address
+
+    def handle(self, method, parts, data):
+        '''
+        Answer one API call
+
+        :param str method: HTTP method
+        :param list parts: Path segments after the app ID
+        :param dict data: Request body
+        :return: HTTP status and response object
+        :rtype: tuple
+        '''
+
+        with self.lock:
+            try:
+                code, response = self.route(method, parts, data)
+            except ApiError as e:
+                code, response = e.code, {'message': e.message}
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                code, response = 400, {'message': f"Invalid request: {e}"}
+        response = dict({'code': code, 'success': code < 400}, **response)
+        return code, response
+
+    def route(self, method, parts, data):
+        controller = parts[0] if parts else ''
+        if controller == 'subnets':
+            return self.routeSubnets(method, parts[1:], data)
+        if controller == 'addresses':
+            if method == 'POST' and parts[1:2] == ['first_free']:
+                # The subnet ID is either in the path or, like the baseline scripts send it, in the body
+                subnetId = parts[2] if len(parts) > 2 else str(data['subnetId'])
+                address = self.addAddress(subnetId, dict(data, ip = None))
+                return 201, {'message': 'Address created', 'id': address['id'], 'data': address['ip']}
+            if method == 'POST' and len(parts) == 1:
+                address = self.addAddress(str(data['subnetId']), data)
+                return 201, {'message': 'Address created', 'id': address['id']}
+        if controller == 'sections' and method == 'GET' and len(parts) == 1:
+            return 200, {'data': list(self.sections.values())}
+        if controller == 'sections' and method == 'GET' and parts[2:3] == ['subnets']:
+            subnets = [self.withUsage(subnet) for subnet in self.subnets.values() if subnet['sectionId'] == parts[1]]
+            return 200, {'data': subnets}
+        if controller == 'tools' and parts[1:2] == ['nameservers'] and method == 'GET':
+            if len(parts) > 2:
+                if parts[2] not in self.nameservers:
+                    raise ApiError(404, 'Nameserver does not exist')
+                return 200, {'data': self.nameservers[parts[2]]}
+            return 200, {'data': list(self.nameservers.values())}
+        if controller == 'tools' and parts[1:2] == ['locations']:
+            return self.routeLocations(method, parts[2:], data)
+        raise ApiError(400, 'Invalid request')
+
+    def routeSubnets(self, method, parts, data):
+        if not parts:
+            if method == 'POST':
+                subnet = self.addSubnet(data)
+                return 201, {'message': 'Subnet created', 'id': subnet['id']}
+            raise ApiError(400, 'Invalid request')
+
+        subnetId = parts[0]
+        action = parts[1] if len(parts) > 1 else ''
+        if action == '':
+            if method == 'GET':
+                return 200, {'data': self.withUsage(self.subnet(subnetId))}
+            if method == 'PATCH':
+                subnet = self.subnet(subnetId)
+                for key in ('description', 'nameserverId', 'allowRequests'):
+                    if key in data:
+                        subnet[key] = str(data[key])
+                subnet['editDate'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                return 200, {'message': 'Subnet updated'}
+            if method == 'DELETE':
+                self.deleteSubnet(subnetId)
+                return 200, {'message': 'Subnet deleted'}
+        if action == 'addresses' and method == 'GET':
+            self.subnet(subnetId)
+            addresses = [address for address in self.addresses.values() if address['subnetId'] == subnetId]
+            if not addresses:
+                raise ApiError(404, 'No addresses found')
+            return 200, {'data': addresses}
+        if action == 'slaves' and method == 'GET':
+            slaves = self.slaves(self.subnet(subnetId)['id'])
+            if not slaves:
+                raise ApiError(404, 'No slaves')
+            return 200, {'data': slaves}
+        if action in ('first_subnet', 'last_subnet'):
+            if len(parts) < 3:
+                raise ApiError(400, 'Subnet mask is mandatory')
+            cidr = self.freeSubnet(subnetId, parts[2], action.split('_')[0])
+            if method == 'GET':
+                return 200, {'data': cidr}
+            if method == 'POST':
+                network, mask = cidr.split('/')
+                subnet = self.addSubnet(dict(data, subnet = network, mask = mask, masterSubnetId = subnetId,
+                    sectionId = self.subnets[subnetId]['sectionId']))
+                return 201, {'message': 'Subnet created', 'id': subnet['id'], 'data': cidr}
+        raise ApiError(400, 'Invalid request')
+
+    def routeLocations(self, method, parts, data):
+        if not parts:
+            if method == 'GET':
+                return 200, {'data': list(self.locations.values())}
+            if method == 'POST':
+                if not data.get('name'):
+                    raise ApiError(400, 'Name is mandatory')
+                location = dict(data, id = self.newId(), editDate = time.strftime('%Y-%m-%d %H:%M:%S'))
+                self.locations[location['id']] = location
+                return 201, {'message': 'Location created', 'id': location['id']}
+            raise ApiError(400, 'Invalid request')
+
+        if parts[0] not in self.locations:
+            raise ApiError(404, 'Location does not exist')
+        location = self.locations[parts[0]]
+        if method == 'GET':
+            return 200, {'data': location}
+        if method == 'PATCH':
+            location.update({key: value for key, value in data.items() if key != 'id'})
+            location['editDate'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            return 200, {'message': 'Location updated'}
+        if method == 'DELETE':
+            del self.locations[parts[0]]
+            return 200, {'message': 'Location deleted'}
+        raise ApiError(400, 'Invalid request')
+
+class Profile:
+    '''
+    Latency, jitter and error rate per endpoint
+    '''
+
+    def __init__(self, settings = None):
+        '''
+        :param dict settings: Settings by endpoint key, and under 'default'
+        '''
+
+        self.settings = settings or {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(method, parts):
+        '''
+        Return the endpoint key of a call, e.g. 'POST subnets/{id}/first_subnet/{id}/'
+        '''
+
+        return method + ' ' + ''.join(('{id}' if re.fullmatch(r'\d+', part) else part) + '/' for part in parts)
+
+    def apply(self, key):
+        '''
+        Delay a call and decide whether it fails
+
+        :param str key: Endpoint key
+        :return: Whether to answer with an injected error
+        :rtype: bool
+        '''
+
+        settings = dict(self.settings.get('default', {}))
+        settings.update(self.settings.get(key, {}))
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+        delay = settings.get('latency', 0) + random.uniform(-1, 1) * settings.get('jitter', 0)
+        if delay > 0:
+            time.sleep(delay)
+        return random.random() < settings.get('errorRate', 0)
+
+class FakeHandler(BaseHTTPRequestHandler):
+    '''
+    Parse a phpIPAM API call and answer it from the fake state
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        # Tolerate clients hanging up on an injected delay
+        try:
+            super().handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def answer(self, code, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+
+        if parts[:1] != ['api'] or len(parts) < 2:
+            return self.answer(400, {'code': 400, 'success': False, 'message': 'Invalid application id'})
+        if self.server.token is not None and self.headers.get('token') != self.server.token:
+            return self.answer(401, {'code': 401, 'success': False, 'message': 'Please authenticate'})
+
+        parts = parts[2:]
+        if self.server.profile.apply(self.server.profile.key(method, parts)):
+            code = self.server.errorCode
+            return self.answer(code, {'code': code, 'success': False, 'message': 'Injected failure'})
+
+        if body.lstrip().startswith('{'):
+            data = json.loads(body)
+        else:
+            data = {key: values[-1] for key, values in urllib.parse.parse_qs(body.lstrip('&'), keep_blank_values = True).items()}
+        start = time.time()
+        code, response = self.server.fake.handle(method, parts, data)
+        response['time'] = time.time() - start
+        self.answer(code, response)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serve every connection in its own thread, keep-alive included
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, fake = None, profile = None, token = None, errorCode = 500, verbose = False):
+        '''
+        :param tuple address: Host and port to listen on
+        :param FakeIpam fake: State to serve
+        :param Profile profile: Latency and failure injection
+        :param str token: Token the clients must send, None to accept any
+        :param int errorCode: HTTP code of injected failures
+        :param bool verbose: Whether to log every request
+        '''
+
+        super().__init__(address, FakeHandler)
+        self.fake = fake or FakeIpam()
+        self.profile = profile or Profile()
+        self.token = token
+        self.errorCode = errorCode
+        self.verbose = verbose
+
+    def start(self):
+        '''
+        Serve in a background thread, e.g. from a benchmark
+
+        :return: Port the server listens on
+        :rtype: int
+        '''
+
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self.server_address[1]
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Serve a stand-in phpIPAM API with latency and failure injection.')
+    argp.add_argument('--host', type=str, default=HOST, help='Address to listen on')
+    argp.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    argp.add_argument('--seed', type=str, default=None, help='JSON file with sections, subnets, nameservers and locations')
+    argp.add_argument('--profile', type=str, default=None, help='JSON file with latency, jitter and errorRate per endpoint')
+    argp.add_argument('--latency', type=float, default=0, help='Default latency in seconds')
+    argp.add_argument('--jitter', type=float, default=0, help='Default jitter in seconds')
+    argp.add_argument('--error-rate', type=float, default=0, help='Default share of calls that fail')
+    argp.add_argument('--error-code', type=int, default=500, help='HTTP code of injected failures')
+    argp.add_argument('--token', type=str, default=None, help='Token the clients must send')
+    argp.add_argument('--verbose', action='store_true', help='Log every request')
+    args = argp.parse_args()
+
+    seed = None
+    if args.seed:
+        with open(args.seed) as seed_file:
+            seed = json.load(seed_file)
+    settings = {}
+    if args.profile:
+        with open(args.profile) as profile_file:
+            settings = json.load(profile_file)
+    settings.setdefault('default', {'latency': args.latency, 'jitter': args.jitter, 'errorRate': args.error_rate})
+
+    server = FakeServer((args.host, args.port), FakeIpam(seed), Profile(settings), args.token, args.error_code, args.verbose)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+""" Write-ahead journal of provisioning runs.
+
+Every provisioning step is written to a journal file before it is sent to
+phpIPAM and again with its result, including the returned ids, once it
+succeeded. A run that failed halfway can then be resumed by its run id:
+the steps that already succeeded are taken from the journal and only the
+missing calls are made. A step that was started but never finished is
+reported as interrupted, as it may have left an object behind.
+
+The subnets created by a run can also be rolled back: they are deleted in
+parallel, the deepest subnets first, and their reserved addresses with them.
+
+A journal starts with the arguments of its run, e.g. region, account and
+template, and a run is only resumed with the same arguments. The journal of
+a run that succeeded, or that was rolled back without leaving a subnet
+behind, is deleted, so only the runs that failed halfway are kept to resume
+or roll back.
+
+Journals are kept in the directory set by the optional 'journalPath' key in
+config.json, or in a directory under the system temporary directory
+otherwise.
+
+Run this script with a run id and --rollback to delete what a run created.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import sys
+import argparse
+import json
+import time
+import uuid
+import tempfile
+import threading
+import ipamclient
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 4 # Default number of parallel deletes during a rollback
+
+class Journal:
+    '''
+    Append-only journal of the steps of one run
+    '''
+
+    def __init__(self, directory, runId = None, prefix = '', lock = None):
+        '''
+        Open the journal of a new or an earlier run
+
+        :param str directory: Directory holding the journals
+        :param str runId: ID of an earlier run to resume, None for a new run
+        :param str prefix: Prefix for the step names, to keep several layouts apart
+        :param threading.Lock lock: Lock shared with the other views on the same file
+        '''
+
+        if runId is None:
+            runId = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        self.directory = directory
+        self.runId = runId
+        self.prefix = prefix
+        self.filename = os.path.join(directory, runId + '.jsonl')
+        self.lock = lock or threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def view(self, prefix):
+        '''
+        Return a view on the same journal with its own step names
+
+        :param str prefix: Prefix for the step names
+        :return: Journal sharing the file of this one
+        :rtype: Journal
+        '''
+
+        return Journal(self.directory, self.runId, self.prefix + prefix + ':', self.lock)
+
+    def write(self, name, state, result = None):
+        '''
+        Append a record and flush it to disk before carrying on
+
+        :param str name: Step name
+        :param str state: 'header', 'start', 'done', 'failed' or 'rolledback'
+        :param result: Result of the step
+        '''
+
+        record = {'time': time.time(), 'step': self.prefix + name, 'state': state, 'result': result}
+        with self.lock:
+            with open(self.filename, 'a') as journal_file:
+                journal_file.write(json.dumps(record) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def records(self):
+        '''
+        Read the records of this view
+
+        :return: Generator of step name, state and result
+        :rtype: generator
+        '''
+
+        try:
+            with open(self.filename) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash
+                        continue
+                    if record['step'].startswith(self.prefix):
+                        yield record['step'][len(self.prefix):], record['state'], record['result']
+        except IOError:
+            return
+
+    def state(self):
+        '''
+        Replay the journal
+
+        :return: Results of the succeeded steps and names of the interrupted ones
+        :rtype: tuple
+        '''
+
+        results = {}
+        started = set()
+        for name, state, result in self.records():
+            if state == 'start':
+                started.add(name)
+            elif state == 'done':
+                results[name] = result
+                started.discard(name)
+            elif state == 'failed':
+                results.pop(name, None)
+                started.discard(name)
+            elif state == 'rolledback':
+                # The subnet went with everything inside it
+                for step in [step for step in results if step == name or step.startswith(name + '/')]:
+                    del results[step]
+        return results, sorted(started)
+
+    def begin(self, header):
+        '''
+        Record the arguments of a new run, or check them against those of the resumed run
+
+        :param dict header: Arguments of the run, e.g. region, account and template
+        :raises ValueError: If the journal belongs to a run with other arguments
+        '''
+
+        header = json.loads(json.dumps(header))
+        found = next((result for name, state, result in self.records() if state == 'header'), None)
+        if found is None:
+            self.write('', 'header', header)
+        elif found != header:
+            raise ValueError(f"Run {self.runId} was started with {json.dumps(found)}, not {json.dumps(header)}.")
+
+    def finish(self, succeeded):
+        '''
+        Delete the journal when its run succeeded, never started a step or was rolled back completely
+
+        :param bool succeeded: Whether the run succeeded
+        '''
+
+        records = list(self.records())
+        if not succeeded and any(state == 'start' for name, state, result in records):
+            results, interrupted = self.state()
+            rolledBack = any(state == 'rolledback' for name, state, result in records)
+            if not rolledBack or createdSubnets(results) or interrupted:
+                # Kept to resume or roll back the run
+                return
+        with self.lock:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+    def run(self, name, function, results):
+        '''
+        Run a step, journaling it before and after
+
+        :param str name: Step name
+        :param function function: Step function, called with the results of its dependencies
+        :param dict results: Results of the dependencies
+        :return: Result of the step
+        '''
+
+        self.write(name, 'start')
+        try:
+            result = function(results)
+        except Exception as e:
+            self.write(name, 'failed', str(e))
+            raise
+        self.write(name, 'done', result)
+        return result
+
+def getJournal(config, runId = None, header = None):
+    '''
+    Open the journal of a new or an earlier run in the configured directory
+
+    :param dict config: Loaded config.json
+    :param str runId: ID of an earlier run to resume, None for a new run
+    :param dict header: Arguments of the run, checked against those of the earlier run, see Journal.begin
+    :return: Journal
+    :rtype: Journal
+    :raises IOError: If the earlier run can't be found
+    :raises ValueError: If the earlier run was started with other arguments
+    '''
+
+    directory = config.get('journalPath', os.path.join(tempfile.gettempdir(), 'phpipam-journal'))
+    journal = Journal(directory, runId)
+    if runId is not None and not os.path.exists(journal.filename):
+        raise IOError(f"Can't find run {runId}.")
+    if header is not None:
+        journal.begin(header)
+    return journal
+
+def rollback(client, journal, subnets, workers = WORKERS):
+    '''
+    Delete created subnets in parallel, the deepest subnets first
+
+    :param IpamClient client: phpIPAM client
+    :param Journal journal: Journal to record the deletes in, or None
+    :param dict subnets: Results of the subnet steps by step name
+    :param int workers: Maximum number of parallel deletes
+    :return: Names of the deleted steps and error messages by failed step name
+    :rtype: dict
+    '''
+
+    def delete(name):
+        r = client.deleteSubnet(subnets[name]['id'])
+        if r.get('code') == 200 and journal is not None:
+            journal.write(name, 'rolledback', subnets[name])
+        return r
+
+    output = {'deleted': [], 'errors': {}}
+    levels = sorted({name.count('/') for name in subnets}, reverse = True)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for level in levels:
+            names = [name for name in subnets if name.count('/') == level]
+            futures = {name: executor.submit(delete, name) for name in names}
+            for name, future in futures.items():
+                try:
+                    r = future.result()
+                except Exception as e:
+                    r = {'message': str(e)}
+                if r.get('code') == 200:
+                    output['deleted'].append(name)
+                else:
+                    output['errors'][name] = r.get('message', r.get('code'))
+    return output
+
+def createdSubnets(results):
+    '''
+    Pick the created subnets out of the results of a run
+
+    :param dict results: Results by step name
+    :return: Results of the subnet steps by step name
+    :rtype: dict
+    '''
+
+    return {name: result for name, result in results.items()
+        if isinstance(result, dict) and 'id' in result and 'subnet' in result}
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Show or roll back a journaled provisioning run.')
+    argp.add_argument('run', type=str, help='Run ID')
+    argp.add_argument('--rollback', action='store_true', help='Delete the subnets the run created')
+    argp.add_argument('--workers', type=int, default=WORKERS, help='Number of parallel deletes')
+    args = argp.parse_args()
+
+    config = loadConfig()
+    journal = getJournal(config, args.run)
+    results, interrupted = journal.state()
+    output = {'code': 200, 'success': 'true', 'run': journal.runId, 'data': createdSubnets(results), 'interrupted': interrupted}
+    if args.rollback:
+        output['rollback'] = rollback(ipamclient.getClient(config), journal, output['data'], args.workers)
+        if output['rollback']['errors']:
+            output['code'] = 500
+            output['success'] = 'false'
+    return output
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+""" Advisory locks around allocations in a regional supernet.
+
+Processes allocating from the same supernet take the same named lock for the
+short moment between finding a free block and creating it. Allocations in
+different supernets don't wait for each other.
+
+The backend is chosen with the optional 'lockBackend' key in config.json:
+    - file: an flock()ed file per lock in the 'lockPath' directory (default)
+    - sqlite: a row per lock in the SQLite database at 'lockPath'
+    - none: no locking, e.g. when a single process does all allocations
+
+'lockTimeout' sets how many seconds to wait for a lock (default 60).
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import time
+import uuid
+import fcntl
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+TIMEOUT = 60 # Default seconds to wait for a lock
+LEASE = 300 # Seconds after which an SQLite lock of a crashed process expires
+POLL = 0.05 # Seconds between attempts to take a lock
+
+class LockError(Exception):
+    '''
+    A lock could not be taken in time
+    '''
+
+class NullLocks:
+    '''
+    Locks that are always free
+    '''
+
+    @contextmanager
+    def lock(self, name):
+        yield
+
+class FileLocks:
+    '''
+    Locks as flock()ed files in a directory
+    '''
+
+    def __init__(self, directory, timeout = TIMEOUT):
+        '''
+        :param str directory: Directory for the lock files
+        :param float timeout: Seconds to wait for a lock
+        '''
+
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok = True)
+
+    @contextmanager
+    def lock(self, name):
+        '''
+        Hold a lock for the duration of a with block
+
+        :param str name: Name of the lock
+        :raises LockError: If the lock isn't free in time
+        '''
+
+        deadline = time.monotonic() + self.timeout
+        with open(os.path.join(self.directory, name + '.lock'), 'w') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise LockError(f"Timed out waiting for lock {name}.")
+                    time.sleep(POLL)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class SqliteLocks:
+    '''
+    Locks as rows in an SQLite database, expiring when their holder crashed
+    '''
+
+    def __init__(self, filename, timeout = TIMEOUT, lease = LEASE):
+        '''
+        :param str filename: SQLite database file
+        :param float timeout: Seconds to wait for a lock
+        :param float lease: Seconds after which a held lock expires
+        '''
+
+        self.filename = filename
+        self.timeout = timeout
+        self.lease = lease
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def connect(self):
+        return sqlite3.connect(self.filename, timeout = self.timeout, isolation_level = None)
+
+    @contextmanager
+    def lock(self, name):
+        '''
+        Hold a lock for the duration of a with block
+
+        :param str name: Name of the lock
+        :raises LockError: If the lock isn't free in time
+        '''
+
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        db = self.connect()
+        try:
+            while True:
+                try:
+                    db.execute('BEGIN IMMEDIATE')
+                    db.execute('DELETE FROM locks WHERE name = ? AND expires < ?', (name, time.time()))
+                    taken = db.execute('INSERT OR IGNORE INTO locks VALUES (?, ?, ?)',
+                        (name, owner, time.time() + self.lease)).rowcount
+                    db.execute('COMMIT')
+                except sqlite3.OperationalError as e:
+                    # The database stayed locked past the busy timeout
+                    if db.in_transaction:
+                        db.execute('ROLLBACK')
+                    raise LockError(f"Timed out waiting for lock {name}: {e}.")
+                if taken:
+                    break
+                if time.monotonic() > deadline:
+                    raise LockError(f"Timed out waiting for lock {name}.")
+                time.sleep(POLL)
+            try:
+                yield
+            finally:
+                try:
+                    db.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, owner))
+                except sqlite3.OperationalError:
+                    # The work under the lock is done, the row expires after the lease
+                    pass
+        finally:
+            db.close()
+
+def getLocks(config):
+    '''
+    Return the lock backend set in the configuration
+
+    :param dict config: Loaded config.json
+    :return: Lock backend
+    '''
+
+    backend = config.get('lockBackend', 'file')
+    timeout = config.get('lockTimeout', TIMEOUT)
+    if backend == 'none':
+        return NullLocks()
+    if backend == 'sqlite':
+        return SqliteLocks(config.get('lockPath', os.path.join(tempfile.gettempdir(), 'phpipam-locks.db')), timeout)
+    if backend == 'file':
+        return FileLocks(config.get('lockPath', os.path.join(tempfile.gettempdir(), 'phpipam-locks')), timeout)
+    raise ValueError(f"Unknown lock backend {backend}.")
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" Overlap checks between phpIPAM and CIDR lists kept elsewhere.
+
+Ranges are read from phpIPAM sections and from local files, either a plain
+list with one CIDR per line, optionally followed by a label, or a JSON dump
+of AWS describe-vpcs. All overlaps between ranges of different sources are
+found with one sweep over the ranges sorted by their first address, so a
+check takes O(n log n) plus the number of overlaps found.
+
+The ranges of the local files can also be saved as an index. The
+provisioning scripts load the index set by the optional 'overlapIndex' key
+in config.json once and check every planned VPC against it before it is
+created, with a few lookups per check.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import bisect
+import heapq
+import ipaddress
+import json
+import threading
+
+indexes = {}
+indexesLock = threading.Lock()
+
+def makeRange(cidr, source, label = ''):
+    '''
+    Turn a CIDR into an integer range
+
+    :param str cidr: CIDR
+    :param str source: Where the CIDR comes from, e.g. 'phpipam' or a file name
+    :param str label: Description of the CIDR
+    :return: Range with version, start, end, prefix length, cidr, source and label
+    :rtype: dict
+    '''
+
+    network = ipaddress.ip_network(cidr, strict = False)
+    return {
+        'version': network.version,
+        'start': int(network.network_address),
+        'end': int(network.broadcast_address),
+        'length': network.prefixlen,
+        'cidr': str(network),
+        'source': source,
+        'label': label
+    }
+
+def loadFile(filename):
+    '''
+    Read the ranges of a CIDR list or an AWS describe-vpcs dump
+
+    :param str filename: File name
+    :return: Ranges
+    :rtype: list
+    :raises ValueError: If a line or a VPC holds no valid CIDR
+    '''
+
+    ranges = []
+    with open(filename, 'r', encoding='utf-8-sig') as cidr_file:
+        if filename.endswith('.json'):
+            for vpc in json.load(cidr_file).get('Vpcs', []):
+                label = next((tag['Value'] for tag in vpc.get('Tags', []) if tag.get('Key') == 'Name'), vpc.get('VpcId', ''))
+                cidrs = {association['CidrBlock'] for association in vpc.get('CidrBlockAssociationSet', [])}
+                cidrs.update(association['Ipv6CidrBlock'] for association in vpc.get('Ipv6CidrBlockAssociationSet', []))
+                if vpc.get('CidrBlock'):
+                    cidrs.add(vpc['CidrBlock'])
+                ranges.extend(makeRange(cidr, filename, label) for cidr in sorted(cidrs))
+            return ranges
+
+        for line in cidr_file:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            cidr, _, label = line.partition(' ')
+            ranges.append(makeRange(cidr, filename, label.strip()))
+    return ranges
+
+def loadPhpipam(client, sectionIds = None):
+    '''
+    Read the ranges of the subnets in phpIPAM
+
+    :param IpamClient client: phpIPAM client
+    :param list sectionIds: IDs of the sections to read, all sections by default
+    :return: Ranges, with the subnet ID as 'id'
+    :rtype: list
+    '''
+
+    if sectionIds is None:
+        sectionIds = [section['id'] for section in client.request('GET', 'sections/').json().get('data') or []]
+    ranges = []
+    for sectionId in sectionIds:
+        for subnet in client.request('GET', f"sections/{sectionId}/subnets/").json().get('data') or []:
+            if str(subnet.get('isFolder', 0)) == '1' or not subnet.get('subnet'):
+                continue
+            found = makeRange(f"{subnet['subnet']}/{subnet['mask']}", 'phpipam', subnet.get('description') or '')
+            found['id'] = str(subnet['id'])
+            ranges.append(found)
+    return ranges
+
+def relation(first, second):
+    '''
+    Describe how two overlapping ranges relate
+
+    :return: 'equal', 'contains' or 'inside'
+    :rtype: str
+    '''
+
+    if (first['start'], first['end']) == (second['start'], second['end']):
+        return 'equal'
+    if first['start'] <= second['start'] and second['end'] <= first['end']:
+        return 'contains'
+    return 'inside'
+
+def findOverlaps(ranges):
+    '''
+    Find all overlaps between ranges of different sources with a sweep
+
+    The ranges are visited by first address, keeping the ranges that are
+    still open in a heap by last address. Every visited range overlaps
+    exactly the open ranges that haven't ended before its first address.
+
+    :param list ranges: Ranges, see makeRange
+    :return: Overlapping pairs with their relation, the first range being the earlier one
+    :rtype: list
+    '''
+
+    overlaps = []
+    ordered = sorted(ranges, key = lambda found: (found['version'], found['start'], -found['end']))
+    active = []
+    version = None
+    for number, found in enumerate(ordered):
+        if found['version'] != version:
+            version = found['version']
+            active = []
+        while active and active[0][0] < found['start']:
+            heapq.heappop(active)
+        for end, index in active:
+            other = ordered[index]
+            if other['source'] != found['source']:
+                overlaps.append({'range': other, 'overlaps': found, 'relation': relation(other, found)})
+        heapq.heappush(active, (found['end'], number))
+    return overlaps
+
+class OverlapIndex:
+    '''
+    Ranges indexed for checking single CIDRs against them
+    '''
+
+    def __init__(self, ranges):
+        '''
+        :param list ranges: Ranges, see makeRange
+        '''
+
+        self.ranges = sorted(ranges, key = lambda found: (found['version'], found['start'], -found['end']))
+        self.keys = [(found['version'], found['start']) for found in self.ranges]
+        # Ranges by version, first address and prefix length, to find the ones containing a CIDR
+        self.exact = {}
+        for found in self.ranges:
+            self.exact.setdefault((found['version'], found['start'], found['length']), []).append(found)
+
+    def overlaps(self, cidr):
+        '''
+        Return the ranges overlapping a CIDR
+
+        Two CIDRs overlap only when one contains the other, so these are the
+        ranges inside the CIDR, which are adjacent in first address order,
+        and the ranges on the path from the top of the address space down to
+        the CIDR.
+
+        :param str cidr: CIDR
+        :return: Overlapping ranges
+        :rtype: list
+        '''
+
+        query = makeRange(cidr, '')
+        width = 32 if query['version'] == 4 else 128
+        found = []
+        for length in range(query['length']):
+            start = query['start'] >> (width - length) << (width - length)
+            found.extend(self.exact.get((query['version'], start, length), []))
+        first = bisect.bisect_left(self.keys, (query['version'], query['start']))
+        last = bisect.bisect_right(self.keys, (query['version'], query['end']))
+        # Ranges starting at the same address may contain the CIDR, those were found above
+        found.extend(candidate for candidate in self.ranges[first:last] if candidate['end'] <= query['end'])
+        return found
+
+    def save(self, filename):
+        '''
+        Write the index as JSON, replacing the file atomically
+
+        :param str filename: File name
+        '''
+
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as index_file:
+            json.dump({'ranges': self.ranges}, index_file)
+        os.replace(temporary, filename)
+
+def configuredGuard(config):
+    '''
+    Return the guard against the configured index
+
+    :param dict config: Loaded config.json
+    :return: Function returning the indexed ranges a CIDR overlaps, None without an index
+    :rtype: function
+    :raises IOError: If the configured index can't be read
+    '''
+
+    if not config.get('overlapIndex'):
+        return None
+    return getIndex(config['overlapIndex']).overlaps
+
+def getIndex(filename):
+    '''
+    Return the index saved in a file, loaded again only when the file changed
+
+    :param str filename: File name
+    :return: Index
+    :rtype: OverlapIndex
+    :raises IOError: If the index can't be read
+    '''
+
+    modified = os.stat(filename).st_mtime
+    with indexesLock:
+        loaded, index = indexes.get(filename, (None, None))
+        if loaded != modified:
+            with open(filename) as index_file:
+                index = OverlapIndex(json.load(index_file)['ranges'])
+            indexes[filename] = (modified, index)
+        return index
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+""" Offline planner for the subnets inside a VPC.
+
+The layout inside a freshly allocated VPC CIDR is fully determined by the
+order, sizes and positions of its child subnets. This module computes every
+child CIDR and reserved IP address locally, the same way phpIPAM would find
+them with consecutive first_subnet/last_subnet and first_free calls, so the
+subnets can be created by explicit CIDR without any server-side search.
+
+A layout is a list of child subnets, each a dictionary with:
+    - description: Human-readable description, appended to a prefix
+    - size: Size of the subnet in bits
+    - position: 'first' or 'last' free block in the parent (default 'first')
+    - nameserver: Whether the regional nameserver set applies (default False)
+    - allowRequests: Whether IP addresses may be requested (default 0)
+    - addresses: Descriptions of the reserved addresses, gateway first
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import ipaddress
+
+def planAddresses(subnet, descriptions):
+    '''
+    Compute the reserved addresses at the start of a subnet
+
+    :param str subnet: CIDR of the subnet
+    :param list descriptions: Descriptions of the addresses, gateway first
+    :return: Addresses with 'ip', 'description' and 'isGateway'
+    :rtype: list
+    '''
+
+    network = ipaddress.ip_network(subnet)
+    addresses = []
+    for offset, description in enumerate(descriptions, 1):
+        addresses.append({
+            'ip': str(network[offset]),
+            'description': description,
+            'isGateway': 1 if offset == 1 else 0
+        })
+    return addresses
+
+def planLayout(cidr, layout):
+    '''
+    Compute the CIDR and reserved addresses of every child subnet
+
+    :param str cidr: CIDR of the parent subnet
+    :param list layout: Child subnets in allocation order
+    :return: Copies of the layout entries with 'subnet' and planned 'addresses'
+    :rtype: list
+    :raises ValueError: If a child subnet does not fit in the parent
+    '''
+
+    parent = ipaddress.ip_network(cidr)
+    allocated = []
+    plan = []
+    for child in layout:
+        candidates = parent.subnets(new_prefix = child['size'])
+        if child.get('position', 'first') == 'last':
+            candidates = reversed(list(candidates))
+
+        subnet = None
+        for candidate in candidates:
+            if not any(candidate.overlaps(taken) for taken in allocated):
+                subnet = candidate
+                break
+        if subnet is None:
+            raise ValueError(f"No free /{child['size']} left in {cidr} for {child['description']}")
+        allocated.append(subnet)
+
+        planned = dict(child)
+        planned['subnet'] = str(subnet)
+        planned['addresses'] = planAddresses(planned['subnet'], child.get('addresses', []))
+        plan.append(planned)
+    return plan
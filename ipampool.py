@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+""" Warm pool of pre-carved spokes per regional supernet.
+
+A refiller provisions complete spoke trees ahead of time, subnets and
+reserved addresses included, with placeholder descriptions. A request for a
+new spoke then claims one of those trees instead of carving a new one: it
+takes the oldest tree of the pool under the pool lock of the supernet and
+renames its subnets to the account, a handful of calls in total.
+
+A tree is carved under the 'Carving' placeholder, followed by the time the
+carving started, and only joins the pool, as 'Unassigned', once it is
+complete, so a claim never gets a half-built tree. A refill first deletes
+the trees that are still being carved after a lease, left behind by a
+refill that crashed.
+
+A claim that fails to rename every subnet of the tree renames them back
+and returns the tree to the pool. A claim skips the trees of the pool that
+overlap a range kept outside phpIPAM (see ipamoverlap), and the next refill
+deletes them.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import time
+import ipamscheduler
+from concurrent.futures import ThreadPoolExecutor
+
+PLACEHOLDER = 'Unassigned' # Description prefix of the trees in the pool
+CARVING = 'Carving' # Description prefix of the trees still being carved
+LEASE = 3600 # Seconds after which a tree still being carved counts as abandoned
+WORKERS = 4 # Default number of parallel API calls
+
+def children(client, subnetId):
+    '''
+    Return the subnets directly inside a subnet
+
+    :param IpamClient client: phpIPAM client
+    :param int subnetId: ID of the subnet
+    :return: phpIPAM subnet objects, empty if there are none
+    :rtype: list
+    :raises ProvisionError: If the subnets can't be read
+    '''
+
+    r = client.getChildren(subnetId)
+    if r.get('code') == 404:
+        return []
+    if r.get('code') != 200:
+        raise ipamscheduler.ProvisionError(f"Can't read the subnets of {subnetId}: {r.get('message', r.get('code'))}")
+    return r.get('data') or []
+
+def pooled(client, layout, masterId):
+    '''
+    Return the trees in the pool of a supernet, oldest first
+
+    :param IpamClient client: phpIPAM client
+    :param dict layout: Layout of the trees
+    :param int masterId: Subnet ID of the regional supernet
+    :return: phpIPAM subnet objects of the VPCs in the pool
+    :rtype: list
+    '''
+
+    description = f"{PLACEHOLDER} {layout['description']}"
+    return sorted([subnet for subnet in children(client, masterId) if subnet['description'] == description],
+        key = lambda subnet: int(subnet['id']))
+
+def renames(client, layout, subnet, account):
+    '''
+    List the renames of the subnets below a VPC, in layout order
+
+    :param IpamClient client: phpIPAM client
+    :param dict layout: Layout entry of the subnet
+    :param dict subnet: phpIPAM subnet object
+    :param str account: Name of the account
+    :return: Subnet ID, CIDR, new and current description of every subnet below
+    :rtype: list
+    :raises ProvisionError: If the tree doesn't match the layout
+    '''
+
+    found = []
+    layoutChildren = ipamscheduler.selectSubnets(layout, set())
+    if not layoutChildren:
+        return found
+    existing = children(client, subnet['id'])
+    for child in layoutChildren:
+        matches = [candidate for candidate in existing if candidate['description'].endswith(' ' + child['description'])]
+        if not matches:
+            raise ipamscheduler.ProvisionError(f"Pooled VPC {subnet['id']} has no {child['description']}.")
+        existing.remove(matches[0])
+        found.append((matches[0]['id'], f"{matches[0]['subnet']}/{matches[0]['mask']}", f"{account} {child['description']}",
+            matches[0]['description']))
+        found.extend(renames(client, child, matches[0], account))
+    return found
+
+def rename(client, subnets, workers = WORKERS, restore = False):
+    '''
+    Rename subnets in parallel
+
+    :param IpamClient client: phpIPAM client
+    :param list subnets: Renames, see renames
+    :param int workers: Maximum number of parallel API calls
+    :param bool restore: Whether to rename them back to their current description
+    :return: Error messages by new description
+    :rtype: dict
+    '''
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        responses = list(executor.map(lambda subnet: client.updateSubnet(subnet[0], {'description': subnet[3 if restore else 2]}),
+            subnets))
+    return {subnet[2]: r.get('message', r.get('code')) for subnet, r in zip(subnets, responses) if r.get('code') != 200}
+
+def claimSpoke(client, locks, layout, masterId, account, workers = WORKERS, guard = None):
+    '''
+    Claim a tree from the pool and rename it to an account
+
+    A tree that doesn't match the layout is marked as abandoned, for the next
+    refill to delete, and the next one is taken. When renaming the subnets
+    fails, the renamed ones are renamed back and the tree returns to the
+    pool.
+
+    :param IpamClient client: phpIPAM client
+    :param locks: Lock backend, see ipamlock
+    :param dict layout: Layout of the trees
+    :param int masterId: Subnet ID of the regional supernet
+    :param str account: Name of the account
+    :param int workers: Maximum number of parallel API calls
+    :param function guard: Function returning the ranges a CIDR must not overlap, see ipamoverlap
+    :return: JSON object like provisionLayout's, None if the pool is empty
+    :rtype: dict
+    '''
+
+    output = {'code': 0, 'success': 'false', 'pool': True}
+    description = f"{account} {layout['description']}"
+    with locks.lock(f"pool-{masterId}"):
+        candidates = pooled(client, layout, masterId)
+        if guard is not None:
+            candidates = [vpc for vpc in candidates if not guard(f"{vpc['subnet']}/{vpc['mask']}")]
+        for vpc in candidates:
+            try:
+                subnets = renames(client, layout, vpc, account)
+            except ipamscheduler.ProvisionError:
+                client.updateSubnet(vpc['id'], {'description': f"{CARVING} 0 {layout['description']}"})
+                continue
+            r = client.updateSubnet(vpc['id'], {'description': description})
+            if r.get('code') != 200:
+                output['code'] = 500
+                output['errors'] = {'vpc': r.get('message', r.get('code'))}
+                return output
+            break
+        else:
+            return None
+    output['data'] = [{'id': vpc['id'], 'subnet': f"{vpc['subnet']}/{vpc['mask']}", 'description': description}]
+    output['data'].extend({'id': subnetId, 'subnet': subnet, 'description': new} for subnetId, subnet, new, current in subnets)
+
+    errors = rename(client, subnets, workers)
+    if not errors:
+        output['code'] = 200
+        output['success'] = 'true'
+        return output
+
+    # Rename the tree back and return it to the pool, a half-renamed tree would be lost to both
+    output['code'] = 500
+    output['errors'] = errors
+    restored = rename(client, subnets, workers, restore = True)
+    if not restored:
+        r = client.updateSubnet(vpc['id'], {'description': f"{PLACEHOLDER} {layout['description']}"})
+        if r.get('code') != 200:
+            restored = {'vpc': r.get('message', r.get('code'))}
+    output['released'] = not restored
+    if restored:
+        output['releaseErrors'] = restored
+    return output
+
+def deleteTree(client, subnetId):
+    '''
+    Delete a subnet, the subnets below it first
+
+    :param IpamClient client: phpIPAM client
+    :param int subnetId: ID of the subnet
+    :raises ProvisionError: If a subnet can't be read or deleted
+    '''
+
+    for child in children(client, subnetId):
+        deleteTree(client, child['id'])
+    r = client.deleteSubnet(subnetId)
+    if r.get('code') != 200:
+        raise ipamscheduler.ProvisionError(f"Can't delete subnet {subnetId}: {r.get('message', r.get('code'))}")
+
+def sweep(client, layout, masterId, lease = LEASE, trie = None):
+    '''
+    Delete the trees of a supernet still being carved after a lease
+
+    :param IpamClient client: phpIPAM client
+    :param dict layout: Layout of the trees
+    :param int masterId: Subnet ID of the regional supernet
+    :param float lease: Seconds a refill may take to carve a tree
+    :param PrefixTrie trie: Prefix trie to remove the deleted trees from, or None
+    :return: Number of trees deleted and error messages of the ones that weren't
+    :rtype: tuple
+    '''
+
+    swept = 0
+    errors = []
+    for subnet in children(client, masterId):
+        words = subnet['description'].split(' ', 2)
+        if len(words) < 3 or words[0] != CARVING or not words[1].isdigit() or words[2] != layout['description']:
+            continue
+        if time.time() - int(words[1]) < lease:
+            continue
+        try:
+            deleteTree(client, subnet['id'])
+        except ipamscheduler.ProvisionError as e:
+            errors.append(str(e))
+            continue
+        swept += 1
+        if trie is not None:
+            try:
+                trie.remove(f"{subnet['subnet']}/{subnet['mask']}")
+            except KeyError:
+                pass
+    return swept, errors
+
+def releaseOverlapping(client, locks, layout, masterId, guard, trie = None):
+    '''
+    Delete the trees of the pool that the guard refuses, claims skip them
+
+    :param IpamClient client: phpIPAM client
+    :param locks: Lock backend, see ipamlock
+    :param dict layout: Layout of the trees
+    :param int masterId: Subnet ID of the regional supernet
+    :param function guard: Function returning the ranges a CIDR must not overlap, see ipamoverlap
+    :param PrefixTrie trie: Prefix trie to remove the deleted trees from, or None
+    :return: CIDRs of the deleted trees, the number of refused trees left and error messages
+    :rtype: tuple
+    '''
+
+    released = []
+    errors = []
+    with locks.lock(f"pool-{masterId}"):
+        refused = [vpc for vpc in pooled(client, layout, masterId) if guard(f"{vpc['subnet']}/{vpc['mask']}")]
+        for vpc in refused:
+            cidr = f"{vpc['subnet']}/{vpc['mask']}"
+            try:
+                deleteTree(client, vpc['id'])
+            except ipamscheduler.ProvisionError as e:
+                errors.append(str(e))
+                continue
+            released.append(cidr)
+            if trie is not None:
+                try:
+                    trie.remove(cidr)
+                except KeyError:
+                    pass
+    return released, len(refused) - len(released), errors
+
+def refillPool(client, locks, layout, masterId, nameserverId, target, workers = WORKERS, trie = None, guard = None,
+    lease = LEASE):
+    '''
+    Carve trees until the pool of a supernet holds a number of them
+
+    The trees an earlier refill left unfinished for longer than the lease
+    are deleted first, and so are the trees of the pool the guard refuses.
+    Refused trees that can't be deleted don't count toward the target.
+
+    :param IpamClient client: phpIPAM client
+    :param locks: Lock backend, see ipamlock
+    :param dict layout: Layout of the trees
+    :param int masterId: Subnet ID of the regional supernet
+    :param int nameserverId: ID of the regional nameserver set in phpIPAM
+    :param int target: Number of trees to keep in the pool
+    :param int workers: Maximum number of parallel API calls
+    :param PrefixTrie trie: Prefix trie of the section to plan in locally, or None
+    :param function guard: Function returning the ranges a CIDR must not overlap, see ipamoverlap
+    :param float lease: Seconds a refill may take to carve a tree
+    :return: Number of trees added and swept, CIDRs of the refused trees released, and error messages of the failed ones
+    :rtype: dict
+    '''
+
+    output = {'added': 0, 'swept': 0, 'released': [], 'errors': []}
+    output['swept'], output['errors'] = sweep(client, layout, masterId, lease, trie)
+    refused = 0
+    if guard is not None:
+        output['released'], refused, errors = releaseOverlapping(client, locks, layout, masterId, guard, trie)
+        output['errors'].extend(errors)
+    for number in range(target - len(pooled(client, layout, masterId)) + refused):
+        r = ipamscheduler.provisionLayout(client, layout, masterId, f"{CARVING} {int(time.time())}", nameserverId,
+            workers = workers, trie = trie, locks = locks, rollback = True, guard = guard)
+        if r['code'] != 200:
+            output['errors'].append(r.get('errors'))
+            break
+        # Complete, so it may be claimed now
+        r = client.updateSubnet(r['data'][0]['id'], {'description': f"{PLACEHOLDER} {layout['description']}"})
+        if r.get('code') != 200:
+            output['errors'].append(r.get('message', r.get('code')))
+            break
+        output['added'] += 1
+    return output
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+""" Regional settings of the provisioning scripts.
+
+Every AWS region has a regional supernet in phpIPAM, a nameserver set and
+its transit gateway. Spokes (spoke-dev.py) and landing zones
+(landingzone-v2.py) are provisioned under the same supernets, but each with
+their own transit gateway settings, so both tables are kept here side by
+side. Reports like capacity-report.py read the supernets from here instead
+of loading the scripts.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+SPOKES = {
+    "ap-southeast-2": {
+        "network": 106,
+        "dns": 2,
+        "tgwId": "tgw-0fc230fd5535b3ddf",
+        "tgwInspectionAttachment": "",
+        "tgwMainRouteTable": "",
+        "tgwInspectionRouteTable": "",
+        "dhcpOptions": ""
+    },
+    "us-east-1": {
+        "network": 74,
+        "dns": 2,
+        "tgwId": "tgw-0031a74e3b340a704",
+        "tgwInspectionAttachment": "",
+        "tgwMainRouteTable": "",
+        "tgwInspectionRouteTable": "",
+        "dhcpOptions": ""
+    },
+    "eu-west-1": {
+        "network": 76,
+        "dns": 3,
+        "tgwId": "tgw-0031a74e3b340a704",
+        "tgwInspectionAttachment": "",
+        "tgwMainRouteTable": "",
+        "tgwInspectionRouteTable": "",
+        "dhcpOptions": ""
+    },
+    "eu-west-2": {
+        "network": 75,
+        "dns": 3,
+        "tgwId": "tgw-000816d04ea49d358",
+        "tgwInspectionAttachment": "",
+        "tgwMainRouteTable": "",
+        "tgwInspectionRouteTable": "",
+        "dhcpOptions": ""
+    },
+    "eu-central-1": {
+        "network": 918,
+        "dns": 3,
+        "tgwId": "tgw-06173001949ff1ea2",
+        "tgwInspectionAttachment": "tgw-attach-068d1df133ade8cac",
+        "tgwMainRouteTable": "tgw-rtb-05f55e0d134692083",
+        "tgwInspectionRouteTable": "tgw-rtb-05f55e0d134692083",
+        "dhcpOptions": "dopt-0a11e07c9afdbb7d8"
+    }
+}
+
+LANDINGZONES = {
+    "us-east-1": {
+        "network": 74,
+        "dns": 2,
+        "tgwId": "tgw-0031a74e3b340a704",
+        "tgwMainRouteTable": ""
+    },
+    "eu-west-1": {
+        "network": 76,
+        "dns": 3,
+        "tgwId": "tgw-0097de3283b71ced1",
+        "tgwMainRouteTable": ""
+    },
+    "eu-west-2": {
+        "network": 75,
+        "dns": 3,
+        "tgwId": "tgw-000816d04ea49d358",
+        "tgwMainRouteTable": ""
+    },
+    "eu-central-1": {
+        "network": 918,
+        "dns": 3,
+        "tgwId": "tgw-06173001949ff1ea2",
+        "tgwMainRouteTable": "tgw-rtb-05f55e0d134692083"
+    },
+    "ap-southeast-2": {
+        "network": 106,
+        "dns": 2,
+        "tgwId": "tgw-0fc230fd5535b3ddf",
+        "tgwMainRouteTable": ""
+    }
+}
+
+def supernets(*tables):
+    '''
+    Collect the regional supernets of settings tables
+
+    :param dict tables: Settings by region, e.g. SPOKES and LANDINGZONES
+    :return: Regions by supernet ID
+    :rtype: dict
+    '''
+
+    found = {}
+    for table in tables:
+        for region, settings in table.items():
+            regions = found.setdefault(str(settings['network']), [])
+            if region not in regions:
+                regions.append(region)
+    return found
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+""" Declarative VPC layouts and a dependency-aware provisioning scheduler.
+
+A VPC layout is a JSON file in the layouts directory describing the VPC
+subnet and, nested under 'subnets', its child subnets with their sizes,
+positions, nameserver, allowRequests and reserved addresses. See
+ipamplanner for the keys of a subnet. Child subnets with a 'when' key are
+only provisioned when that option is requested, e.g. "when": "cvpn".
+
+The scheduler turns a layout into a dependency graph: the VPC is allocated
+from the regional supernet, its children are planned locally and created by
+CIDR as soon as the VPC exists, and the reserved addresses of each child as
+soon as that child exists. Independent branches run concurrently on a
+bounded worker pool.
+
+The VPC is found and created by CIDR under a per-supernet lock (see
+ipamlock), then read back. If a concurrent allocation got in the way, the
+VPC is released and allocated again, a bounded number of times.
+
+Given a journal (see ipamjournal), every step is recorded with its result
+and the steps that succeeded in an earlier attempt of the same run are not
+run again. On failure, the subnets created so far can be rolled back.
+
+Given a prefix trie of the section (see ipamtrie), the VPC is planned
+locally instead of on the server, and every created subnet is recorded in
+the trie so later plans in the same process don't collide with it.
+
+Given a guard (see ipamoverlap), a planned VPC that overlaps a range kept
+outside phpIPAM is refused before it is created.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import json
+import time
+import random
+import ipaddress
+import ipamlock
+import ipamjournal
+import ipamplanner
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+LAYOUTPATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layouts'),
+    '/etc/netops/phpipam/layouts'
+]
+WORKERS = 4 # Default number of parallel API calls
+RETRIES = 3 # Default number of retries of a collided VPC allocation
+BACKOFF = 0.2 # Base seconds between VPC allocation retries
+
+class ProvisionError(Exception):
+    '''
+    A provisioning step was refused by phpIPAM
+    '''
+
+def loadLayout(name):
+    '''
+    Load a VPC layout by name
+
+    :param str name: Name of the layout file without .json
+    :return: Layout
+    :rtype: dict
+    :raises IOError: If the layout can't be found
+    '''
+
+    for path in LAYOUTPATHS:
+        try:
+            with open(os.path.join(path, name + '.json')) as layout_file:
+                return json.load(layout_file)
+        except IOError:
+            continue
+    raise IOError(f"Can't find layout {name}.")
+
+def runGraph(tasks, workers = WORKERS, done = None):
+    '''
+    Run tasks on a worker pool as soon as their dependencies have succeeded
+
+    Every task is a tuple of a function and a list of task names it depends
+    on. The function is called with a dictionary of the results of those
+    dependencies. Tasks depending on a failed task are not run and fail too.
+
+    :param dict tasks: Tasks by name
+    :param int workers: Maximum number of tasks running at the same time
+    :param dict done: Results of tasks that already succeeded earlier, these are not run again
+    :return: Results by task name and error messages by failed task name
+    :rtype: tuple
+    '''
+
+    results = dict(done or {})
+    failed = {}
+    pending = {name: task for name, task in tasks.items() if name not in results}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                function, dependencies = pending[name]
+                blocked = [dependency for dependency in dependencies if dependency in failed]
+                if blocked:
+                    failed[name] = f"Skipped, {blocked[0]} failed."
+                    del pending[name]
+                elif all(dependency in results for dependency in dependencies):
+                    arguments = {dependency: results[dependency] for dependency in dependencies}
+                    running[executor.submit(function, arguments)] = name
+                    del pending[name]
+
+            if not running:
+                for name in pending:
+                    failed[name] = 'Unresolvable dependencies.'
+                break
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    failed[name] = str(e)
+
+    return results, failed
+
+def checkResponse(r, what):
+    '''
+    Raise if phpIPAM did not create what was asked for
+
+    :param dict r: Server response
+    :param str what: Description of the requested object
+    :return: Server response
+    :rtype: dict
+    :raises ProvisionError: If the response code is not 201
+    '''
+
+    if r.get('code') != 201:
+        raise ProvisionError(f"{what}: {r.get('message', r.get('code'))}")
+    return r
+
+def selectSubnets(subnet, options):
+    '''
+    Return the child subnets of a layout entry that apply to the options
+
+    :param dict subnet: Layout entry
+    :param set options: Enabled layout options
+    :return: Child subnets in layout order
+    :rtype: list
+    '''
+
+    return [child for child in subnet.get('subnets', []) if child.get('when', '') in options | {''}]
+
+def loadChildren(client, trie, masterId):
+    '''
+    Get the subnets directly inside the regional supernet, recording them in the trie
+
+    :param IpamClient client: phpIPAM client
+    :param PrefixTrie trie: Prefix trie to record the subnets in, or None
+    :param int masterId: Subnet ID of the regional supernet
+    :return: phpIPAM subnet objects
+    :rtype: list
+    :raises ProvisionError: If the subnets can't be read
+    '''
+
+    r = client.getChildren(masterId)
+    if r.get('code') != 200:
+        raise ProvisionError(f"Can't read the subnets of {masterId}: {r.get('message', r.get('code'))}")
+    children = r.get('data') or []
+    if trie is not None:
+        for child in children:
+            trie.insert(f"{child['subnet']}/{child['mask']}", child)
+    return children
+
+def planVpc(client, trie, masterId, subnet, description):
+    '''
+    Find the free block for the VPC, in the trie or on the server
+
+    :return: CIDR of the free block
+    :rtype: str
+    :raises ProvisionError: If there is no free block
+    '''
+
+    position = subnet.get('position', 'first')
+    if trie is None:
+        r = client.findSubnet(masterId, subnet['size'], position)
+        if r.get('code') != 200:
+            raise ProvisionError(f"{description}: {r.get('message', r.get('code'))}")
+        return r['data']
+    planned = trie.freeBlock(trie.ids[str(masterId)], subnet['size'], position)
+    if planned is None:
+        raise ProvisionError(f"{description}: No free /{subnet['size']} left in the regional supernet.")
+    return planned
+
+def verifyVpc(client, trie, masterId, subnetId, planned):
+    '''
+    Check that a new VPC subnet is the planned one and doesn't overlap an older sibling
+
+    :return: Whether the allocation holds
+    :rtype: bool
+    '''
+
+    network = ipaddress.ip_network(planned)
+    for child in loadChildren(client, trie, masterId):
+        cidr = f"{child['subnet']}/{child['mask']}"
+        if str(child['id']) == str(subnetId):
+            if cidr != planned:
+                return False
+        elif int(child['id']) < int(subnetId) and ipaddress.ip_network(cidr).overlaps(network):
+            return False
+    return True
+
+def createVpc(client, locks, trie, masterId, subnet, description, nameserverId, results, retries = RETRIES, guard = None):
+    '''
+    Task allocating the VPC subnet from the regional supernet
+
+    The free block is found and created under the lock of the supernet, then
+    verified. When another allocation got in the way, the subnet is released
+    and the allocation retried a bounded number of times.
+    '''
+
+    conflict = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+        with locks.lock(f"subnet-{masterId}"):
+            planned = planVpc(client, trie, masterId, subnet, description)
+            overlaps = guard(planned) if guard is not None else []
+            if overlaps:
+                names = ', '.join(f"{found['cidr']} ({found['label'] or found['source']})" for found in overlaps)
+                raise ProvisionError(f"{description}: {planned} overlaps {names}.")
+            r = client.createSubnet(masterId, results['section'], planned, description, nameserverId,
+                subnet.get('allowRequests', 0))
+            if r.get('code') == 201 and trie is not None:
+                trie.insert(planned, {'id': r['id'], 'description': description})
+
+        if r.get('code') == 409:
+            # Taken since it was planned, look again
+            conflict = r.get('message', planned)
+            if trie is not None:
+                loadChildren(client, trie, masterId)
+            continue
+        checkResponse(r, description)
+
+        if verifyVpc(client, trie, masterId, r['id'], planned):
+            return {'id': r['id'], 'subnet': planned, 'description': description}
+        conflict = f"{planned} collided with a concurrent allocation"
+        client.deleteSubnet(r['id'])
+        if trie is not None:
+            trie.remove(planned)
+            loadChildren(client, trie, masterId)
+
+    raise ProvisionError(f"{description}: Gave up after {retries + 1} attempts, {conflict}.")
+
+def planChildren(parent, children, results):
+    '''
+    Task planning the child subnets as soon as the parent CIDR is known
+    '''
+
+    return ipamplanner.planLayout(results[parent]['subnet'], children)
+
+def createChild(client, trie, parent, index, subnet, description, nameserverId, results):
+    '''
+    Task creating a planned child subnet by CIDR
+    '''
+
+    planned = results[parent + '/plan'][index]
+    r = checkResponse(client.createSubnet(results[parent]['id'], results['section'], planned['subnet'],
+        description, nameserverId, subnet.get('allowRequests', 0)), description)
+    if trie is not None:
+        trie.insert(planned['subnet'], {'id': r['id'], 'description': description})
+    return {'id': r['id'], 'subnet': planned['subnet'], 'description': description}
+
+def reserveAddress(client, name, descriptions, index, results):
+    '''
+    Task reserving one of the first addresses of a subnet
+    '''
+
+    address = ipamplanner.planAddresses(results[name]['subnet'], descriptions)[index]
+    return checkResponse(client.createAddress(results[name]['id'], address['ip'], address['description'],
+        address['isGateway']), f"{results[name]['description']} {address['ip']}")
+
+def buildTasks(client, trie, tasks, order, name, subnet, create, dependencies, descriptionPrePend, nameserverId, options):
+    '''
+    Add the tasks for a subnet, its reserved addresses and its children
+
+    :param IpamClient client: phpIPAM client
+    :param PrefixTrie trie: Prefix trie to record the subnets in, or None
+    :param dict tasks: Tasks by name, updated in place
+    :param list order: Names of the subnet tasks in output order, updated in place
+    :param str name: Task name of the subnet
+    :param dict subnet: Layout entry of the subnet
+    :param function create: Task function creating the subnet, completed with description, nameserver and results
+    :param list dependencies: Task names the subnet creation depends on
+    :param str descriptionPrePend: Prefix for the subnet descriptions
+    :param int nameserverId: ID of the regional nameserver set in phpIPAM
+    :param set options: Enabled layout options
+    '''
+
+    description = descriptionPrePend + ' ' + subnet['description']
+    nameserver = nameserverId if subnet.get('nameserver') else 0
+    tasks[name] = (partial(create, description, nameserver), dependencies)
+    order.append(name)
+
+    for index in range(len(subnet.get('addresses', []))):
+        tasks[f"{name}/address/{index}"] = (partial(reserveAddress, client, name, subnet['addresses'], index), [name])
+
+    children = selectSubnets(subnet, options)
+    if children:
+        tasks[name + '/plan'] = (partial(planChildren, name, children), [name])
+    for index, child in enumerate(children):
+        childName = f"{name}/{index}"
+        buildTasks(client, trie, tasks, order, childName, child, partial(createChild, client, trie, name, index, child),
+            [name, name + '/plan', 'section'], descriptionPrePend, nameserverId, options)
+
+def forgetSubnets(trie, created, deleted):
+    '''
+    Take rolled back subnets out of the trie again
+
+    :param PrefixTrie trie: Prefix trie the subnets were recorded in, or None
+    :param dict created: Results of the subnet steps by step name
+    :param list deleted: Names of the deleted steps
+    '''
+
+    if trie is None:
+        return
+    for name in deleted:
+        try:
+            trie.remove(created[name]['subnet'])
+        except KeyError:
+            pass
+
+def rollbackLayout(client, journal, workers = WORKERS, trie = None):
+    '''
+    Roll back the subnets a journaled layout created, e.g. one that succeeded next to a layout that failed
+
+    :param IpamClient client: phpIPAM client
+    :param Journal journal: Journal (or view) the layout was provisioned with
+    :param int workers: Maximum number of parallel deletes
+    :param PrefixTrie trie: Prefix trie the subnets were recorded in, or None
+    :return: Names of the deleted steps and error messages by failed step name
+    :rtype: dict
+    '''
+
+    created = ipamjournal.createdSubnets(journal.state()[0])
+    output = ipamjournal.rollback(client, journal, created, workers)
+    forgetSubnets(trie, created, output['deleted'])
+    return output
+
+def provisionLayout(client, layout, masterId, descriptionPrePend, nameserverId, options = (), workers = WORKERS, trie = None,
+    locks = None, retries = RETRIES, journal = None, rollback = False, guard = None):
+    '''
+    Provision a VPC layout under a regional supernet
+
+    :param IpamClient client: phpIPAM client
+    :param dict layout: VPC layout
+    :param int masterId: Subnet ID of the regional supernet
+    :param str descriptionPrePend: Prefix for the subnet descriptions
+    :param int nameserverId: ID of the regional nameserver set in phpIPAM
+    :param list options: Enabled layout options, e.g. ['cvpn']
+    :param int workers: Maximum number of parallel API calls
+    :param PrefixTrie trie: Prefix trie of the section to plan the VPC in, or None to let phpIPAM find it
+    :param locks: Lock backend serializing allocations per supernet, see ipamlock
+    :param int retries: Number of times to retry a VPC allocation that collided
+    :param Journal journal: Journal to record every step in and to resume from, see ipamjournal
+    :param bool rollback: Whether to delete the created subnets again when a step failed
+    :param function guard: Function returning the ranges a CIDR must not overlap, see ipamoverlap
+    :return: JSON object with the created subnets in layout order
+    :rtype: dict
+    '''
+
+    output = {'code': 0, 'success': 'false'}
+    tasks = {}
+    order = []
+
+    tasks['section'] = (lambda results: client.getCached(f"subnets/{masterId}/")['data']['sectionId'], [])
+    create = partial(createVpc, client, locks or ipamlock.NullLocks(), trie, masterId, layout, retries = retries,
+        guard = guard)
+    buildTasks(client, trie, tasks, order, 'vpc', layout, create, ['section'],
+        descriptionPrePend, nameserverId, set(options))
+
+    done = {}
+    if journal is not None:
+        done, interrupted = journal.state()
+        if interrupted:
+            output['interrupted'] = interrupted
+        tasks = {name: (partial(journal.run, name, function), dependencies)
+            for name, (function, dependencies) in tasks.items()}
+    results, failed = runGraph(tasks, workers, done)
+
+    output['data'] = [results[name] for name in order if name in results]
+    if failed:
+        output['code'] = 500
+        output['success'] = 'false'
+        output['errors'] = failed
+        if rollback:
+            created = {name: results[name] for name in order if name in results}
+            output['rollback'] = ipamjournal.rollback(client, journal, created, workers)
+            forgetSubnets(trie, created, output['rollback']['deleted'])
+    else:
+        output['code'] = 200
+        output['success'] = 'true'
+    return output
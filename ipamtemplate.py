@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+""" Shared Jinja2 template loading for all scripts.
+
+Templates are loaded through one Environment per template directory with a
+filesystem loader, so compiled templates are kept in memory and only
+recompiled when the file's modification time changes. Compiled bytecode is
+also stored in a FileSystemBytecodeCache, so a fresh process doesn't have to
+lex and compile a large template again either.
+
+The bytecode cache lives in the directory set by the optional
+'templateCache' key in config.json, or in a private directory under the
+system temporary directory otherwise.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import threading
+import ipamtrace
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+environments = {}
+environmentsLock = threading.Lock()
+
+def getEnvironment(directory, cacheDir = None):
+    '''
+    Return the shared Environment for a template directory
+
+    :param str directory: Directory holding the templates
+    :param str cacheDir: Directory for the bytecode cache
+    :return: Environment shared by every caller using the same directory
+    :rtype: jinja2.Environment
+    '''
+
+    key = (directory, cacheDir)
+    with environmentsLock:
+        if key not in environments:
+            if cacheDir is not None:
+                os.makedirs(cacheDir, exist_ok = True)
+            environments[key] = Environment(
+                loader = FileSystemLoader(directory),
+                bytecode_cache = FileSystemBytecodeCache(cacheDir),
+                auto_reload = True
+            )
+        return environments[key]
+
+def getTemplate(filename, cacheDir = None):
+    '''
+    Return a compiled template, recompiled only when the file has changed
+
+    :param str filename: Template file name
+    :param str cacheDir: Directory for the bytecode cache
+    :return: Compiled template
+    :rtype: jinja2.Template
+    '''
+
+    filename = os.path.abspath(filename)
+    with ipamtrace.span('template', template = filename):
+        return getEnvironment(os.path.dirname(filename), cacheDir).get_template(os.path.basename(filename))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+""" Lightweight tracing of where the time of a run goes.
+
+When tracing is enabled, named spans are recorded with their start, their
+duration, the thread they ran in and a few attributes: every HTTP call with
+its method, endpoint, status and size, every template load and render, and
+the startup of the script up to its main function. When tracing is not
+enabled, a span costs next to nothing.
+
+The spans can be added to the JSON output of a script, or written as a
+Chrome trace-event file to open in chrome://tracing, Perfetto or speedscope.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+enabled = False
+spans = []
+spansLock = threading.Lock()
+threads = {}
+
+def enable():
+    '''
+    Start recording spans
+    '''
+
+    global enabled
+    enabled = True
+
+def record(name, start, end, **attributes):
+    '''
+    Record a span that has already finished
+
+    :param str name: Name of the span, e.g. 'http'
+    :param float start: Start as a Unix timestamp
+    :param float end: End as a Unix timestamp
+    :param attributes: Attributes of the span
+    '''
+
+    if not enabled:
+        return
+    with spansLock:
+        thread = threads.setdefault(threading.get_ident(), len(threads))
+        spans.append({'name': name, 'start': start, 'duration': end - start, 'thread': thread, 'attributes': attributes})
+
+@contextmanager
+def span(name, **attributes):
+    '''
+    Record a span for the duration of a with block
+
+    The block receives the attributes as a dictionary, so it can add what
+    it only learns along the way, like the status of a response.
+
+    :param str name: Name of the span, e.g. 'http'
+    :param attributes: Attributes of the span
+    '''
+
+    if not enabled:
+        yield attributes
+        return
+    start = time.time()
+    try:
+        yield attributes
+    finally:
+        record(name, start, time.time(), **attributes)
+
+def processStart():
+    '''
+    Return when the current process was started
+
+    :return: Unix timestamp, None where the operating system doesn't tell
+    :rtype: float
+    '''
+
+    try:
+        with open('/proc/self/stat') as stat_file:
+            ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+    return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+
+def startup(end, fallback):
+    '''
+    Record the startup of the script, interpreter and imports included
+
+    :param float end: Unix timestamp the script's main function started
+    :param float fallback: Unix timestamp to start from when the process start isn't known
+    '''
+
+    start = processStart()
+    if start is None or start > fallback:
+        start = fallback
+    record('startup', start, end)
+
+def getSpans():
+    '''
+    Return the spans recorded so far
+
+    :return: Spans in start order with times in seconds
+    :rtype: list
+    '''
+
+    with spansLock:
+        return sorted(spans, key = lambda span: span['start'])
+
+def chromeTrace():
+    '''
+    Return the spans in Chrome trace-event format
+
+    :return: Trace events
+    :rtype: dict
+    '''
+
+    events = []
+    for span in getSpans():
+        events.append({
+            'name': span['attributes'].get('endpoint', span['name']),
+            'cat': span['name'],
+            'ph': 'X',
+            'ts': span['start'] * 1000000,
+            'dur': span['duration'] * 1000000,
+            'pid': os.getpid(),
+            'tid': span['thread'],
+            'args': span['attributes']
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def writeChromeTrace(filename):
+    '''
+    Write the spans as a Chrome trace-event file
+
+    :param str filename: File name
+    '''
+
+    with open(filename, 'w') as trace_file:
+        json.dump(chromeTrace(), trace_file)
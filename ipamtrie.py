@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+""" In-memory prefix trie of the phpIPAM subnet tree.
+
+All subnets of a section are loaded with a single API call into a binary
+trie keyed by integer network address and prefix length. Questions about
+the address space are then answered locally, walking at most one path from
+the root:
+    - longestMatch: the most specific subnet containing an address or CIDR
+    - overlaps: the subnets overlapping a CIDR
+    - children: the subnets directly below a subnet
+    - freeBlock: the first or last free block of a size inside a subnet
+
+Every node keeps the size of the largest free block below it, so a free
+block is found without visiting occupied branches. Subnets created or
+removed by the provisioning scripts are applied to the trie with insert and
+remove, so it stays in step with phpIPAM during a run.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import ipaddress
+import threading
+
+class Node:
+    '''
+    Node of the trie, one per prefix that is stored or has stored prefixes below it
+    '''
+
+    __slots__ = ('children', 'data', 'stored', 'free')
+
+    def __init__(self, length):
+        self.children = [None, None]
+        self.data = None
+        self.stored = False
+        # Prefix length of the largest free block below this node
+        self.free = length + 1
+
+    def update(self, length):
+        '''
+        Recompute the largest free block from the children
+
+        :param int length: Prefix length of this node
+        '''
+
+        free = None
+        for child in self.children:
+            if child is None:
+                candidate = length + 1
+            elif child.stored:
+                candidate = None
+            else:
+                candidate = child.free
+            if candidate is not None and (free is None or candidate < free):
+                free = candidate
+        self.free = free
+
+class PrefixTrie:
+    '''
+    Binary trie of subnets, one root per IP version
+    '''
+
+    def __init__(self):
+        self.roots = {4: Node(0), 6: Node(0)}
+        self.ids = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(cidr):
+        '''
+        Return the integer key of a CIDR
+
+        :param str cidr: CIDR or IP address
+        :return: IP version, integer network address, prefix length and address width
+        :rtype: tuple
+        '''
+
+        network = ipaddress.ip_network(cidr, strict = False)
+        return network.version, int(network.network_address), network.prefixlen, network.max_prefixlen
+
+    @staticmethod
+    def bit(address, length, width):
+        '''
+        Return the bit of an address that selects the child at a prefix length
+        '''
+
+        return (address >> (width - length - 1)) & 1
+
+    @staticmethod
+    def network(version, address, length):
+        '''
+        Return the CIDR of an integer key
+        '''
+
+        address = ipaddress.IPv4Address(address) if version == 4 else ipaddress.IPv6Address(address)
+        return str(ipaddress.ip_network((address, length)))
+
+    @staticmethod
+    def truncate(address, length, width):
+        '''
+        Return an address with only the first bits of a prefix length kept
+        '''
+
+        return address >> (width - length) << (width - length)
+
+    def path(self, cidr):
+        '''
+        Return the nodes on the path to a CIDR, as far as they exist
+
+        :param str cidr: CIDR
+        :return: Nodes from the root down
+        :rtype: list
+        '''
+
+        version, address, length, width = self.key(cidr)
+        node = self.roots[version]
+        nodes = [node]
+        for depth in range(length):
+            node = node.children[self.bit(address, depth, width)]
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+    def insert(self, cidr, data = None):
+        '''
+        Store a subnet
+
+        :param str cidr: CIDR of the subnet
+        :param dict data: phpIPAM subnet object, or anything else to keep with it
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            node = self.roots[version]
+            nodes = [node]
+            for depth in range(length):
+                bit = self.bit(address, depth, width)
+                if node.children[bit] is None:
+                    node.children[bit] = Node(depth + 1)
+                node = node.children[bit]
+                nodes.append(node)
+            node.stored = True
+            node.data = data
+            if isinstance(data, dict) and 'id' in data:
+                self.ids[str(data['id'])] = self.network(version, address, length)
+            for depth in range(length - 1, -1, -1):
+                nodes[depth].update(depth)
+
+    def remove(self, cidr):
+        '''
+        Remove a subnet, the subnets below it stay
+
+        :param str cidr: CIDR of the subnet
+        :raises KeyError: If the subnet isn't stored
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            nodes = self.path(cidr)
+            if len(nodes) != length + 1 or not nodes[-1].stored:
+                raise KeyError(cidr)
+            node = nodes[-1]
+            if isinstance(node.data, dict) and 'id' in node.data:
+                self.ids.pop(str(node.data['id']), None)
+            node.stored = False
+            node.data = None
+
+            # Prune the branches that no longer lead to a stored subnet
+            for depth in range(length, 0, -1):
+                node = nodes[depth]
+                if node.stored or node.children != [None, None]:
+                    break
+                nodes[depth - 1].children[self.bit(address, depth - 1, width)] = None
+            for depth in range(length - 1, -1, -1):
+                nodes[depth].update(depth)
+
+    def get(self, cidr):
+        '''
+        Return the data of a stored subnet
+
+        :param str cidr: CIDR of the subnet
+        :return: Data of the subnet, None if it isn't stored
+        '''
+
+        with self.lock:
+            nodes = self.path(cidr)
+            if len(nodes) == self.key(cidr)[2] + 1 and nodes[-1].stored:
+                return nodes[-1].data
+            return None
+
+    def longestMatch(self, cidr):
+        '''
+        Return the most specific subnet containing an address or CIDR
+
+        :param str cidr: IP address or CIDR
+        :return: CIDR and data of the subnet, None if nothing contains it
+        :rtype: tuple
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            match = None
+            for depth, node in enumerate(self.path(cidr)):
+                if node.stored:
+                    match = (self.network(version, self.truncate(address, depth, width), depth), node.data)
+            return match
+
+    def walk(self, node, version, address, length, width):
+        '''
+        Yield the stored subnets in a branch in address order
+
+        :return: Generator of CIDR and data tuples
+        :rtype: generator
+        '''
+
+        if node.stored:
+            yield self.network(version, address, length), node.data
+        for bit, child in enumerate(node.children):
+            if child is not None:
+                yield from self.walk(child, version, address | (bit << (width - length - 1)), length + 1, width)
+
+    def overlaps(self, cidr):
+        '''
+        Return the subnets overlapping a CIDR, i.e. containing it or inside it
+
+        :param str cidr: CIDR
+        :return: CIDR and data tuples, the containing subnets first
+        :rtype: list
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            nodes = self.path(cidr)
+            found = []
+            for depth, node in enumerate(nodes[:length]):
+                if node.stored:
+                    found.append((self.network(version, self.truncate(address, depth, width), depth), node.data))
+            if len(nodes) == length + 1:
+                found.extend(self.walk(nodes[-1], version, address, length, width))
+            return found
+
+    def children(self, cidr):
+        '''
+        Return the subnets directly below a CIDR
+
+        :param str cidr: CIDR
+        :return: CIDR and data tuples in address order
+        :rtype: list
+        '''
+
+        version, address, length, width = self.key(cidr)
+        with self.lock:
+            nodes = self.path(cidr)
+            if len(nodes) != length + 1:
+                return []
+            found = []
+            stack = [(nodes[-1].children[bit], address | (bit << (width - length - 1)), length + 1) for bit in (1, 0)]
+            while stack:
+                node, prefix, depth = stack.pop()
+                if node is None:
+                    continue
+                if node.stored:
+                    found.append((self.network(version, prefix, depth), node.data))
+                    continue
+                stack.extend((node.children[bit], prefix | (bit << (width - depth - 1)), depth + 1) for bit in (1, 0))
+            return found
+
+    def freeBlock(self, cidr, size, position = 'first'):
+        '''
+        Find the first or last free block of a size inside a subnet
+
+        :param str cidr: CIDR of the parent subnet
+        :param int size: Prefix length of the block
+        :param str position: 'first' or 'last' free block
+        :return: CIDR of the free block, None if there is none
+        :rtype: str
+        '''
+
+        version, address, length, width = self.key(cidr)
+        if size <= length or size > width:
+            return None
+        order = (1, 0) if position == 'last' else (0, 1)
+        with self.lock:
+            nodes = self.path(cidr)
+            if len(nodes) != length + 1:
+                # Nothing is stored inside the parent
+                node = None
+            else:
+                node = nodes[-1]
+                if node.free is None or node.free > size:
+                    return None
+
+            for depth in range(length, size):
+                if node is None:
+                    # The whole branch is free, take its first or last block
+                    if position == 'last':
+                        address |= (1 << (width - depth)) - (1 << (width - size))
+                    break
+                for bit in order:
+                    child = node.children[bit]
+                    if child is None or (not child.stored and child.free is not None and child.free <= size):
+                        address |= bit << (width - depth - 1)
+                        node = child
+                        break
+            return self.network(version, address, size)
+
+    def allocate(self, cidr, size, position = 'first', data = None):
+        '''
+        Find a free block and store it in one step
+
+        :param str cidr: CIDR of the parent subnet
+        :param int size: Prefix length of the block
+        :param str position: 'first' or 'last' free block
+        :param dict data: Data to keep with the block
+        :return: CIDR of the block, None if there is no free block
+        :rtype: str
+        '''
+
+        with self.lock:
+            block = self.freeBlock(cidr, size, position)
+            if block is not None:
+                self.insert(block, data)
+            return block
+
+def loadSection(client, sectionId, trie = None):
+    '''
+    Load all subnets of a section into a trie
+
+    :param IpamClient client: phpIPAM client
+    :param int sectionId: ID of the section in phpIPAM
+    :param PrefixTrie trie: Empty trie to load into, a new PrefixTrie by default
+    :return: Trie of the subnets, with their phpIPAM objects as data
+    :rtype: PrefixTrie
+    '''
+
+    r = client.request('GET', f"sections/{sectionId}/subnets/").json()
+    if trie is None:
+        trie = PrefixTrie()
+    for subnet in r.get('data') or []:
+        if str(subnet.get('isFolder', 0)) == '1' or not subnet.get('subnet'):
+            continue
+        trie.insert(f"{subnet['subnet']}/{subnet['mask']}", subnet)
+    return trie
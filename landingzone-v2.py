@@ -9,6 +9,15 @@ Including in the Landing Zones is:
     - Shared Services VPC
     - vEdge VPC
 
+With --regions or --all-regions several regions are provisioned in
+parallel, each under its own regional supernet, and the output holds the
+result and the CloudFormation YAML of every region. Raise poolSize in
+config.json to give every region its full share of connections.
+
+With --rollback, a run where any VPC failed is rolled back as a whole: the
+VPCs and regions that succeeded are deleted again from the journal of the
+run, so no half-built landing zone is left behind.
+
 --
 
 This program is free software: you can redistribute it and/or modify it under
@@ -29,45 +38,23 @@ __license__ = "GPLv3"
 
 import sys
 import argparse
-import requests
+import ipamclient
+import ipamtrace
+import ipamlock
+import ipamjournal
+import ipambuddy
+import ipamoverlap
+import ipamtemplate
+import ipamscheduler
+import ipamregions
 import json
 import time
-from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor
 
 starttime = time.time()
 config = {}
-regionalSettings = {
-    "us-east-1": {
-        "network": 74,
-        "dns": 2,
-        "tgwId": "tgw-0031a74e3b340a704",
-        "tgwMainRouteTable": ""
-    },
-    "eu-west-1": {
-        "network": 76,
-        "dns": 3,
-        "tgwId": "tgw-0097de3283b71ced1",
-        "tgwMainRouteTable": ""
-    },
-    "eu-west-2": {
-        "network": 75,
-        "dns": 3,
-        "tgwId": "tgw-000816d04ea49d358",
-        "tgwMainRouteTable": ""
-    },
-    "eu-central-1": {
-        "network": 918,
-        "dns": 3,
-        "tgwId": "tgw-06173001949ff1ea2",
-        "tgwMainRouteTable": "tgw-rtb-05f55e0d134692083"
-    },
-    "ap-southeast-2": {
-        "network": 106,
-        "dns": 2,
-        "tgwId": "tgw-0fc230fd5535b3ddf",
-        "tgwMainRouteTable": ""
-    }
-}
+regionalSettings = ipamregions.LANDINGZONES
+WORKERS = 4 # Default number of parallel API calls
 
 def loadConfig():
     '''
@@ -86,218 +73,46 @@ def loadConfig():
         except IOError:
             sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
 
-def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests = 1, position = 'first'):
-    '''
-    Request a subnet from a supernet and update its details
-
-    :param int masterId: Subnet ID of the supernet
-    :param int size: Size of the requested subnet in bits (1 - 31)
-    :param str description: Human-readable description of what this subnet is used for
-    :param int nameserverId: ID of nameserver set in phpIPAM
-    :param int allowRequests: Define whether IP addresses may be requested from this subnet
-    :param str position: Where in the supernet sits the requested subnet
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{masterId}/{position}_subnet/{size}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"description\": \"{description}\",
-        \"pingSubnet\": \"0\",
-        \"allowRequests\": \"{allowRequests}\",
-        \"nameserverId\": \"{nameserverId}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createFirstAddress(subnetId, description, isGateway = 0):
-    '''
-    Create an IP address in a specific subnet
-
-    :param int subnetId: ID of the subnet
-    :param str description: Human-readable description of what this subnet is used for
-    :param int isGateway: Define whether the device is a gateway (router)
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/addresses/first_free/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"subnetId\": \"{subnetId}\",
-        \"description\": \"{description}\",
-        \"is_gateway\": \"{isGateway}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createSsVpc(region, cvpn):
+def createSsVpc(region, cvpn, trie = None, journal = None, rollback = False):
     '''
     Create subnets for the Shared Services VPC
 
     :param str region: region where we deploy the VPC
     :param bool cvpn: whether to add subnets for CVPN firewalls
+    :param PrefixTrie trie: prefix trie of the section to plan in locally, or None
+    :param Journal journal: journal of the run, or None
+    :param bool rollback: whether to delete the created subnets again on failure
     :return: JSON object with server response
     :rtype: str
     '''
 
     global config, regionalSettings
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
-
-    descriptionPrePend = 'Shared Services'
-    description = descriptionPrePend + ' VpcCidr'
-    r = json.loads(requestSubnet(regionalSettings[region]['network'], 19, description, regionalSettings[region]['dns']))
-    if r['code'] == 201:
-        tmp = {'id': r['id'], 'subnet': r['data'], 'description': description}
-        output['data'].append(tmp)
-
-        description = descriptionPrePend + ' Private subnet AZ A'
-        privatea = json.loads(requestSubnet(r['id'], 22, description, regionalSettings[region]['dns']))
-        tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
-        output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
-
-        description = descriptionPrePend + ' Private subnet AZ B'
-        privateb = json.loads(requestSubnet(r['id'], 22, description, regionalSettings[region]['dns']))
-        tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
-        output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-
-        description = descriptionPrePend + ' Transit subnet AZ B'
-        transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
-        output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-
-        description = descriptionPrePend + ' Transit subnet AZ A'
-        transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
-        output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-
-        description = descriptionPrePend + ' Public subnet AZ B'
-        publicb = json.loads(requestSubnet(r['id'], 23, description, regionalSettings[region]['dns'], 1, 'last'))
-        tmp = {'id': publicb['id'], 'subnet': publicb['data'], 'description': description}
-        output['data'].append(tmp)
-        publicb_gw = json.loads(createFirstAddress(publicb['id'], 'Default gateway', 1))
-        publicb_res2 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-        publicb_res3 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-
-        description = descriptionPrePend + ' Public subnet AZ A'
-        publica = json.loads(requestSubnet(r['id'], 23, description, regionalSettings[region]['dns'], 1 , 'last'))
-        tmp = {'id': publica['id'], 'subnet': publica['data'], 'description': description}
-        output['data'].append(tmp)
-        publica_gw = json.loads(createFirstAddress(publica['id'], 'Default gateway', 1))
-        publica_res2 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-        publica_res3 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-
-        if cvpn:
-            description = descriptionPrePend + ' CVPN subnet'
-            cvpna = json.loads(requestSubnet(r['id'], 22, description, regionalSettings[region]['dns'], 0, 'last'))
-            tmp = {'id': cvpna['id'], 'subnet': cvpna['data'], 'description': description}
-            output['data'].append(tmp)
-            cvpna_gw = json.loads(createFirstAddress(cvpna['id'], 'Default gateway', 1))
-
-        output['code'] = 200
-        output['success'] = 'true'
-    else:
-        output['code'] = 500
-        output['success'] = 'false'
-    return output
-
-def createvEdgeVpc(region):
+    options = ['cvpn'] if cvpn else []
+    client = ipamclient.getClient(config)
+    trie = ipambuddy.configuredTrie(config, client, regionalSettings[region]['network'], trie)
+    return ipamscheduler.provisionLayout(client, ipamscheduler.loadLayout('sharedservices'),
+        regionalSettings[region]['network'], 'Shared Services', regionalSettings[region]['dns'], options,
+        config.get('workers', WORKERS), trie, ipamlock.getLocks(config), journal = journal, rollback = rollback,
+        guard = ipamoverlap.configuredGuard(config))
+
+def createvEdgeVpc(region, trie = None, journal = None, rollback = False):
     '''
     Create subnets for the vEdge VPC
 
     :param str region: region where we deploy the VPC
+    :param PrefixTrie trie: prefix trie of the section to plan in locally, or None
+    :param Journal journal: journal of the run, or None
+    :param bool rollback: whether to delete the created subnets again on failure
     :return: JSON object with server response
     :rtype: str
     '''
 
     global config, regionalSettings
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
-
-    descriptionPrePend = 'vEdge'
-    description = descriptionPrePend + ' VpcCidr'
-    r = json.loads(requestSubnet(regionalSettings[region]['network'], 25, description, regionalSettings[region]['dns'], 1, 'last'))
-    if r['code'] == 201:
-        description = descriptionPrePend + ' Public subnet AZ A'
-        tmp = {'id': r['id'], 'subnet': r['data'], 'description': description}
-        output['data'].append(tmp)
-    
-        description = descriptionPrePend + ' Private subnet AZ A'
-        privatea = json.loads(requestSubnet(r['id'], 28, description, regionalSettings[region]['dns']))
-        tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
-        output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
-    
-        description = descriptionPrePend + ' Private subnet AZ B'
-        privateb = json.loads(requestSubnet(r['id'], 28, description, regionalSettings[region]['dns']))
-        tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
-        output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-    
-        description = descriptionPrePend + ' Public subnet AZ A'
-        publica = json.loads(requestSubnet(r['id'], 28, description, regionalSettings[region]['dns']))
-        tmp = {'id': publica['id'], 'subnet': publica['data'], 'description': description}
-        output['data'].append(tmp)
-        publica_gw = json.loads(createFirstAddress(publica['id'], 'Default gateway', 1))
-        publica_res2 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-        publica_res3 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-    
-        description = descriptionPrePend + ' Public subnet AZ B'
-        publicb = json.loads(requestSubnet(r['id'], 28, description, regionalSettings[region]['dns']))
-        tmp = {'id': publicb['id'], 'subnet': publicb['data'], 'description': description}
-        output['data'].append(tmp)
-        publicb_gw = json.loads(createFirstAddress(publicb['id'], 'Default gateway', 1))
-        publicb_res2 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-        publicb_res3 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-    
-        description = descriptionPrePend + ' Transit subnet AZ B'
-        transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
-        output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-    
-        description = descriptionPrePend + ' Transit subnet AZ A'
-        transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
-        output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-
-        output['code'] = 200
-        output['success'] = 'true'
-    else:
-        output['code'] = 500
-        output['success'] = 'false'
-    return output
+    client = ipamclient.getClient(config)
+    trie = ipambuddy.configuredTrie(config, client, regionalSettings[region]['network'], trie)
+    return ipamscheduler.provisionLayout(client, ipamscheduler.loadLayout('vedge'),
+        regionalSettings[region]['network'], 'vEdge', regionalSettings[region]['dns'], workers = config.get('workers', WORKERS), trie = trie,
+        locks = ipamlock.getLocks(config), journal = journal, rollback = rollback, guard = ipamoverlap.configuredGuard(config))
    
 def createCfYaml(region, ipam, template, cvpn = False):
     '''
@@ -306,28 +121,21 @@ def createCfYaml(region, ipam, template, cvpn = False):
     :param str region: AWS region
     :param dict ipam_ss: Dictionary with Shared Services subnets and related information
     :param dict ipam_ve: Dictionary with vEdge subnets and related information
-    :param str template: YAML Template
+    :param str template: Template file name
     :return: YAML
     :rtype: str
     '''
 
     global config, regionalSettings
+    client = ipamclient.getClient(config)
 
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = ''
-
-    url = f"https://{config['server']}/api/{config['appid']}/tools/nameservers/{regionalSettings[region]['dns']}/"
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = client.getCached(f"tools/nameservers/{regionalSettings[region]['dns']}/")
     nameservers = r['data']['namesrv1'].split(';')
 
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{regionalSettings[region]['network']}/"
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = client.getCached(f"subnets/{regionalSettings[region]['network']}/")
     regionalCidr = r['data']['subnet'] + '/' + r['data']['mask']
 
-    tpl = Template(template)
+    tpl = ipamtemplate.getTemplate(template, config.get('templateCache'))
     tplArgs = {
         'nameservers': nameservers,
         'region': region,
@@ -362,51 +170,136 @@ def createCfYaml(region, ipam, template, cvpn = False):
         'TgMainRouteTable': regionalSettings[region]['tgwMainRouteTable'],
     }
 
-    return tpl.render (tplArgs)
+    with ipamtrace.span('render', template = template):
+        return tpl.render (tplArgs)
+
+def buildLandingZone(region, template, cvpn = False, journal = None, rollback = False):
+    '''
+    Create the Landing Zone networks of a region and render its CloudFormation YAML
+
+    :param str region: AWS region
+    :param str template: Template file name
+    :param bool cvpn: whether to add subnets for CVPN firewalls
+    :param Journal journal: journal of the run, or None
+    :param bool rollback: whether to delete the created subnets of both VPCs again when either failed
+    :return: JSON object with subnets and YAML, or the subnets, errors and rollback of each VPC
+    :rtype: dict
+    '''
+
+    global config, regionalSettings
+    regionStart = time.time()
+    output = {'code': 0, 'success': 'false'}
+    output['data'] = []
+    output['yaml'] = {}
+
+    if region in regionalSettings:
+        # The VPCs come from opposite ends of the supernet, so carve them side by side
+        with ThreadPoolExecutor(max_workers = 2) as executor:
+            ssfuture = executor.submit(createSsVpc, region, cvpn, journal = journal and journal.view('sharedservices'),
+                rollback = rollback)
+            vedgefuture = executor.submit(createvEdgeVpc, region, journal = journal and journal.view('vedge'),
+                rollback = rollback)
+        vpcs = {'sharedservices': ssfuture.result(), 'vedge': vedgefuture.result()}
+        if all(vpc['code'] == 200 for vpc in vpcs.values()):
+            output['code'] = 200
+            output['success'] = 'true'
+            output['data'].append(vpcs['sharedservices']['data'])
+            output['data'].append(vpcs['vedge']['data'])
+            output['yaml'] = createCfYaml(region, output['data'], template, cvpn)
+        else:
+            output['code'] = 500
+            output['success'] = 'false'
+            output['data'] = {'description': 'General failure trying to create networks.'}
+            output['subnets'] = {name: vpc.get('data', []) for name, vpc in vpcs.items()}
+            output['errors'] = {name: vpc.get('errors', {}) for name, vpc in vpcs.items()}
+            if rollback:
+                output['rollback'] = {name: vpc['rollback'] for name, vpc in vpcs.items() if 'rollback' in vpc}
+                if journal is not None:
+                    # Leave no half-built landing zone behind, the VPC that succeeded goes too
+                    client = ipamclient.getClient(config)
+                    trie = ipambuddy.configuredTrie(config, client, regionalSettings[region]['network'])
+                    for name in [name for name, vpc in vpcs.items() if vpc['code'] == 200]:
+                        output['rollback'][name] = ipamscheduler.rollbackLayout(client, journal.view(name),
+                            config.get('workers', WORKERS), trie)
+    else:
+        output['data'] = {'description': 'Region not defined or recognised.'}
+
+    output['time'] = time.time() - regionStart
+    return output
 
 def main():
     '''
     Main script logic
     '''
 
+    mainStart = time.time()
     loadConfig()
+    configEnd = time.time()
 
     global config, regionalSettings
 
     # Read input arguments
     argp = argparse.ArgumentParser(description = 'Create Landing Zone networks.')
-    argp.add_argument('region', type=str, help='AWS region where the networks reside.')
+    argp.add_argument('region', type=str, nargs='?', default=None, help='AWS region where the networks reside.')
     argp.add_argument('template', type=str, help='Template file name')
+    argp.add_argument('--regions', type=str, default=None, help='Comma-separated AWS regions to provision in parallel')
+    argp.add_argument('--all-regions', action='store_true', help='Provision all known regions in parallel')
     argp.add_argument('--cvpn', type=str, default='no', help='Whether to provision networks for CVPN in.')
+    argp.add_argument('--resume', type=str, default=None, help='Run ID of an earlier run to resume')
+    argp.add_argument('--rollback', action='store_true', help='Delete the created subnets again when a step fails')
+    argp.add_argument('--trace', action='store_true', help='Add timing spans to the output')
+    argp.add_argument('--trace-file', type=str, default=None, help='Write timing spans to a Chrome trace-event file')
     args = argp.parse_args()
-    region = args.region
+    if args.trace or args.trace_file:
+        ipamtrace.enable()
+        ipamtrace.startup(mainStart, starttime)
+        ipamtrace.record('config', mainStart, configEnd)
     template = args.template
     if args.cvpn == 'yes':
         cvpn = True
     else:
         cvpn = False
 
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
-    output['yaml'] = {}
-
-    if region in regionalSettings:
-        ssvpc = createSsVpc(region, cvpn)
-        if ssvpc['code'] == 200:
-            output['code'] = 200
-            output['success'] = 'true'
-            output['data'].append(ssvpc['data'])
-            output['data'].append(createvEdgeVpc(region)['data'])
-            with open(template) as infile:
-                output['yaml'] = createCfYaml(region, output['data'], infile.read(), cvpn)
-        else:
+    # A resumed run has to be for the same regions, template and options
+    header = {'region': args.region, 'regions': args.regions, 'allRegions': args.all_regions, 'template': template, 'cvpn': cvpn}
+    try:
+        journal = ipamjournal.getJournal(config, args.resume, header)
+    except IOError as e:
+        return {'code': 404, 'success': 'false', 'data': {'description': str(e)}}
+    except ValueError as e:
+        return {'code': 409, 'success': 'false', 'data': {'description': str(e)}}
+
+    if args.all_regions or args.regions:
+        # Every region has its own supernet, so the regions don't wait for each other
+        regions = list(regionalSettings) if args.all_regions else [region.strip() for region in args.regions.split(',')]
+        with ThreadPoolExecutor(max_workers = len(regions)) as executor:
+            futures = {region: executor.submit(buildLandingZone, region, template, cvpn, journal.view(region), args.rollback)
+                for region in regions}
+        output = {'code': 200, 'success': 'true', 'run': journal.runId}
+        output['data'] = {region: future.result() for region, future in futures.items()}
+        output['failed'] = [region for region, result in output['data'].items() if result['code'] != 200]
+        if output['failed']:
             output['code'] = 500
             output['success'] = 'false'
-            output['data'] = {'description': 'General failure trying to create networks.'}
+            if args.rollback:
+                # Leave nothing of the run behind, the regions that succeeded go too
+                client = ipamclient.getClient(config)
+                output['rollback'] = {region: ipamscheduler.rollbackLayout(client, journal.view(region),
+                    config.get('workers', WORKERS), ipambuddy.configuredTrie(config, client, regionalSettings[region]['network']))
+                    for region in regions if region not in output['failed']}
+    elif args.region:
+        output = buildLandingZone(args.region, template, cvpn, journal, args.rollback)
+        output['run'] = journal.runId
     else:
-        output['data'] = {'description': 'Region not defined or recognised.'}
+        output = {'code': 400, 'success': 'false', 'data': {'description': 'No region given.'}}
+
+    journal.finish(output['code'] == 200)
 
     output['time'] = time.time() - starttime
+    if args.trace:
+        output['trace'] = ipamtrace.getSpans()
+    if args.trace_file:
+        ipamtrace.writeChromeTrace(args.trace_file)
     return output
 
 if __name__ == "__main__":
@@ -28,11 +28,14 @@ __contact__ = "pvandesande@tmhcc.com"
 __license__ = "GPLv3"
 
 import sys
+import ipaddress
 import argparse
-import requests
+import ipamclient
+import ipamtemplate
+import ipamtrace
 import json
 import time
-from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor
 
 starttime = time.time()
 config = {}
@@ -54,6 +57,7 @@ regionalTGWs = {
         "eu-west-1": "tgw-0097de3283b71ced1",
         "ap-southeast-2": "tgw-0fc230fd5535b3ddf"
 }
+WORKERS = 4 # Default number of parallel address reservations
 
 def loadConfig():
     '''
@@ -87,11 +91,6 @@ def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests =
     '''
 
     global config
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{masterId}/{position}_subnet/{size}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
     payload = f"""{{
         \"description\": \"{description}\",
         \"pingSubnet\": \"0\",
@@ -99,32 +98,50 @@ def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests =
         \"nameserverId\": \"{nameserverId}\"
     }}"""
 
-    return requests.request("POST", url, headers=headers, data=payload).text
+    return ipamclient.getClient(config).request("POST", f"subnets/{masterId}/{position}_subnet/{size}/", payload).text
 
-def createFirstAddress(subnetId, description, isGateway = 0):
+def createAddress(subnetId, ip, description, isGateway = 0):
     '''
-    Create an IP address in a specific subnet
+    Create a specific IP address in a subnet
 
     :param int subnetId: ID of the subnet
-    :param str description: Human-readable description of what this subnet is used for
+    :param str ip: IP address to create
+    :param str description: Human-readable description of what this address is used for
     :param int isGateway: Define whether the device is a gateway (router)
     :return: JSON object with server response
     :rtype: str
     '''
 
     global config
-    url = f"https://{config['server']}/api/{config['appid']}/addresses/first_free/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
     payload = f"""{{
         \"subnetId\": \"{subnetId}\",
+        \"ip\": \"{ip}\",
         \"description\": \"{description}\",
         \"is_gateway\": \"{isGateway}\"
     }}"""
 
-    return requests.request("POST", url, headers=headers, data=payload).text
+    return ipamclient.getClient(config).request("POST", "addresses/", payload).text
+
+def reserveAddresses(executor, subnet, descriptions):
+    '''
+    Reserve the first addresses of a subnet on the worker pool
+
+    The first description lands on the first address (the default gateway),
+    every next description on the address after it.
+
+    :param ThreadPoolExecutor executor: Worker pool running the reservations
+    :param dict subnet: Server response of the subnet request
+    :param list descriptions: Descriptions of the addresses, gateway first
+    :return: Futures with the server responses
+    :rtype: list
+    '''
+
+    network = ipaddress.ip_network(subnet['data'])
+    futures = []
+    for offset, description in enumerate(descriptions, 1):
+        isGateway = 1 if offset == 1 else 0
+        futures.append(executor.submit(createAddress, subnet['id'], str(network[offset]), description, isGateway))
+    return futures
 
 def createSsVpc(region, cvpn):
     '''
@@ -139,6 +156,8 @@ def createSsVpc(region, cvpn):
     global config, regionalNetworks, regionalInternalDNS
     output = {'code': 0, 'success': 'false'}
     output['data'] = []
+    executor = ThreadPoolExecutor(max_workers = config.get('workers', WORKERS))
+    reservations = []
 
     descriptionPrePend = 'Shared Services'
     description = descriptionPrePend + ' VpcCidr'
@@ -151,72 +170,62 @@ def createSsVpc(region, cvpn):
         privatea = json.loads(requestSubnet(r['id'], 23, description, regionalInternalDNS[region]))
         tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
         output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privatea, ['Default gateway', 'AWS DNS', 'Reserved by AWS'])
 
         description = descriptionPrePend + ' Private subnet AZ B'
         privateb = json.loads(requestSubnet(r['id'], 23, description, regionalInternalDNS[region]))
         tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
         output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privateb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = descriptionPrePend + ' Transit subnet AZ B'
         transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
         output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, transitb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = descriptionPrePend + ' Transit subnet AZ A'
         transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
         output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, transita, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = descriptionPrePend + ' Public subnet AZ B'
         publicb = json.loads(requestSubnet(r['id'], 23, description, regionalInternalDNS[region], 1, 'last'))
         tmp = {'id': publicb['id'], 'subnet': publicb['data'], 'description': description}
         output['data'].append(tmp)
-        publicb_gw = json.loads(createFirstAddress(publicb['id'], 'Default gateway', 1))
-        publicb_res2 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-        publicb_res3 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, publicb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = descriptionPrePend + ' Public subnet AZ A'
         publica = json.loads(requestSubnet(r['id'], 23, description, regionalInternalDNS[region], 1 , 'last'))
         tmp = {'id': publica['id'], 'subnet': publica['data'], 'description': description}
         output['data'].append(tmp)
-        publica_gw = json.loads(createFirstAddress(publica['id'], 'Default gateway', 1))
-        publica_res2 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-        publica_res3 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, publica, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         if cvpn:
             description = descriptionPrePend + ' Public CVPN subnet AZ B'
             cvpnb = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region], 0, 'last'))
             tmp = {'id': cvpnb['id'], 'subnet': cvpnb['data'], 'description': description}
             output['data'].append(tmp)
-            cvpnb_gw = json.loads(createFirstAddress(cvpnb['id'], 'Default gateway', 1))
-            cvpnb_res2 = json.loads(createFirstAddress(cvpnb['id'], 'Reserved by AWS'))
-            cvpnb_res3 = json.loads(createFirstAddress(cvpnb['id'], 'Reserved by AWS'))
+            reservations += reserveAddresses(executor, cvpnb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
             description = descriptionPrePend + ' Public CVPN subnet AZ A'
             cvpna = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region], 0 , 'last'))
             tmp = {'id': cvpna['id'], 'subnet': cvpna['data'], 'description': description}
             output['data'].append(tmp)
-            cvpna_gw = json.loads(createFirstAddress(cvpna['id'], 'Default gateway', 1))
-            cvpna_res2 = json.loads(createFirstAddress(cvpna['id'], 'Reserved by AWS'))
-            cvpna_res3 = json.loads(createFirstAddress(cvpna['id'], 'Reserved by AWS'))
+            reservations += reserveAddresses(executor, cvpna, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
-        output['code'] = 200
-        output['success'] = 'true'
+        # Wait for all address reservations before reporting the result
+        if all(json.loads(future.result())['code'] == 201 for future in reservations):
+            output['code'] = 200
+            output['success'] = 'true'
+        else:
+            output['code'] = 500
+            output['success'] = 'false'
     else:
         output['code'] = 500
         output['success'] = 'false'
+    executor.shutdown()
     return output
 
 def createvEdgeVpc(region):
@@ -231,6 +240,8 @@ def createvEdgeVpc(region):
     global config, regionalNetworks, regionalInternalDNS
     output = {'code': 0, 'success': 'false'}
     output['data'] = []
+    executor = ThreadPoolExecutor(max_workers = config.get('workers', WORKERS))
+    reservations = []
 
     descriptionPrePend = 'vEdge'
     description = descriptionPrePend + ' VpcCidr'
@@ -244,71 +255,61 @@ def createvEdgeVpc(region):
         privatea = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
         output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privatea, ['Default gateway', 'AWS DNS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Private subnet AZ B'
         privateb = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
         output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privateb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Public subnet AZ A'
         publica = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': publica['id'], 'subnet': publica['data'], 'description': description}
         output['data'].append(tmp)
-        publica_gw = json.loads(createFirstAddress(publica['id'], 'Default gateway', 1))
-        publica_res2 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
-        publica_res3 = json.loads(createFirstAddress(publica['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, publica, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Public subnet AZ B'
         publicb = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': publicb['id'], 'subnet': publicb['data'], 'description': description}
         output['data'].append(tmp)
-        publicb_gw = json.loads(createFirstAddress(publicb['id'], 'Default gateway', 1))
-        publicb_res2 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
-        publicb_res3 = json.loads(createFirstAddress(publicb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, publicb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Temp subnet AZ A'
         tempa = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': tempa['id'], 'subnet': tempa['data'], 'description': description}
         output['data'].append(tmp)
-        tempa_gw = json.loads(createFirstAddress(tempa['id'], 'Default gateway', 1))
-        tempa_res2 = json.loads(createFirstAddress(tempa['id'], 'Reserved by AWS'))
-        tempa_res3 = json.loads(createFirstAddress(tempa['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, tempa, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Temp subnet AZ B'
         tempb = json.loads(requestSubnet(r['id'], 28, description, regionalInternalDNS[region]))
         tmp = {'id': tempb['id'], 'subnet': tempb['data'], 'description': description}
         output['data'].append(tmp)
-        tempb_gw = json.loads(createFirstAddress(tempb['id'], 'Default gateway', 1))
-        tempb_res2 = json.loads(createFirstAddress(tempb['id'], 'Reserved by AWS'))
-        tempb_res3 = json.loads(createFirstAddress(tempb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, tempb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Transit subnet AZ B'
         transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
         output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, transitb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
     
         description = descriptionPrePend + ' Transit subnet AZ A'
         transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
         output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, transita, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
-        output['code'] = 200
-        output['success'] = 'true'
+        # Wait for all address reservations before reporting the result
+        if all(json.loads(future.result())['code'] == 201 for future in reservations):
+            output['code'] = 200
+            output['success'] = 'true'
+        else:
+            output['code'] = 500
+            output['success'] = 'false'
     else:
         output['code'] = 500
         output['success'] = 'false'
+    executor.shutdown()
     return output
    
 def createCfYaml(region, ipam, template, cvpn = False):
@@ -318,23 +319,16 @@ def createCfYaml(region, ipam, template, cvpn = False):
     :param str region: AWS region
     :param dict ipam_ss: Dictionary with Shared Services subnets and related information
     :param dict ipam_ve: Dictionary with vEdge subnets and related information
-    :param str template: YAML Template
+    :param str template: Template file name
     :return: YAML
     :rtype: str
     '''
 
     global config, regionalInternalDNS, regionalTGWs
 
-    url = f"https://{config['server']}/api/{config['appid']}/tools/nameservers/{regionalInternalDNS[region]}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = ''
-
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = ipamclient.getClient(config).getCached(f"tools/nameservers/{regionalInternalDNS[region]}/")
     nameservers = r['data']['namesrv1'].split(';')
-    tpl = Template(template)
+    tpl = ipamtemplate.getTemplate(template, config.get('templateCache'))
     tplArgs = {
         'nameservers': nameservers,
         'region': region,
@@ -384,7 +378,9 @@ def main():
     Main script logic
     '''
 
+    mainStart = time.time()
     loadConfig()
+    configEnd = time.time()
 
     global config
 
@@ -393,7 +389,13 @@ def main():
     argp.add_argument('region', type=str, help='AWS region where the networks reside.')
     argp.add_argument('template', type=str, help='Template file name')
     argp.add_argument('--cvpn', type=str, default='no', help='Whether to provision networks for CVPN in.')
+    argp.add_argument('--trace', action='store_true', help='Add timing spans to the output')
+    argp.add_argument('--trace-file', type=str, default=None, help='Write timing spans to a Chrome trace-event file')
     args = argp.parse_args()
+    if args.trace or args.trace_file:
+        ipamtrace.enable()
+        ipamtrace.startup(mainStart, starttime)
+        ipamtrace.record('config', mainStart, configEnd)
     region = args.region
     template = args.template
     if args.cvpn == 'yes':
@@ -412,8 +414,7 @@ def main():
             output['success'] = 'true'
             output['data'].append(ssvpc['data'])
             output['data'].append(createvEdgeVpc(region)['data'])
-            with open(template) as infile:
-                output['yaml'] = createCfYaml(region, output['data'], infile.read(), cvpn)
+            output['yaml'] = createCfYaml(region, output['data'], template, cvpn)
         else:
             output['code'] = 500
             output['success'] = 'false'
@@ -422,6 +423,10 @@ def main():
         output['data'] = {'description': 'Region not defined or recognised.'}
 
     output['time'] = time.time() - starttime
+    if args.trace:
+        output['trace'] = ipamtrace.getSpans()
+    if args.trace_file:
+        ipamtrace.writeChromeTrace(args.trace_file)
     return output
 
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+""" This script provisions a batch of spokes from a manifest.
+
+This script does the same work as spoke-dev.py for every row of a manifest,
+in a single process sharing the configuration, the compiled templates and
+the pooled connections to phpIPAM.
+
+The manifest is a CSV file with the columns region, account and template, or
+a JSON file with a list of objects with the same keys. The template may be
+left out when a default template is given on the command line.
+
+Spokes under the same regional supernet are provisioned one after the other,
+so their allocations never race each other. Different supernets are
+provisioned in parallel. Every spoke's output, including its buildspec and
+its own time, is written to a single JSON report.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import argparse
+import csv
+import json
+import time
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spoke-dev.py')
+REGIONS = 4 # Default number of supernets provisioned in parallel
+
+spokedev = None
+
+def loadManifest(filename, template = None):
+    '''
+    Read the rows of a manifest
+
+    :param str filename: CSV or JSON manifest
+    :param str template: Template file name for rows without one
+    :return: Rows with region, account and template
+    :rtype: list
+    '''
+
+    with open(filename, 'r', encoding='utf-8-sig') as manifest_file:
+        if filename.endswith('.json'):
+            rows = json.load(manifest_file)
+        else:
+            rows = list(csv.DictReader(manifest_file))
+
+    for row in rows:
+        if not row.get('template'):
+            row['template'] = template
+    return rows
+
+def provisionGroup(rows):
+    '''
+    Provision the spokes under one regional supernet, one after the other
+
+    :param list rows: Numbered manifest rows
+    :return: Output by row number
+    :rtype: dict
+    '''
+
+    outputs = {}
+    for number, row in rows:
+        starttime = time.time()
+        try:
+            if row['template'] is None:
+                raise ValueError('No template given.')
+            output = spokedev.buildSpoke(row['region'], row['account'], row['template'])
+        except Exception as e:
+            output = {'code': 500, 'success': 'false', 'data': {'description': str(e)}}
+        output['region'] = row['region']
+        output['account'] = row['account']
+        output['time'] = time.time() - starttime
+        outputs[number] = output
+    return outputs
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    global spokedev
+
+    starttime = time.time()
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Provision a batch of spokes from a manifest and report on all of them.')
+    argp.add_argument('manifest', type=str, help='CSV or JSON manifest with region, account and template')
+    argp.add_argument('--template', type=str, default=None, help='Template file name for rows without one')
+    argp.add_argument('--report', type=str, default='spoke-batch.json', help='JSON report to write')
+    argp.add_argument('--regions', type=int, default=REGIONS, help='Number of supernets provisioned in parallel')
+    argp.add_argument('--script', type=str, default=SCRIPT, help='spoke-dev.py to load')
+    args = argp.parse_args()
+
+    spec = importlib.util.spec_from_file_location('spokedev', args.script)
+    spokedev = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(spokedev)
+    spokedev.loadConfig()
+
+    rows = loadManifest(args.manifest, args.template)
+
+    # Group the rows by regional supernet, unknown regions fail on their own
+    groups = {}
+    for number, row in enumerate(rows):
+        settings = spokedev.regionalSettings.get(row['region'])
+        key = settings['network'] if settings else row['region']
+        groups.setdefault(key, []).append((number, row))
+
+    outputs = {}
+    with ThreadPoolExecutor(max_workers = args.regions) as executor:
+        for result in executor.map(provisionGroup, groups.values()):
+            outputs.update(result)
+
+    report = {'code': 200, 'success': 'true'}
+    report['data'] = [outputs[number] for number in range(len(rows))]
+    report['failed'] = [output['account'] for output in report['data'] if output['code'] != 200]
+    if report['failed']:
+        report['code'] = 500
+        report['success'] = 'false'
+    report['time'] = time.time() - starttime
+
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent = 2)
+
+    return {
+        'code': report['code'],
+        'success': report['success'],
+        'spokes': len(rows),
+        'failed': report['failed'],
+        'time': report['time']
+    }
+
+if __name__ == "__main__":
+    print(json.dumps(main()))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" This daemon serves spoke requests from a long-running process.
+
+This daemon does the same work as spoke-dev.py, but keeps the interpreter,
+the configuration, the compiled templates and the pooled connections to
+phpIPAM warm between requests. spoke-dev.php talks to it over a Unix socket.
+
+Every request is a single line of JSON with the region, the account and the
+template file name, e.g.:
+    {"region": "eu-west-1", "account": "Testing123", "template": "/var/netops/aws/spoke-dev.tf"}
+
+The response is the same single line of JSON spoke-dev.py prints. Only the
+templates given on the command line are served.
+
+When the optional 'spokePool' key in config.json holds a number, a
+background thread keeps that many pre-carved spokes ready in every region
+(see ipampool). It tops the pools up after every request and every
+--refill-interval seconds.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import argparse
+import json
+import sys
+import time
+import threading
+import socketserver
+import importlib.util
+import ipamtemplate
+
+SOCKET = '/run/netops/spoke-dev.sock' # Default socket path
+REFILL = 300 # Default seconds between pool refills
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spoke-dev.py')
+
+spokedev = None
+templates = set()
+refill = threading.Event()
+
+class SpokeHandler(socketserver.StreamRequestHandler):
+    '''
+    Handle one spoke request per connection
+    '''
+
+    def handle(self):
+        starttime = time.time()
+        try:
+            request = json.loads(self.rfile.readline())
+            template = request['template']
+            if template not in templates:
+                raise KeyError(template)
+        except (ValueError, KeyError, TypeError):
+            output = {'code': 400, 'success': 'false', 'data': {'description': 'Invalid request or template.'}}
+        else:
+            try:
+                output = spokedev.buildSpoke(request['region'], request['account'], template)
+            except Exception as e:
+                output = {'code': 500, 'success': 'false', 'data': {'description': str(e)}}
+
+        output['time'] = time.time() - starttime
+        self.wfile.write((json.dumps(output) + '\n').encode('utf-8'))
+        refill.set()
+
+class SpokeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Serve every connection in its own thread
+    '''
+
+    daemon_threads = True
+
+def refillPools(interval):
+    '''
+    Keep the spoke pools of all regions topped up, runs in its own thread
+
+    :param float interval: Seconds between refills when there are no requests
+    '''
+
+    while True:
+        refill.clear()
+        for region in spokedev.regionalSettings:
+            try:
+                r = spokedev.refillPool(region)
+            except Exception as e:
+                r = {'errors': [str(e)]}
+            if r['errors'] or r.get('released'):
+                print(json.dumps({'region': region, 'pool': r}), file = sys.stderr)
+        refill.wait(interval)
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    global spokedev, templates
+
+    # Read input arguments
+    argp = argparse.ArgumentParser(description = 'Serve spoke requests from a long-running process.')
+    argp.add_argument('templates', type=str, nargs='+', help='Template file names to serve')
+    argp.add_argument('--socket', type=str, default=SOCKET, help='Unix socket to listen on')
+    argp.add_argument('--script', type=str, default=SCRIPT, help='spoke-dev.py to load')
+    argp.add_argument('--refill-interval', type=float, default=REFILL, help='Seconds between spoke pool refills')
+    args = argp.parse_args()
+
+    spec = importlib.util.spec_from_file_location('spokedev', args.script)
+    spokedev = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(spokedev)
+    spokedev.loadConfig()
+
+    # Compile the served templates up front, they are recompiled when they change
+    for filename in args.templates:
+        filename = os.path.abspath(filename)
+        ipamtemplate.getTemplate(filename, spokedev.config.get('templateCache'))
+        templates.add(filename)
+
+    if spokedev.config.get('spokePool'):
+        threading.Thread(target = refillPools, args = (args.refill_interval,), daemon = True).start()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    with SpokeServer(args.socket, SpokeHandler) as server:
+        os.chmod(args.socket, 0o660)
+        server.serve_forever()
+
+if __name__ == "__main__":
+    main()
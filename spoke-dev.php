@@ -37,7 +37,21 @@ function buildspec($region, $account, $format) {
       $template = '/var/netops/aws/spoke-dev.tf';
       break;
   }
-  $cmd = sprintf('/usr/local/bin/spoke-dev.py %s %s %s', $region, $account, $template);
+
+  // Prefer the warm spoke-daemon.py, only start a new process when it isn't running
+  $socket = @stream_socket_client('unix:///run/netops/spoke-dev.sock', $errno, $errstr, 1);
+  if ($socket !== false) {
+    stream_set_timeout($socket, 120);
+    fwrite($socket, json_encode(array('region' => $region, 'account' => $account, 'template' => $template)) . "\n");
+    $response = fgets($socket);
+    fclose($socket);
+    if ($response === false) {
+      return sprintf("Error %d", 500);
+    }
+    return rtrim($response);
+  }
+
+  $cmd = sprintf('/usr/local/bin/spoke-dev.py %s %s %s', escapeshellarg($region), escapeshellarg($account), escapeshellarg($template));
   exec($cmd, $output, $retval);
   if ($retval <> 0) {
     return sprintf("Error %d", $retval);
@@ -5,6 +5,10 @@ This script requests a spoke supernet based on the AWS region and
 updates phpIPAM accordingly, including the creation of further subnets and
 reserving IP addresses.
 
+When the optional 'spokePool' key in config.json is set, a /22 spoke is
+claimed from the warm pool of the region first (see ipampool), and only
+carved when the pool is empty. spoke-daemon.py keeps the pools topped up.
+
 --
 
 This program is free software: you can redistribute it and/or modify it under
@@ -25,62 +29,25 @@ __license__ = "GPLv3"
 
 import sys
 import argparse
-import requests
+import ipamclient
+import ipamtrace
+import ipamlock
+import ipamjournal
+import ipambuddy
+import ipamoverlap
+import ipampool
+import ipamtemplate
+import ipamscheduler
+import ipamregions
 import json
 import time
-from jinja2 import Template
 
 starttime = time.time()
 config = {}
-regionalSettings = {
-    "ap-southeast-2": {
-        "network": 106,
-        "dns": 2,
-        "tgwId": "tgw-0fc230fd5535b3ddf",
-        "tgwInspectionAttachment": "",
-        "tgwMainRouteTable": "",
-        "tgwInspectionRouteTable": "",
-        "dhcpOptions": ""
-    },
-    "us-east-1": {
-        "network": 74,
-        "dns": 2,
-        "tgwId": "tgw-0031a74e3b340a704",
-        "tgwInspectionAttachment": "",
-        "tgwMainRouteTable": "",
-        "tgwInspectionRouteTable": "",
-        "dhcpOptions": ""
-    },
-    "eu-west-1": {
-        "network": 76,
-        "dns": 3,
-        "tgwId": "tgw-0031a74e3b340a704",
-        "tgwInspectionAttachment": "",
-        "tgwMainRouteTable": "",
-        "tgwInspectionRouteTable": "",
-        "dhcpOptions": ""
-    },
-    "eu-west-2": {
-        "network": 75,
-        "dns": 3,
-        "tgwId": "tgw-000816d04ea49d358",
-        "tgwInspectionAttachment": "",
-        "tgwMainRouteTable": "",
-        "tgwInspectionRouteTable": "",
-        "dhcpOptions": ""
-    },
-    "eu-central-1": {
-        "network": 918,
-        "dns": 3,
-        "tgwId": "tgw-06173001949ff1ea2",
-        "tgwInspectionAttachment": "tgw-attach-068d1df133ade8cac",
-        "tgwMainRouteTable": "tgw-rtb-05f55e0d134692083",
-        "tgwInspectionRouteTable": "tgw-rtb-05f55e0d134692083",
-        "dhcpOptions": "dopt-0a11e07c9afdbb7d8"
-    }
-}
+regionalSettings = ipamregions.SPOKES
 
 SPOKESIZE = 22 # Supernet size for a standard spoke
+WORKERS = 4 # Default number of parallel API calls
 
 def loadConfig():
     '''
@@ -99,117 +66,54 @@ def loadConfig():
         except IOError:
             sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
 
-def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests = 1, position = 'first'):
-    '''
-    Request a subnet from a supernet and update its details
-
-    :param int masterId: Subnet ID of the supernet
-    :param int size: Size of the requested subnet in bits (1 - 31)
-    :param str description: Human-readable description of what this subnet is used for
-    :param int nameserverId: ID of nameserver set in phpIPAM
-    :param int allowRequests: Define whether IP addresses may be requested from this subnet
-    :param str position: Where in the supernet sits the requested subnet
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{masterId}/{position}_subnet/{size}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"description\": \"{description}\",
-        \"pingSubnet\": \"0\",
-        \"allowRequests\": \"{allowRequests}\",
-        \"nameserverId\": \"{nameserverId}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createFirstAddress(subnetId, description, isGateway = 0):
-    '''
-    Create an IP address in a specific subnet
-
-    :param int subnetId: ID of the subnet
-    :param str description: Human-readable description of what this subnet is used for
-    :param int isGateway: Define whether the device is a gateway (router)
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/addresses/first_free/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"subnetId\": \"{subnetId}\",
-        \"description\": \"{description}\",
-        \"is_gateway\": \"{isGateway}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createSpoke(region, account, size = 22):
+def createSpoke(region, account, size = 22, trie = None, journal = None, rollback = False):
     '''
     Calculate and create subnets plus reserved IP addresses
 
     :param str region: AWS region
     :param str account: Name of the account
     :param int size: CIDR size of the VPC
+    :param PrefixTrie trie: Prefix trie of the section to plan in locally, or None
+    :param Journal journal: Journal of the run, or None
+    :param bool rollback: Whether to delete the created subnets again on failure
     :return: JSON object with server response
     :rtype: str
     '''
     global config, regionalSettings 
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = size
+    client = ipamclient.getClient(config)
+    locks = ipamlock.getLocks(config)
+    guard = ipamoverlap.configuredGuard(config)
+
+    # A resumed run carries on with the tree it started
+    if config.get('spokePool') and size == SPOKESIZE and (journal is None or not journal.state()[0]):
+        output = ipampool.claimSpoke(client, locks, layout, regionalSettings[region]['network'], account,
+            config.get('workers', WORKERS), guard)
+        if output is not None:
+            return output
+
+    trie = ipambuddy.configuredTrie(config, client, regionalSettings[region]['network'], trie)
+    return ipamscheduler.provisionLayout(client, layout, regionalSettings[region]['network'],
+        account, regionalSettings[region]['dns'], workers = config.get('workers', WORKERS), trie = trie,
+        locks = locks, journal = journal, rollback = rollback, guard = guard)
+
+def refillPool(region):
+    '''
+    Top up the warm pool of spokes of a region
 
-    description = account + ' VpcCidr'
-    r = json.loads(requestSubnet(regionalSettings[region]['network'], size, description, regionalSettings[region]['dns']))
-    if r['code'] == 201:
-        tmp = {'id': r['id'], 'subnet': r['data'], 'description': description}
-        output['data'].append(tmp)
-
-        description = account + ' Private subnet AZ A'
-        privatea = json.loads(requestSubnet(r['id'], 24, description, regionalSettings[region]['dns']))
-        tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
-        output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
-
-        description = account + ' Private subnet AZ B'
-        privateb = json.loads(requestSubnet(r['id'], 24, description, regionalSettings[region]['dns']))
-        tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
-        output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-
-        description = account + ' Transit subnet AZ B'
-        transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
-        output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-
-        description = account + ' Transit subnet AZ A'
-        transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
-        output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        output['code'] = 200
-        output['success'] = 'true'
-    else:
-        output['code'] = 500
-        output['success'] = 'false'
-    return output
+    :param str region: AWS region
+    :return: Number of spokes added and error messages
+    :rtype: dict
+    '''
+
+    global config, regionalSettings
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = SPOKESIZE
+    client = ipamclient.getClient(config)
+    return ipampool.refillPool(client, ipamlock.getLocks(config), layout, regionalSettings[region]['network'],
+        regionalSettings[region]['dns'], int(config.get('spokePool', 0)), config.get('workers', WORKERS),
+        ipambuddy.configuredTrie(config, client, regionalSettings[region]['network']), ipamoverlap.configuredGuard(config))
 
 def renderTemplate(region, account, ipam, template):
     '''
@@ -218,49 +122,80 @@ def renderTemplate(region, account, ipam, template):
     :param str region: AWS region
     :param str account: Account name
     :param str ipam: Dictionary with subnets and related information
-    :param str template: Template file
+    :param str template: Template file name
     :return: string
     :rtype: str
     '''
 
     global config, regionalSettings 
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = ''
-
-    url = f"https://{config['server']}/api/{config['appid']}/tools/nameservers/{regionalSettings[region]['dns']}/"
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = ipamclient.getClient(config).getCached(f"tools/nameservers/{regionalSettings[region]['dns']}/")
     nameservers = r['data']['namesrv1'].split(';')
 
-    tpl = Template(template)
-    return tpl.render (
-        nameservers = nameservers,
-        account = account,
-        region = region,
-        vpcCidr = ipam['data'][0]['subnet'],
-        privateAIp = ipam['data'][1]['subnet'],
-        privateADescription = ipam['data'][1]['description'],
-        privateBIp = ipam['data'][2]['subnet'],
-        privateBDescription = ipam['data'][2]['description'],
-        transitBIp = ipam['data'][3]['subnet'],
-        transitBDescription = ipam['data'][3]['description'],
-        transitAIp = ipam['data'][4]['subnet'],
-        transitADescription = ipam['data'][4]['description'],
-        transitGatewayId = regionalSettings[region]['tgwId'],
-        transitGatewayInspectionAttachment = regionalSettings[region]['tgwInspectionAttachment'],
-        transitGatewayMainRouteTable = regionalSettings[region]['tgwMainRouteTable'],
-        transitGatewayInspectionRouteTable = regionalSettings[region]['tgwInspectionRouteTable'],
-        dhcpOptionsId = regionalSettings[region]['dhcpOptions']
-    )
+    tpl = ipamtemplate.getTemplate(template, config.get('templateCache'))
+    with ipamtrace.span('render', template = template):
+        return tpl.render (
+            nameservers = nameservers,
+            account = account,
+            region = region,
+            vpcCidr = ipam['data'][0]['subnet'],
+            privateAIp = ipam['data'][1]['subnet'],
+            privateADescription = ipam['data'][1]['description'],
+            privateBIp = ipam['data'][2]['subnet'],
+            privateBDescription = ipam['data'][2]['description'],
+            transitBIp = ipam['data'][3]['subnet'],
+            transitBDescription = ipam['data'][3]['description'],
+            transitAIp = ipam['data'][4]['subnet'],
+            transitADescription = ipam['data'][4]['description'],
+            transitGatewayId = regionalSettings[region]['tgwId'],
+            transitGatewayInspectionAttachment = regionalSettings[region]['tgwInspectionAttachment'],
+            transitGatewayMainRouteTable = regionalSettings[region]['tgwMainRouteTable'],
+            transitGatewayInspectionRouteTable = regionalSettings[region]['tgwInspectionRouteTable'],
+            dhcpOptionsId = regionalSettings[region]['dhcpOptions']
+        )
+
+def buildSpoke(region, account, template, journal = None, rollback = False):
+    '''
+    Create the spoke and render its buildspec
+
+    :param str region: AWS region
+    :param str account: Account name
+    :param str template: Template file name
+    :param Journal journal: Journal of the run, or None
+    :param bool rollback: Whether to delete the created subnets again on failure
+    :return: JSON object with subnets and buildspec
+    :rtype: dict
+    '''
+
+    global regionalSettings
+    output = {'code': 0, 'success': 'false'}
+    output['data'] = []
+
+    if region in regionalSettings:
+        ipam = createSpoke(region, account, SPOKESIZE, journal = journal, rollback = rollback)
+        if ipam['code'] == 200:
+            output['code'] = 200
+            output['success'] = 'true'
+            output['data'] = ipam['data']
+            output['buildspec'] = renderTemplate(region, account, ipam, template)
+        else:
+            output['code'] = 500
+            output['success'] = 'false'
+            output['errors'] = ipam.get('errors', {})
+            if 'rollback' in ipam:
+                output['rollback'] = ipam['rollback']
+    else:
+        output['data'] = {'description': 'Region not defined or recognised.'}
+
+    return output
 
 def main():
     '''
     Main script logic
     '''
 
+    mainStart = time.time()
     loadConfig()
+    configEnd = time.time()
 
     global config, regionalSettings
 
@@ -269,29 +204,35 @@ def main():
     argp.add_argument('region', type=str, help='AWS region where the spoke resides')
     argp.add_argument('account', type=str, help='Account name')
     argp.add_argument('template', type=str, help='Template file name')
+    argp.add_argument('--resume', type=str, default=None, help='Run ID of an earlier run to resume')
+    argp.add_argument('--rollback', action='store_true', help='Delete the created subnets again when a step fails')
+    argp.add_argument('--trace', action='store_true', help='Add timing spans to the output')
+    argp.add_argument('--trace-file', type=str, default=None, help='Write timing spans to a Chrome trace-event file')
     args = argp.parse_args()
+    if args.trace or args.trace_file:
+        ipamtrace.enable()
+        ipamtrace.startup(mainStart, starttime)
+        ipamtrace.record('config', mainStart, configEnd)
     region = args.region
     account = args.account
     template = args.template
 
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
+    try:
+        journal = ipamjournal.getJournal(config, args.resume, {'region': region, 'account': account, 'template': template})
+    except IOError as e:
+        return {'code': 404, 'success': 'false', 'data': {'description': str(e)}}
+    except ValueError as e:
+        return {'code': 409, 'success': 'false', 'data': {'description': str(e)}}
 
-    if region in regionalSettings:
-        ipam = createSpoke(region, account, SPOKESIZE)
-        if ipam['code'] == 200:
-            output['code'] = 200
-            output['success'] = 'true'
-            output['data'] = ipam['data']
-            with open(template) as infile:
-                output['buildspec'] = renderTemplate(region, account, ipam, infile.read())
-        else:
-            output['code'] = 500
-            output['success'] = 'false'
-    else:
-        output['data'] = {'description': 'Region not defined or recognised.'}
+    output = buildSpoke(region, account, template, journal, args.rollback)
+    output['run'] = journal.runId
+    journal.finish(output['code'] == 200)
 
     output['time'] = time.time() - starttime
+    if args.trace:
+        output['trace'] = ipamtrace.getSpans()
+    if args.trace_file:
+        ipamtrace.writeChromeTrace(args.trace_file)
     return output
 
 if __name__ == "__main__":
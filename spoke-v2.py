@@ -25,10 +25,16 @@ __license__ = "GPLv3"
 
 import sys
 import argparse
-import requests
+import ipamclient
+import ipamtrace
+import ipamlock
+import ipamjournal
+import ipambuddy
+import ipamoverlap
+import ipamtemplate
+import ipamscheduler
 import json
 import time
-from jinja2 import Template
 
 starttime = time.time()
 config = {}
@@ -81,6 +87,7 @@ regionalSettings = {
 }
 
 SPOKESIZE = 22 # Supernet size for a standard spoke
+WORKERS = 4 # Default number of parallel API calls
 
 def loadConfig():
     '''
@@ -99,117 +106,27 @@ def loadConfig():
         except IOError:
             sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
 
-def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests = 1, position = 'first'):
-    '''
-    Request a subnet from a supernet and update its details
-
-    :param int masterId: Subnet ID of the supernet
-    :param int size: Size of the requested subnet in bits (1 - 31)
-    :param str description: Human-readable description of what this subnet is used for
-    :param int nameserverId: ID of nameserver set in phpIPAM
-    :param int allowRequests: Define whether IP addresses may be requested from this subnet
-    :param str position: Where in the supernet sits the requested subnet
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{masterId}/{position}_subnet/{size}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"description\": \"{description}\",
-        \"pingSubnet\": \"0\",
-        \"allowRequests\": \"{allowRequests}\",
-        \"nameserverId\": \"{nameserverId}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createFirstAddress(subnetId, description, isGateway = 0):
-    '''
-    Create an IP address in a specific subnet
-
-    :param int subnetId: ID of the subnet
-    :param str description: Human-readable description of what this subnet is used for
-    :param int isGateway: Define whether the device is a gateway (router)
-    :return: JSON object with server response
-    :rtype: str
-    '''
-
-    global config
-    url = f"https://{config['server']}/api/{config['appid']}/addresses/first_free/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = f"""{{
-        \"subnetId\": \"{subnetId}\",
-        \"description\": \"{description}\",
-        \"is_gateway\": \"{isGateway}\"
-    }}"""
-
-    return requests.request("POST", url, headers=headers, data=payload).text
-
-def createSpoke(region, account, size = 22):
+def createSpoke(region, account, size = 22, trie = None, journal = None, rollback = False):
     '''
     Calculate and create subnets plus reserved IP addresses
 
     :param str region: AWS region
     :param str account: Name of the account
     :param int size: CIDR size of the VPC
+    :param PrefixTrie trie: Prefix trie of the section to plan in locally, or None
+    :param Journal journal: Journal of the run, or None
+    :param bool rollback: Whether to delete the created subnets again on failure
     :return: JSON object with server response
     :rtype: str
     '''
     global config, regionalSettings 
-    output = {'code': 0, 'success': 'false'}
-    output['data'] = []
-
-    description = account + ' VpcCidr'
-    r = json.loads(requestSubnet(regionalSettings[region]['network'], size, description, regionalSettings[region]['dns']))
-    if r['code'] == 201:
-        tmp = {'id': r['id'], 'subnet': r['data'], 'description': description}
-        output['data'].append(tmp)
-
-        description = account + ' Private subnet AZ A'
-        privatea = json.loads(requestSubnet(r['id'], 24, description, regionalSettings[region]['dns']))
-        tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
-        output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
-
-        description = account + ' Private subnet AZ B'
-        privateb = json.loads(requestSubnet(r['id'], 24, description, regionalSettings[region]['dns']))
-        tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
-        output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-
-        description = account + ' Transit subnet AZ B'
-        transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
-        output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-
-        description = account + ' Transit subnet AZ A'
-        transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
-        tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
-        output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        output['code'] = 200
-        output['success'] = 'true'
-    else:
-        output['code'] = 500
-        output['success'] = 'false'
-    return output
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = size
+    client = ipamclient.getClient(config)
+    trie = ipambuddy.configuredTrie(config, client, regionalSettings[region]['network'], trie)
+    return ipamscheduler.provisionLayout(client, layout, regionalSettings[region]['network'],
+        account, regionalSettings[region]['dns'], workers = config.get('workers', WORKERS), trie = trie,
+        locks = ipamlock.getLocks(config), journal = journal, rollback = rollback, guard = ipamoverlap.configuredGuard(config))
 
 def createCfYaml(region, account, ipam, template):
     '''
@@ -218,48 +135,44 @@ def createCfYaml(region, account, ipam, template):
     :param str region: AWS region
     :param str account: Account name
     :param str ipam: Dictionary with subnets and related information
-    :param str template: YAML Template
+    :param str template: Template file name
     :return: YAML
     :rtype: str
     '''
 
     global config, regionalSettings 
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = ''
-
-    url = f"https://{config['server']}/api/{config['appid']}/tools/nameservers/{regionalSettings[region]['dns']}/"
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = ipamclient.getClient(config).getCached(f"tools/nameservers/{regionalSettings[region]['dns']}/")
     nameservers = r['data']['namesrv1'].split(';')
 
-    tpl = Template(template)
-    return tpl.render (
-        nameservers = nameservers,
-        account = account,
-        vpcCidr = ipam['data'][0]['subnet'],
-        privateAIp = ipam['data'][1]['subnet'],
-        privateADescription = ipam['data'][1]['description'],
-        privateBIp = ipam['data'][2]['subnet'],
-        privateBDescription = ipam['data'][2]['description'],
-        transitBIp = ipam['data'][3]['subnet'],
-        transitBDescription = ipam['data'][3]['description'],
-        transitAIp = ipam['data'][4]['subnet'],
-        transitADescription = ipam['data'][4]['description'],
-        transitGatewayId = regionalSettings[region]['tgwId'],
-        transitGatewayInspectionAttachment = regionalSettings[region]['tgwInspectionAttachment'],
-        transitGatewayMainRouteTable = regionalSettings[region]['tgwMainRouteTable'],
-        transitGatewayInspectionRouteTable = regionalSettings[region]['tgwInspectionRouteTable'],
-        dhcpOptionsId = regionalSettings[region]['dhcpOptions']
-    )
+    tpl = ipamtemplate.getTemplate(template, config.get('templateCache'))
+    with ipamtrace.span('render', template = template):
+        return tpl.render (
+            nameservers = nameservers,
+            account = account,
+            vpcCidr = ipam['data'][0]['subnet'],
+            privateAIp = ipam['data'][1]['subnet'],
+            privateADescription = ipam['data'][1]['description'],
+            privateBIp = ipam['data'][2]['subnet'],
+            privateBDescription = ipam['data'][2]['description'],
+            transitBIp = ipam['data'][3]['subnet'],
+            transitBDescription = ipam['data'][3]['description'],
+            transitAIp = ipam['data'][4]['subnet'],
+            transitADescription = ipam['data'][4]['description'],
+            transitGatewayId = regionalSettings[region]['tgwId'],
+            transitGatewayInspectionAttachment = regionalSettings[region]['tgwInspectionAttachment'],
+            transitGatewayMainRouteTable = regionalSettings[region]['tgwMainRouteTable'],
+            transitGatewayInspectionRouteTable = regionalSettings[region]['tgwInspectionRouteTable'],
+            dhcpOptionsId = regionalSettings[region]['dhcpOptions']
+        )
 
 def main():
     '''
     Main script logic
     '''
 
+    mainStart = time.time()
     loadConfig()
+    configEnd = time.time()
 
     global config, regionalSettings
 
@@ -268,29 +181,52 @@ def main():
     argp.add_argument('region', type=str, nargs=1, help='AWS region where the spoke resides')
     argp.add_argument('account', type=str, nargs=1, help='Account name')
     argp.add_argument('template', type=str, help='Template file name')
+    argp.add_argument('--resume', type=str, default=None, help='Run ID of an earlier run to resume')
+    argp.add_argument('--rollback', action='store_true', help='Delete the created subnets again when a step fails')
+    argp.add_argument('--trace', action='store_true', help='Add timing spans to the output')
+    argp.add_argument('--trace-file', type=str, default=None, help='Write timing spans to a Chrome trace-event file')
     args = argp.parse_args()
+    if args.trace or args.trace_file:
+        ipamtrace.enable()
+        ipamtrace.startup(mainStart, starttime)
+        ipamtrace.record('config', mainStart, configEnd)
     region = args.region[0]
     account = args.account[0]
     template = args.template
 
-    output = {'code': 0, 'success': 'false'}
+    try:
+        journal = ipamjournal.getJournal(config, args.resume, {'region': region, 'account': account, 'template': template})
+    except IOError as e:
+        return {'code': 404, 'success': 'false', 'data': {'description': str(e)}}
+    except ValueError as e:
+        return {'code': 409, 'success': 'false', 'data': {'description': str(e)}}
+
+    output = {'code': 0, 'success': 'false', 'run': journal.runId}
     output['data'] = []
 
     if region in regionalSettings:
-        ipam = createSpoke(region, account, SPOKESIZE)
+        ipam = createSpoke(region, account, SPOKESIZE, journal = journal, rollback = args.rollback)
         if ipam['code'] == 200:
             output['code'] = 200
             output['success'] = 'true'
             output['data'] = ipam['data']
-            with open(template) as infile:
-                output['yaml'] = createCfYaml(region, account, ipam, infile.read())
+            output['yaml'] = createCfYaml(region, account, ipam, template)
         else:
             output['code'] = 500
             output['success'] = 'false'
+            output['errors'] = ipam.get('errors', {})
+            if 'rollback' in ipam:
+                output['rollback'] = ipam['rollback']
     else:
         output['data'] = {'description': 'Region not defined or recognised.'}
 
+    journal.finish(output['code'] == 200)
+
     output['time'] = time.time() - starttime
+    if args.trace:
+        output['trace'] = ipamtrace.getSpans()
+    if args.trace_file:
+        ipamtrace.writeChromeTrace(args.trace_file)
     return output
 
 if __name__ == "__main__":
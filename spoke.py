@@ -24,11 +24,14 @@ __contact__ = "pvandesande@tmhcc.com"
 __license__ = "GPLv3"
 
 import sys
+import ipaddress
 import argparse
-import requests
+import ipamclient
+import ipamtemplate
+import ipamtrace
 import json
 import time
-from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor
 
 starttime = time.time()
 config = {}
@@ -51,6 +54,7 @@ regionalTGWs = {
         "ap-southeast-2": "tgw-0fc230fd5535b3ddf"
 }
 SPOKESIZE = 22 # Supernet size for a standard spoke
+WORKERS = 4 # Default number of parallel address reservations
 
 def loadConfig():
     '''
@@ -84,11 +88,6 @@ def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests =
     '''
 
     global config
-    url = f"https://{config['server']}/api/{config['appid']}/subnets/{masterId}/{position}_subnet/{size}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
     payload = f"""{{
         \"description\": \"{description}\",
         \"pingSubnet\": \"0\",
@@ -96,32 +95,50 @@ def requestSubnet(masterId, size, description, nameserverId = 0, allowRequests =
         \"nameserverId\": \"{nameserverId}\"
     }}"""
 
-    return requests.request("POST", url, headers=headers, data=payload).text
+    return ipamclient.getClient(config).request("POST", f"subnets/{masterId}/{position}_subnet/{size}/", payload).text
 
-def createFirstAddress(subnetId, description, isGateway = 0):
+def createAddress(subnetId, ip, description, isGateway = 0):
     '''
-    Create an IP address in a specific subnet
+    Create a specific IP address in a subnet
 
     :param int subnetId: ID of the subnet
-    :param str description: Human-readable description of what this subnet is used for
+    :param str ip: IP address to create
+    :param str description: Human-readable description of what this address is used for
     :param int isGateway: Define whether the device is a gateway (router)
     :return: JSON object with server response
     :rtype: str
     '''
 
     global config
-    url = f"https://{config['server']}/api/{config['appid']}/addresses/first_free/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
     payload = f"""{{
         \"subnetId\": \"{subnetId}\",
+        \"ip\": \"{ip}\",
         \"description\": \"{description}\",
         \"is_gateway\": \"{isGateway}\"
     }}"""
 
-    return requests.request("POST", url, headers=headers, data=payload).text
+    return ipamclient.getClient(config).request("POST", "addresses/", payload).text
+
+def reserveAddresses(executor, subnet, descriptions):
+    '''
+    Reserve the first addresses of a subnet on the worker pool
+
+    The first description lands on the first address (the default gateway),
+    every next description on the address after it.
+
+    :param ThreadPoolExecutor executor: Worker pool running the reservations
+    :param dict subnet: Server response of the subnet request
+    :param list descriptions: Descriptions of the addresses, gateway first
+    :return: Futures with the server responses
+    :rtype: list
+    '''
+
+    network = ipaddress.ip_network(subnet['data'])
+    futures = []
+    for offset, description in enumerate(descriptions, 1):
+        isGateway = 1 if offset == 1 else 0
+        futures.append(executor.submit(createAddress, subnet['id'], str(network[offset]), description, isGateway))
+    return futures
 
 def createSpoke(region, account, size = 22):
     '''
@@ -136,6 +153,8 @@ def createSpoke(region, account, size = 22):
     global config, regionalNetworks, regionalInternalDNS
     output = {'code': 0, 'success': 'false'}
     output['data'] = []
+    executor = ThreadPoolExecutor(max_workers = config.get('workers', WORKERS))
+    reservations = []
 
     description = account + ' VpcCidr'
     r = json.loads(requestSubnet(regionalNetworks[region], size, description, regionalInternalDNS[region]))
@@ -147,38 +166,36 @@ def createSpoke(region, account, size = 22):
         privatea = json.loads(requestSubnet(r['id'], 24, description, regionalInternalDNS[region]))
         tmp = {'id': privatea['id'], 'subnet': privatea['data'], 'description': description}
         output['data'].append(tmp)
-        privatea_gw = json.loads(createFirstAddress(privatea['id'], 'Default gateway', 1))
-        privatea_dns = json.loads(createFirstAddress(privatea['id'], 'AWS DNS'))
-        privatea_res3 = json.loads(createFirstAddress(privatea['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privatea, ['Default gateway', 'AWS DNS', 'Reserved by AWS'])
 
         description = account + ' Private subnet AZ B'
         privateb = json.loads(requestSubnet(r['id'], 24, description, regionalInternalDNS[region]))
         tmp = {'id': privateb['id'], 'subnet': privateb['data'], 'description': description}
         output['data'].append(tmp)
-        privateb_gw = json.loads(createFirstAddress(privateb['id'], 'Default gateway', 1))
-        privateb_res2 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
-        privateb_res3 = json.loads(createFirstAddress(privateb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, privateb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = account + ' Transit subnet AZ B'
         transitb = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transitb['id'], 'subnet': transitb['data'], 'description': description}
         output['data'].append(tmp)
-        transitb_gw = json.loads(createFirstAddress(transitb['id'], 'Default gateway', 1))
-        transitb_res2 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
-        transitb_res3 = json.loads(createFirstAddress(transitb['id'], 'Reserved by AWS'))
+        reservations += reserveAddresses(executor, transitb, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
 
         description = account + ' Transit subnet AZ A'
         transita = json.loads(requestSubnet(r['id'], 28, description, 0, 0, 'last'))
         tmp = {'id': transita['id'], 'subnet': transita['data'], 'description': description}
         output['data'].append(tmp)
-        transita_gw = json.loads(createFirstAddress(transita['id'], 'Default gateway', 1))
-        transita_res2 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        transita_res3 = json.loads(createFirstAddress(transita['id'], 'Reserved by AWS'))
-        output['code'] = 200
-        output['success'] = 'true'
+        reservations += reserveAddresses(executor, transita, ['Default gateway', 'Reserved by AWS', 'Reserved by AWS'])
+        # Wait for all address reservations before reporting the result
+        if all(json.loads(future.result())['code'] == 201 for future in reservations):
+            output['code'] = 200
+            output['success'] = 'true'
+        else:
+            output['code'] = 500
+            output['success'] = 'false'
     else:
         output['code'] = 500
         output['success'] = 'false'
+    executor.shutdown()
     return output
 
 def createCfYaml(region, account, ipam, template):
@@ -188,23 +205,16 @@ def createCfYaml(region, account, ipam, template):
     :param str region: AWS region
     :param str account: Account name
     :param str ipam: Dictionary with subnets and related information
-    :param str template: YAML Template
+    :param str template: Template file name
     :return: YAML
     :rtype: str
     '''
 
     global config, regionalInternalDNS, regionalTGWs
 
-    url = f"https://{config['server']}/api/{config['appid']}/tools/nameservers/{regionalInternalDNS[region]}/"
-    headers = {
-            'token': config['token'],
-            'Content-Type': 'application/json'
-    }
-    payload = ''
-
-    r = json.loads(requests.request("GET", url, headers=headers, data=payload).text)
+    r = ipamclient.getClient(config).getCached(f"tools/nameservers/{regionalInternalDNS[region]}/")
     nameservers = r['data']['namesrv1'].split(';')
-    tpl = Template(template)
+    tpl = ipamtemplate.getTemplate(template, config.get('templateCache'))
     return tpl.render (
         nameservers = nameservers,
         account = account,
@@ -225,7 +235,9 @@ def main():
     Main script logic
     '''
 
+    mainStart = time.time()
     loadConfig()
+    configEnd = time.time()
 
     global config, regionalNetworks, regionalInternalDNS
 
@@ -234,7 +246,13 @@ def main():
     argp.add_argument('region', type=str, nargs=1, help='AWS region where the spoke resides')
     argp.add_argument('account', type=str, nargs=1, help='Account name')
     argp.add_argument('template', type=str, nargs=1, help='Template file name')
+    argp.add_argument('--trace', action='store_true', help='Add timing spans to the output')
+    argp.add_argument('--trace-file', type=str, default=None, help='Write timing spans to a Chrome trace-event file')
     args = argp.parse_args()
+    if args.trace or args.trace_file:
+        ipamtrace.enable()
+        ipamtrace.startup(mainStart, starttime)
+        ipamtrace.record('config', mainStart, configEnd)
     region = args.region[0]
     account = args.account[0]
     template = args.template[0]
@@ -248,8 +266,7 @@ def main():
             output['code'] = 200
             output['success'] = 'true'
             output['data'] = ipam['data']
-            with open(template) as infile:
-                output['yaml'] = createCfYaml(region, account, ipam, infile.read())
+            output['yaml'] = createCfYaml(region, account, ipam, template)
         else:
             output['code'] = 500
             output['success'] = 'false'
@@ -257,6 +274,10 @@ def main():
         output['data'] = {'description': 'Region not defined or recognised.'}
 
     output['time'] = time.time() - starttime
+    if args.trace:
+        output['trace'] = ipamtrace.getSpans()
+    if args.trace_file:
+        ipamtrace.writeChromeTrace(args.trace_file)
     return output
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+""" Shared fixtures for the tests.
+
+The fake fixture serves a fresh stand-in phpIPAM (see ipamfake) on an
+ephemeral port, so the provisioning code can be run against a real HTTP
+API without a server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import ipamclient
+import ipamfake
+
+class Fake:
+    '''
+    Stand-in server with a client and a configuration pointing at it
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.state = server.fake
+        self.config = {'scheme': 'http', 'server': f"127.0.0.1:{server.server_address[1]}", 'app': 'fake', 'token': 'fake'}
+        self.client = ipamclient.IpamClient(self.config)
+
+    def inject(self, settings):
+        '''
+        Set the latency and failure injection, see ipamfake.Profile
+
+        :param dict settings: Settings by endpoint key
+        '''
+
+        self.server.profile.settings = settings
+
+    def children(self, masterId):
+        '''
+        Return the subnets directly inside a subnet, by CIDR
+
+        :param int masterId: ID of the subnet
+        :return: Subnet objects by CIDR
+        :rtype: dict
+        '''
+
+        return {f"{subnet['subnet']}/{subnet['mask']}": subnet for subnet in self.state.slaves(str(masterId))}
+
+@pytest.fixture
+def fake():
+    server = ipamfake.FakeServer(('127.0.0.1', 0))
+    server.start()
+    found = Fake(server)
+    yield found
+    found.client.close()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,101 @@
+""" Tests of the best-fit allocator against brute force.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import random
+import ipaddress
+import pytest
+import ipambuddy
+
+SUPERNET = ipaddress.ip_network('10.76.0.0/16')
+
+def randomSiblings(generator, count):
+    '''
+    Pick non-overlapping subnets of random sizes inside the supernet
+    '''
+
+    siblings = []
+    while len(siblings) < count:
+        size = generator.randint(18, 28)
+        offset = generator.randrange(1 << (size - SUPERNET.prefixlen)) << (32 - size)
+        candidate = ipaddress.ip_network((int(SUPERNET.network_address) + offset, size))
+        if not any(candidate.overlaps(sibling) for sibling in siblings):
+            siblings.append(candidate)
+    return siblings
+
+def freeSpace(siblings):
+    '''
+    Split the free space of the supernet into the largest aligned blocks
+    '''
+
+    blocks = []
+    low = int(SUPERNET.network_address)
+    for sibling in sorted(siblings) + [None]:
+        high = int(sibling.network_address) - 1 if sibling is not None else int(SUPERNET.broadcast_address)
+        if high >= low:
+            blocks.extend(ipaddress.summarize_address_range(ipaddress.ip_address(low), ipaddress.ip_address(high)))
+        if sibling is not None:
+            low = int(sibling.broadcast_address) + 1
+    return blocks
+
+def load(trie, siblings):
+    trie.insert(str(SUPERNET), {'id': '76'})
+    for number, sibling in enumerate(siblings):
+        trie.insert(str(sibling), {'id': str(number)})
+    return trie
+
+def test_best_fit_takes_the_tightest_hole():
+    # Free: a /24 at 10.76.1.0 and everything from 10.76.4.0 on
+    siblings = [ipaddress.ip_network('10.76.0.0/24'), ipaddress.ip_network('10.76.2.0/23')]
+    trie = load(ipambuddy.BuddyTrie(), siblings)
+
+    assert trie.freeBlock(str(SUPERNET), 24) == '10.76.1.0/24'
+    assert trie.freeBlock(str(SUPERNET), 22) == '10.76.4.0/22'
+    assert trie.freeBlock(str(SUPERNET), 24, 'last') == '10.76.1.0/24'
+    assert trie.freeBlock(str(SUPERNET), 28, 'last') == '10.76.1.240/28'
+
+@pytest.mark.parametrize('seed', range(20))
+def test_free_lists_stay_in_step(seed):
+    generator = random.Random(seed)
+    siblings = randomSiblings(generator, 10)
+    trie = load(ipambuddy.BuddyTrie(), siblings)
+    trie.manage(str(SUPERNET))
+
+    for step in range(40):
+        if siblings and generator.random() < 0.4:
+            sibling = siblings.pop(generator.randrange(len(siblings)))
+            trie.remove(str(sibling))
+        else:
+            size = generator.randint(20, 28)
+            block = trie.freeBlock(str(SUPERNET), size, generator.choice(['first', 'last']))
+            if block is None:
+                continue
+            block = ipaddress.ip_network(block)
+            assert not any(block.overlaps(sibling) for sibling in siblings)
+            # Carved from the smallest free block that holds it
+            holders = [free for free in freeSpace(siblings) if free.prefixlen <= size]
+            assert any(block.subnet_of(free) and free.prefixlen == max(holder.prefixlen for holder in holders)
+                for free in holders)
+            trie.insert(str(block))
+            siblings.append(block)
+
+        expected = {}
+        for free in freeSpace(siblings):
+            expected[f"/{free.prefixlen}"] = expected.get(f"/{free.prefixlen}", 0) + 1
+        assert trie.fragmentation(str(SUPERNET))['blocks'] == dict(sorted(expected.items(), key = lambda item: int(item[0][1:])))
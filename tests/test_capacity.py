@@ -0,0 +1,114 @@
+""" Tests of the gap and free block computations of capacity-report.py.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import random
+import ipaddress
+import importlib.util
+import pytest
+
+spec = importlib.util.spec_from_file_location('capacityreport',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'capacity-report.py'))
+capacity = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(capacity)
+
+SUPERNET = {'id': '76', 'subnet': '10.76.0.0', 'mask': '16', 'description': 'eu-west-1'}
+LOW = int(ipaddress.ip_address('10.76.0.0'))
+HIGH = LOW + 65535
+
+def randomSubnets(generator, count):
+    '''
+    Pick subnets inside the supernet, nested ones included
+    '''
+
+    subnets = []
+    for number in range(count):
+        length = generator.randint(18, 28)
+        address = LOW + (generator.randrange(1 << (length - 16)) << (32 - length))
+        subnets.append({'id': str(number), 'subnet': str(ipaddress.ip_address(address)), 'mask': str(length)})
+    return subnets
+
+def bruteFree(subnets):
+    '''
+    Count the free addresses one by one and split them into the largest aligned blocks
+    '''
+
+    taken = set()
+    for subnet in subnets:
+        network = ipaddress.ip_network(f"{subnet['subnet']}/{subnet['mask']}")
+        taken.update(range(int(network.network_address), int(network.broadcast_address) + 1))
+    counts = {}
+    start = None
+    for address in range(LOW, HIGH + 2):
+        if address <= HIGH and address not in taken:
+            start = address if start is None else start
+        elif start is not None:
+            for block in ipaddress.summarize_address_range(ipaddress.ip_address(start), ipaddress.ip_address(address - 1)):
+                counts[block.prefixlen] = counts.get(block.prefixlen, 0) + 1
+            start = None
+    return len(taken), dict(sorted(counts.items()))
+
+@pytest.mark.parametrize('seed', range(10))
+def test_free_blocks_match_brute_force(seed):
+    generator = random.Random(seed)
+    subnets = randomSubnets(generator, generator.randint(0, 40))
+    bounds = [capacity.bounds(subnet) for subnet in subnets]
+
+    taken, gapStarts, gapEnds = capacity.gaps([bound[1] for bound in bounds], [bound[2] for bound in bounds], LOW, HIGH)
+
+    assert (taken, capacity.freeBlocks(gapStarts, gapEnds, 32)) == bruteFree(subnets)
+
+@pytest.mark.parametrize('seed', range(10))
+def test_numpy_matches_python(seed):
+    numpy = pytest.importorskip('numpy')
+    generator = random.Random(seed)
+    bounds = [capacity.bounds(subnet) for subnet in randomSubnets(generator, generator.randint(0, 40))]
+    starts = [bound[1] for bound in bounds]
+    ends = [bound[2] for bound in bounds]
+
+    taken, gapStarts, gapEnds = capacity.gaps(starts, ends, LOW, HIGH)
+    arrayTaken, arrayStarts, arrayEnds = capacity.gaps(numpy.asarray(starts, dtype = numpy.int64),
+        numpy.asarray(ends, dtype = numpy.int64), LOW, HIGH)
+
+    assert arrayTaken == taken
+    assert capacity.freeBlocks(arrayStarts, arrayEnds, 32) == capacity.freeBlocks(gapStarts, gapEnds, 32)
+
+def test_report_of_a_supernet():
+    subnets = [
+        dict(SUPERNET),
+        {'id': '1', 'subnet': '10.76.0.0', 'mask': '22'},
+        {'id': '2', 'subnet': '10.76.0.0', 'mask': '24'},
+        {'id': '3', 'subnet': '10.76.8.0', 'mask': '24'},
+        {'id': '4', 'subnet': '10.76.255.128', 'mask': '25'},
+        {'id': '5', 'subnet': '10.77.0.0', 'mask': '22'}
+    ]
+    table = capacity.columns(subnets, {'2': 3, '3': 0, '4': 10})
+
+    r = capacity.reportSupernet(SUPERNET, table, {'spokes': 22, 'landingZones': 19})
+
+    assert r['allocated'] == 1024 + 256 + 128
+    assert r['subnets'] == 4
+    assert r['addresses'] == 13
+    assert r['addressUtilization'] == 13 / (256 + 256 + 128)
+    assert r['largestFree'] == '/18'
+    assert r['freeBlocks'] == {'/18': 2, '/19': 2, '/20': 2, '/21': 1, '/22': 3, '/23': 2, '/24': 2, '/25': 1}
+    # The /22s in the larger blocks, and 10.76.4.0/22, 10.76.12.0/22 and 10.76.248.0/22
+    assert r['spokes'] == 2 * 16 + 2 * 8 + 2 * 4 + 2 + 3
+    assert r['landingZones'] == 2 * 2 + 2
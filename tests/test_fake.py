@@ -0,0 +1,54 @@
+""" Tests of the stand-in phpIPAM server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import json
+import pytest
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+
+def createVpc(fake):
+    return fake.client.requestSubnet(SUPERNET, 22, 'Acct VpcCidr')['id']
+
+def test_first_free_address_with_the_subnet_in_the_body(fake):
+    vpc = createVpc(fake)
+    payload = json.dumps({'subnetId': str(vpc), 'description': 'Default gateway', 'is_gateway': '1'})
+
+    r = fake.client.request('POST', 'addresses/first_free/', payload).json()
+
+    assert r['code'] == 201 and r['data'] == '10.76.0.1'
+    assert fake.state.addresses[str(r['id'])]['is_gateway'] == '1'
+
+def test_first_free_address_with_the_subnet_in_the_path(fake):
+    vpc = createVpc(fake)
+    fake.client.request('POST', f"addresses/first_free/{vpc}/", json.dumps({'description': 'Gateway'}))
+
+    r = fake.client.request('POST', f"addresses/first_free/{vpc}/", json.dumps({'description': 'AWS DNS'})).json()
+
+    assert r['code'] == 201 and r['data'] == '10.76.0.2'
+
+@pytest.mark.parametrize('method, endpoint', [
+    ('POST', 'addresses/first_free/'),
+    ('GET', f"subnets/{SUPERNET}/first_subnet/"),
+    ('POST', f"subnets/{SUPERNET}/last_subnet/")
+])
+def test_incomplete_requests_are_refused(fake, method, endpoint):
+    r = fake.client.request(method, endpoint, json.dumps({'description': 'Incomplete'}))
+
+    assert r.status_code == 400 and r.json()['success'] is False
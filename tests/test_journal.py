@@ -0,0 +1,88 @@
+""" Regression tests of the provisioning journal against the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import pytest
+import ipamjournal
+import ipamscheduler
+import ipamtrie
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+NAMESERVER = 3
+
+def spokeLayout():
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    return layout
+
+def addresses(fake, subnetId):
+    return sorted(address['ip'] for address in fake.state.addresses.values() if address['subnetId'] == str(subnetId))
+
+def test_failed_run_resumes_from_the_journal(fake, tmp_path):
+    fake.inject({'POST addresses/': {'errorRate': 1}})
+    journal = ipamjournal.Journal(str(tmp_path))
+    r = ipamscheduler.provisionLayout(fake.client, spokeLayout(), SUPERNET, 'Acct', NAMESERVER, journal = journal)
+    assert r['code'] == 500
+    vpc = r['data'][0]
+
+    fake.inject({})
+    resumed = ipamjournal.Journal(str(tmp_path), journal.runId)
+    r = ipamscheduler.provisionLayout(fake.client, spokeLayout(), SUPERNET, 'Acct', NAMESERVER, journal = resumed)
+
+    assert r['code'] == 200
+    assert r['data'][0] == vpc
+    # Nothing was created twice
+    assert list(fake.children(SUPERNET)) == ['10.76.0.0/22']
+    assert len(fake.children(vpc['id'])) == 4
+    assert sum(len(addresses(fake, subnet['id'])) for subnet in r['data']) == 12
+
+def test_failed_run_is_rolled_back(fake, tmp_path):
+    fake.inject({'POST addresses/': {'errorRate': 1}})
+    journal = ipamjournal.Journal(str(tmp_path))
+    r = ipamscheduler.provisionLayout(fake.client, spokeLayout(), SUPERNET, 'Acct', NAMESERVER, journal = journal,
+        rollback = True)
+
+    assert r['code'] == 500
+    assert len(r['rollback']['deleted']) == 5 and not r['rollback']['errors']
+    assert fake.children(SUPERNET) == {}
+    assert fake.state.addresses == {}
+    assert ipamjournal.createdSubnets(journal.state()[0]) == {}
+
+def test_rollback_removes_the_subnets_from_the_trie(fake):
+    trie = ipamtrie.loadSection(fake.client, 1)
+    fake.inject({'POST addresses/': {'errorRate': 1}})
+    r = ipamscheduler.provisionLayout(fake.client, spokeLayout(), SUPERNET, 'Acct', NAMESERVER, trie = trie, rollback = True)
+
+    assert r['code'] == 500
+    assert trie.get('10.76.0.0/22') is None
+    assert trie.freeBlock('10.76.0.0/16', 22) == '10.76.0.0/22'
+
+def test_journal_refuses_a_resume_with_other_arguments(fake, tmp_path):
+    config = {'journalPath': str(tmp_path)}
+    journal = ipamjournal.getJournal(config, None, {'region': 'eu-west-1', 'account': 'Acct'})
+    journal.write('vpc', 'start')
+
+    with pytest.raises(ValueError):
+        ipamjournal.getJournal(config, journal.runId, {'region': 'eu-west-1', 'account': 'Other'})
+    assert ipamjournal.getJournal(config, journal.runId, {'region': 'eu-west-1', 'account': 'Acct'}).runId == journal.runId
+
+    journal.finish(False)
+    assert tmp_path.joinpath(journal.runId + '.jsonl').exists()
+    journal.finish(True)
+    assert not tmp_path.joinpath(journal.runId + '.jsonl').exists()
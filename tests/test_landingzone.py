@@ -0,0 +1,121 @@
+""" Regression tests of landingzone-v2.py against the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import os
+import sys
+import json
+import shutil
+import importlib.util
+import pytest
+import ipamoverlap
+import ipamscheduler
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location('landingzonev2', os.path.join(ROOT, 'landingzone-v2.py'))
+landingzone = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(landingzone)
+
+@pytest.fixture
+def run(fake, tmp_path, monkeypatch):
+    '''
+    Run landingzone-v2.py in a working directory configured for the stand-in server
+    '''
+
+    shutil.copy(os.path.join(ROOT, 'landingzone-v2.yaml'), str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+
+    def main(*arguments, **settings):
+        config = dict(fake.config, journalPath = str(tmp_path.joinpath('journal')), **settings)
+        tmp_path.joinpath('config.json').write_text(json.dumps(config))
+        monkeypatch.setattr(sys, 'argv', ['landingzone-v2.py'] + list(arguments))
+        return landingzone.main()
+    return main
+
+@pytest.fixture
+def brokenVedge(monkeypatch):
+    '''
+    Let the vEdge VPC fail once it exists, its first child can't fit in it
+    '''
+
+    loadLayout = ipamscheduler.loadLayout
+    def broken(name):
+        layout = loadLayout(name)
+        if name == 'vedge':
+            layout['subnets'][0]['size'] = 24
+        return layout
+    monkeypatch.setattr(ipamscheduler, 'loadLayout', broken)
+
+def journals(tmp_path):
+    return os.listdir(tmp_path.joinpath('journal'))
+
+def test_landing_zone_is_created(fake, run, tmp_path):
+    r = run('eu-west-1', 'landingzone-v2.yaml', '--cvpn', 'yes')
+
+    assert r['code'] == 200
+    assert [vpc[0]['description'] for vpc in r['data']] == ['Shared Services VpcCidr', 'vEdge VpcCidr']
+    assert journals(tmp_path) == []
+
+def test_failure_reports_both_vpcs(fake, run, brokenVedge, tmp_path):
+    r = run('eu-west-1', 'landingzone-v2.yaml')
+
+    assert r['code'] == 500
+    assert r['errors']['sharedservices'] == {} and r['errors']['vedge']
+    assert r['subnets']['sharedservices'][0]['description'] == 'Shared Services VpcCidr'
+    # Kept to resume
+    assert len(fake.children(SUPERNET)) == 2
+    assert journals(tmp_path) == [r['run'] + '.jsonl']
+
+def test_failure_rolls_back_both_vpcs(fake, run, brokenVedge, tmp_path):
+    r = run('eu-west-1', 'landingzone-v2.yaml', '--rollback')
+
+    assert r['code'] == 500
+    assert len(r['rollback']['sharedservices']['deleted']) == 7 and not r['rollback']['sharedservices']['errors']
+    assert r['rollback']['vedge']['deleted'] == ['vpc'] and not r['rollback']['vedge']['errors']
+    assert fake.children(SUPERNET) == {}
+    assert fake.state.addresses == {}
+    assert journals(tmp_path) == []
+
+def test_failed_region_rolls_back_the_others(fake, run, tmp_path):
+    # Room for the vEdge VPC in eu-west-1, but not for the Shared Services VPC
+    for network, mask in (('10.76.16.0', '20'), ('10.76.32.0', '19'), ('10.76.64.0', '18'), ('10.76.128.0', '17')):
+        fake.state.addSubnet({'subnet': network, 'mask': mask, 'masterSubnetId': str(SUPERNET), 'description': 'Taken'})
+
+    r = run('--regions', 'eu-west-2,eu-west-1', 'landingzone-v2.yaml', '--rollback')
+
+    assert r['code'] == 500 and r['failed'] == ['eu-west-1']
+    assert r['data']['eu-west-1']['errors']['sharedservices'] and r['data']['eu-west-1']['rollback']['vedge']['deleted']
+    assert len(r['rollback']['eu-west-2']['deleted']) == 14 and not r['rollback']['eu-west-2']['errors']
+    assert fake.children(75) == {}
+    assert sorted(subnet['description'] for subnet in fake.children(SUPERNET).values()) == ['Taken'] * 4
+    assert journals(tmp_path) == []
+
+def test_guard_refuses_an_overlapping_vpc(fake, run, tmp_path):
+    # The vEdge VPC is carved from the end of the supernet
+    filename = str(tmp_path.joinpath('overlaps.json'))
+    ipamoverlap.OverlapIndex([ipamoverlap.makeRange('10.76.255.192/26', 'onprem.txt', 'Datacenter')]).save(filename)
+
+    r = run('eu-west-1', 'landingzone-v2.yaml', '--rollback', overlapIndex = filename)
+
+    assert r['code'] == 500 and r['errors']['sharedservices'] == {}
+    assert 'overlaps 10.76.255.192/26 (Datacenter)' in json.dumps(r['errors']['vedge'])
+    assert fake.children(SUPERNET) == {}
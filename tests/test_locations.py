@@ -0,0 +1,63 @@
+""" Tests of the streaming location export of get_locations.py.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
+import json
+import pytest
+import get_locations
+
+@pytest.fixture
+def export(fake, tmp_path, monkeypatch):
+    '''
+    Run get_locations.py in a working directory configured for the stand-in server
+    '''
+
+    monkeypatch.chdir(tmp_path)
+
+    def run(config, *arguments):
+        tmp_path.joinpath('config.json').write_text(json.dumps(config))
+        monkeypatch.setattr(sys, 'argv', ['get_locations.py', 'locations.csv'] + list(arguments))
+        get_locations.main()
+        return tmp_path.joinpath('locations.csv').read_text(encoding = 'utf-8-sig').splitlines()
+    return run
+
+def test_items_are_streamed_across_chunks():
+    document = json.dumps({'code': 200, 'data': [{'id': 1, 'name': 'Amsterdam, é'}, {'id': 2, 'name': '[]'}]}).encode('utf-8')
+
+    assert list(get_locations.iterItems(document[i:i + 3] for i in range(0, len(document), 3))) == [
+        {'id': 1, 'name': 'Amsterdam, é'}, {'id': 2, 'name': '[]'}]
+
+def test_locations_are_exported(fake, export):
+    for number in range(5):
+        fake.state.locations[str(number)] = {'id': str(number), 'name': f"Site {number}"}
+
+    assert export(fake.config, '--page-size', '2')[1:] == [f"{number},Site {number}" for number in range(5)]
+
+def test_refused_request_fails_the_export(fake, export, tmp_path):
+    fake.inject({'GET tools/locations/': {'errorRate': 1}})
+    with pytest.raises(SystemExit) as e:
+        export(fake.config)
+
+    assert json.loads(e.value.code)['data']['description'] == 'Export failed, 500: Injected failure'
+    assert not tmp_path.joinpath('locations.csv').exists()
+
+def test_response_without_locations_fails_the_export():
+    with pytest.raises(get_locations.ExportError, match = 'Unexpected answer'):
+        list(get_locations.iterItems([b'{"code": 200, "success": true, "message": "Unexpected answer"}']))
@@ -0,0 +1,55 @@
+""" Tests of the lock backends.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sqlite3
+import pytest
+import ipamlock
+
+@pytest.fixture(params = ['file', 'sqlite'])
+def locks(request, tmp_path):
+    if request.param == 'file':
+        return ipamlock.FileLocks(str(tmp_path), timeout = 0.2)
+    return ipamlock.SqliteLocks(str(tmp_path.joinpath('locks.db')), timeout = 0.2)
+
+def test_held_lock_times_out(locks):
+    with locks.lock('subnet-76'):
+        with pytest.raises(ipamlock.LockError):
+            with locks.lock('subnet-76'):
+                pass
+        # Other locks don't wait
+        with locks.lock('subnet-74'):
+            pass
+
+    with locks.lock('subnet-76'):
+        pass
+
+def test_locked_database_raises_lock_error(tmp_path):
+    filename = str(tmp_path.joinpath('locks.db'))
+    locks = ipamlock.SqliteLocks(filename, timeout = 0.2)
+    other = sqlite3.connect(filename, isolation_level = None)
+    other.execute('BEGIN EXCLUSIVE')
+
+    with pytest.raises(ipamlock.LockError):
+        with locks.lock('subnet-76'):
+            pass
+
+    other.execute('ROLLBACK')
+    with locks.lock('subnet-76'):
+        pass
@@ -0,0 +1,101 @@
+""" Tests of the overlap sweep and index against brute force.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import json
+import random
+import pytest
+import ipamoverlap
+
+def randomRanges(generator, count, sources):
+    ranges = []
+    for number in range(count):
+        length = generator.randint(12, 28)
+        address = generator.randrange(1 << 32) >> (32 - length) << (32 - length)
+        cidr = f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/{length}"
+        ranges.append(ipamoverlap.makeRange(cidr, generator.choice(sources), str(number)))
+    return ranges
+
+def pair(overlap):
+    return tuple(sorted((overlap['range']['label'], overlap['overlaps']['label'])))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_sweep_matches_brute_force(seed):
+    generator = random.Random(seed)
+    ranges = randomRanges(generator, 200, ['phpipam', 'onprem.txt', 'vpcs.json'])
+    # Identical ranges from different sources overlap too
+    ranges.append(dict(ranges[0], source = 'partner.txt', label = 'copy'))
+
+    expected = {tuple(sorted((first['label'], second['label']))) for number, first in enumerate(ranges)
+        for second in ranges[number + 1:] if first['source'] != second['source']
+        and first['start'] <= second['end'] and second['start'] <= first['end']}
+    found = [pair(overlap) for overlap in ipamoverlap.findOverlaps(ranges)]
+
+    assert sorted(found) == sorted(expected)
+    assert len(found) == len(set(found))
+
+def test_relations():
+    big = ipamoverlap.makeRange('10.0.0.0/8', 'a')
+    small = ipamoverlap.makeRange('10.1.0.0/16', 'b')
+
+    assert ipamoverlap.relation(big, small) == 'contains'
+    assert ipamoverlap.relation(small, big) == 'inside'
+    assert ipamoverlap.relation(big, dict(big, source = 'b')) == 'equal'
+    assert ipamoverlap.findOverlaps([big, ipamoverlap.makeRange('2001:db8::/32', 'b')]) == []
+
+@pytest.mark.parametrize('seed', range(10))
+def test_index_matches_brute_force(seed):
+    generator = random.Random(seed)
+    ranges = randomRanges(generator, 300, ['onprem.txt'])
+    index = ipamoverlap.OverlapIndex(ranges)
+
+    for query in randomRanges(generator, 100, ['query']):
+        expected = sorted(found['label'] for found in ranges if found['start'] <= query['end'] and query['start'] <= found['end'])
+        assert sorted(found['label'] for found in index.overlaps(query['cidr'])) == expected
+
+def test_load_files(tmp_path):
+    cidrs = tmp_path.joinpath('onprem.txt')
+    cidrs.write_text('# On-premises\n10.200.0.0/16 Datacenter\n\n172.16.0.0/12\n')
+    vpcs = tmp_path.joinpath('vpcs.json')
+    vpcs.write_text(json.dumps({'Vpcs': [{
+        'VpcId': 'vpc-1',
+        'CidrBlock': '10.76.0.0/22',
+        'CidrBlockAssociationSet': [{'CidrBlock': '10.76.0.0/22'}, {'CidrBlock': '100.64.0.0/24'}],
+        'Ipv6CidrBlockAssociationSet': [{'Ipv6CidrBlock': '2001:db8::/56'}],
+        'Tags': [{'Key': 'Name', 'Value': 'Legacy'}]
+    }]}))
+
+    assert [(found['cidr'], found['label']) for found in ipamoverlap.loadFile(str(cidrs))] == [
+        ('10.200.0.0/16', 'Datacenter'), ('172.16.0.0/12', '')]
+    assert [(found['cidr'], found['label'], found['version']) for found in ipamoverlap.loadFile(str(vpcs))] == [
+        ('10.76.0.0/22', 'Legacy', 4), ('100.64.0.0/24', 'Legacy', 4), ('2001:db8::/56', 'Legacy', 6)]
+
+    cidrs.write_text('not-a-cidr\n')
+    with pytest.raises(ValueError):
+        ipamoverlap.loadFile(str(cidrs))
+
+def test_guard_reads_the_saved_index(tmp_path):
+    filename = str(tmp_path.joinpath('overlaps.json'))
+    ipamoverlap.OverlapIndex([ipamoverlap.makeRange('10.76.4.0/24', 'onprem.txt', 'Datacenter')]).save(filename)
+
+    guard = ipamoverlap.configuredGuard({'overlapIndex': filename})
+
+    assert [found['label'] for found in guard('10.76.4.0/22')] == ['Datacenter']
+    assert guard('10.76.0.0/22') == []
+    assert ipamoverlap.configuredGuard({}) is None
@@ -0,0 +1,143 @@
+""" Tests of the offline layout planner.
+
+The plans are checked against the order in which phpIPAM hands out blocks
+with consecutive first_subnet/last_subnet and first_free calls, as
+implemented by the in-memory state of the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import pytest
+import ipamfake
+import ipamplanner
+import ipamscheduler
+import ipamtrie
+
+SUPERNET = '10.76.0.0/16'
+
+def phpipamOrder(supernet, layout, options = (), siblings = ()):
+    '''
+    Allocate a layout the way phpIPAM would, one server-side search per subnet
+
+    :param str supernet: CIDR of the regional supernet
+    :param dict layout: VPC layout
+    :param list options: Enabled layout options
+    :param list siblings: CIDRs already taken in the supernet
+    :return: CIDR of the VPC, and CIDR and reserved addresses of every child
+    :rtype: tuple
+    '''
+
+    network, mask = supernet.split('/')
+    state = ipamfake.FakeIpam({'subnets': [{'id': '1', 'subnet': network, 'mask': mask, 'sectionId': '1', 'masterSubnetId': '0'}]})
+    for sibling in siblings:
+        network, mask = sibling.split('/')
+        state.addSubnet({'subnet': network, 'mask': mask, 'masterSubnetId': '1'})
+
+    cidr = state.freeSubnet('1', layout['size'], layout.get('position', 'first'))
+    network, mask = cidr.split('/')
+    vpc = state.addSubnet({'subnet': network, 'mask': mask, 'masterSubnetId': '1'})
+    children = []
+    for child in ipamscheduler.selectSubnets(layout, set(options)):
+        found = state.freeSubnet(vpc['id'], child['size'], child.get('position', 'first'))
+        network, mask = found.split('/')
+        subnet = state.addSubnet({'subnet': network, 'mask': mask, 'masterSubnetId': vpc['id']})
+        ips = [state.addAddress(subnet['id'], {})['ip'] for description in child.get('addresses', [])]
+        children.append((found, ips))
+    return cidr, children
+
+def localPlan(supernet, layout, options = (), siblings = ()):
+    '''
+    Plan a layout locally, the VPC in a prefix trie and the children with the planner
+    '''
+
+    trie = ipamtrie.PrefixTrie()
+    trie.insert(supernet)
+    for sibling in siblings:
+        trie.insert(sibling)
+    cidr = trie.freeBlock(supernet, layout['size'], layout.get('position', 'first'))
+    plan = ipamplanner.planLayout(cidr, ipamscheduler.selectSubnets(layout, set(options)))
+    return cidr, [(child['subnet'], [address['ip'] for address in child['addresses']]) for child in plan]
+
+def test_spoke_plan():
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    plan = ipamplanner.planLayout('10.76.4.0/22', layout['subnets'])
+
+    assert [(child['subnet'], child['description']) for child in plan] == [
+        ('10.76.4.0/24', 'Private subnet AZ A'),
+        ('10.76.5.0/24', 'Private subnet AZ B'),
+        ('10.76.7.240/28', 'Transit subnet AZ B'),
+        ('10.76.7.224/28', 'Transit subnet AZ A')
+    ]
+    assert plan[0]['addresses'] == [
+        {'ip': '10.76.4.1', 'description': 'Default gateway', 'isGateway': 1},
+        {'ip': '10.76.4.2', 'description': 'AWS DNS', 'isGateway': 0},
+        {'ip': '10.76.4.3', 'description': 'Reserved by AWS', 'isGateway': 0}
+    ]
+
+def test_sharedservices_plan_with_cvpn():
+    layout = ipamscheduler.loadLayout('sharedservices')
+    plan = ipamplanner.planLayout('10.76.32.0/19', ipamscheduler.selectSubnets(layout, {'cvpn'}))
+
+    assert [child['subnet'] for child in plan] == ['10.76.32.0/22', '10.76.36.0/22', '10.76.63.240/28', '10.76.63.224/28',
+        '10.76.60.0/23', '10.76.58.0/23', '10.76.52.0/22']
+    # The CVPN subnet only reserves its gateway
+    assert plan[-1]['addresses'] == [{'ip': '10.76.52.1', 'description': 'Default gateway', 'isGateway': 1}]
+
+def test_sharedservices_plan_without_cvpn():
+    layout = ipamscheduler.loadLayout('sharedservices')
+    children = ipamscheduler.selectSubnets(layout, set())
+
+    assert 'CVPN subnet' not in [child['description'] for child in children]
+    assert len(ipamplanner.planLayout('10.76.32.0/19', children)) == 6
+
+def test_vedge_plan():
+    layout = ipamscheduler.loadLayout('vedge')
+    plan = ipamplanner.planLayout('10.76.255.128/25', layout['subnets'])
+
+    assert [child['subnet'] for child in plan] == ['10.76.255.128/28', '10.76.255.144/28', '10.76.255.160/28',
+        '10.76.255.176/28', '10.76.255.240/28', '10.76.255.224/28']
+
+@pytest.mark.parametrize('name, size, options', [
+    ('spoke', 22, ()),
+    ('sharedservices', None, ()),
+    ('sharedservices', None, ('cvpn',)),
+    ('vedge', None, ())
+])
+@pytest.mark.parametrize('siblings', [
+    (),
+    ('10.76.0.0/24', '10.76.2.0/23', '10.76.255.128/26', '10.76.254.0/24'),
+    ('10.76.0.0/19', '10.76.64.0/18', '10.76.255.0/25')
+])
+def test_plan_matches_phpipam_order(name, size, options, siblings):
+    layout = ipamscheduler.loadLayout(name)
+    if size is not None:
+        layout['size'] = size
+
+    assert localPlan(SUPERNET, layout, options, siblings) == phpipamOrder(SUPERNET, layout, options, siblings)
+
+def test_child_that_does_not_fit():
+    layout = ipamscheduler.loadLayout('sharedservices')
+
+    with pytest.raises(ValueError):
+        ipamplanner.planLayout('10.76.0.0/21', layout['subnets'])
+
+def test_addresses_of_an_ipv6_subnet():
+    addresses = ipamplanner.planAddresses('2001:db8::/64', ['Default gateway', 'Reserved'])
+
+    assert [address['ip'] for address in addresses] == ['2001:db8::1', '2001:db8::2']
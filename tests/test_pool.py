@@ -0,0 +1,123 @@
+""" Regression tests of the warm spoke pool against the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import time
+import ipamlock
+import ipamoverlap
+import ipampool
+import ipamscheduler
+from concurrent.futures import ThreadPoolExecutor
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+NAMESERVER = 3
+
+def spokeLayout():
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    return layout
+
+def descriptions(fake, masterId = SUPERNET):
+    return sorted(subnet['description'] for subnet in fake.children(masterId).values())
+
+def refill(fake, target, **kwargs):
+    return ipampool.refillPool(fake.client, ipamlock.NullLocks(), spokeLayout(), SUPERNET, NAMESERVER, target, **kwargs)
+
+def claim(fake, account, locks = None, guard = None):
+    return ipampool.claimSpoke(fake.client, locks or ipamlock.NullLocks(), spokeLayout(), SUPERNET, account, guard = guard)
+
+def test_refill_tops_the_pool_up(fake):
+    assert refill(fake, 2) == {'added': 2, 'swept': 0, 'released': [], 'errors': []}
+    assert refill(fake, 3)['added'] == 1
+    assert descriptions(fake) == ['Unassigned VpcCidr'] * 3
+
+def test_claim_renames_the_oldest_tree(fake):
+    refill(fake, 2)
+    oldest = ipampool.pooled(fake.client, spokeLayout(), SUPERNET)[0]
+
+    r = claim(fake, 'Acct')
+
+    assert r['code'] == 200
+    assert r['data'][0]['id'] == oldest['id']
+    assert [subnet['description'] for subnet in r['data']] == ['Acct VpcCidr', 'Acct Private subnet AZ A',
+        'Acct Private subnet AZ B', 'Acct Transit subnet AZ B', 'Acct Transit subnet AZ A']
+    assert sorted(subnet['description'] for subnet in fake.children(oldest['id']).values()) == sorted(
+        subnet['description'] for subnet in r['data'][1:])
+    assert descriptions(fake) == ['Acct VpcCidr', 'Unassigned VpcCidr']
+
+def test_claim_from_an_empty_pool(fake):
+    assert claim(fake, 'Acct') is None
+
+def test_parallel_claims_get_different_trees(fake, tmp_path):
+    refill(fake, 3)
+    locks = ipamlock.FileLocks(str(tmp_path))
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        results = list(executor.map(lambda number: claim(fake, f"Acct{number}", locks), range(4)))
+
+    claimed = [r for r in results if r is not None]
+    assert len(claimed) == 3 and all(r['code'] == 200 for r in claimed)
+    assert len({r['data'][0]['id'] for r in claimed}) == 3
+
+def test_failed_rename_returns_the_tree_to_the_pool(fake):
+    refill(fake, 1)
+    update = fake.client.updateSubnet
+    def failing(subnetId, fields):
+        if fields['description'] == 'Acct Transit subnet AZ B':
+            return {'code': 500, 'message': 'Injected failure'}
+        return update(subnetId, fields)
+    fake.client.updateSubnet = failing
+
+    r = claim(fake, 'Acct')
+
+    assert r['code'] == 500 and r['released']
+    assert list(r['errors']) == ['Acct Transit subnet AZ B']
+    vpc = r['data'][0]['id']
+    assert descriptions(fake) == ['Unassigned VpcCidr']
+    assert not any(description.startswith('Acct') for description in descriptions(fake, vpc))
+
+    fake.client.updateSubnet = update
+    assert claim(fake, 'Acct')['code'] == 200
+
+def test_refill_sweeps_abandoned_trees(fake):
+    layout = spokeLayout()
+    # Left behind by a refill that crashed long ago, and one still carving
+    ipamscheduler.provisionLayout(fake.client, layout, SUPERNET, f"{ipampool.CARVING} 5", NAMESERVER)
+    ipamscheduler.provisionLayout(fake.client, layout, SUPERNET, f"{ipampool.CARVING} {int(time.time())}", NAMESERVER)
+
+    r = refill(fake, 1)
+
+    assert r['swept'] == 1 and r['added'] == 1
+    assert [description.split(' ')[0] for description in descriptions(fake)] == [ipampool.CARVING, 'Unassigned']
+    # The supernets, and the two trees of five subnets left
+    assert len(fake.state.subnets) == 5 + 2 * 5
+
+def test_refill_releases_the_trees_the_guard_refuses(fake, tmp_path):
+    refill(fake, 2)
+    oldest = ipampool.pooled(fake.client, spokeLayout(), SUPERNET)[0]
+    filename = str(tmp_path.joinpath('overlaps.json'))
+    ipamoverlap.OverlapIndex([ipamoverlap.makeRange(f"{oldest['subnet']}/{oldest['mask']}", 'onprem.txt', 'Datacenter')]).save(filename)
+    guard = ipamoverlap.configuredGuard({'overlapIndex': filename})
+    assert claim(fake, 'Acct', guard = guard)['data'][0]['id'] != oldest['id']
+
+    r = refill(fake, 2, guard = guard)
+
+    assert r['released'] == [f"{oldest['subnet']}/{oldest['mask']}"]
+    # The released block is the first free one again, which the guard refuses to carve
+    assert r['added'] == 0 and 'Datacenter' in str(r['errors'])
+    assert descriptions(fake) == ['Acct VpcCidr']
@@ -0,0 +1,67 @@
+""" Regression tests of provisionLayout against the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import pytest
+import ipamscheduler
+import ipamtrie
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+NAMESERVER = 3
+
+def spokeLayout():
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    return layout
+
+def addresses(fake, subnetId):
+    return sorted(address['ip'] for address in fake.state.addresses.values() if address['subnetId'] == str(subnetId))
+
+def test_spoke_is_created_with_children_and_addresses(fake):
+    r = ipamscheduler.provisionLayout(fake.client, spokeLayout(), SUPERNET, 'Acct', NAMESERVER)
+
+    assert r['code'] == 200
+    assert [(subnet['subnet'], subnet['description']) for subnet in r['data']] == [
+        ('10.76.0.0/22', 'Acct VpcCidr'),
+        ('10.76.0.0/24', 'Acct Private subnet AZ A'),
+        ('10.76.1.0/24', 'Acct Private subnet AZ B'),
+        ('10.76.3.240/28', 'Acct Transit subnet AZ B'),
+        ('10.76.3.224/28', 'Acct Transit subnet AZ A')
+    ]
+    vpc = r['data'][0]['id']
+    assert sorted(fake.children(vpc)) == sorted(subnet['subnet'] for subnet in r['data'][1:])
+    assert addresses(fake, r['data'][1]['id']) == ['10.76.0.1', '10.76.0.2', '10.76.0.3']
+    assert addresses(fake, r['data'][3]['id']) == ['10.76.3.241', '10.76.3.242', '10.76.3.243']
+    assert fake.state.subnets[str(r['data'][3]['id'])]['nameserverId'] == '0'
+    assert fake.state.subnets[str(r['data'][1]['id'])]['nameserverId'] == str(NAMESERVER)
+
+@pytest.mark.parametrize('position', ['first', 'last'])
+def test_trie_plans_the_block_phpipam_would_find(fake, position):
+    # A sibling that isn't aligned to the spoke size
+    fake.state.addSubnet({'subnet': '10.76.1.0', 'mask': '24', 'masterSubnetId': str(SUPERNET), 'description': 'Sibling'})
+    fake.state.addSubnet({'subnet': '10.76.255.0', 'mask': '24', 'masterSubnetId': str(SUPERNET), 'description': 'Sibling'})
+    trie = ipamtrie.loadSection(fake.client, 1)
+    layout = dict(spokeLayout(), position = position)
+
+    for number in range(3):
+        expected = fake.state.freeSubnet(str(SUPERNET), '22', position)
+        r = ipamscheduler.provisionLayout(fake.client, layout, SUPERNET, f"Acct{number}", NAMESERVER, trie = trie)
+        assert r['code'] == 200
+        assert r['data'][0]['subnet'] == expected
+        assert trie.get(expected) is not None
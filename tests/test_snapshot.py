@@ -0,0 +1,107 @@
+""" Regression tests of get_snapshot.py --incremental against the stand-in server.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
+import json
+import pytest
+import get_snapshot
+import ipamscheduler
+
+SUPERNET = 76 # eu-west-1 in the stand-in server
+NAMESERVER = 3
+EARLIER = '2020-01-01 00:00:00'
+
+@pytest.fixture
+def snapshot(fake, tmp_path, monkeypatch):
+    '''
+    Run get_snapshot.py in a working directory configured for the stand-in server
+    '''
+
+    tmp_path.joinpath('config.json').write_text(json.dumps(fake.config))
+    monkeypatch.chdir(tmp_path)
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    for number in range(3):
+        assert ipamscheduler.provisionLayout(fake.client, layout, SUPERNET, f"Acct{number}", NAMESERVER)['code'] == 200
+    # Created well before the edits of the tests, editDate only counts seconds
+    for subnet in fake.state.subnets.values():
+        subnet['editDate'] = EARLIER
+
+    def run(directory, *arguments):
+        monkeypatch.setattr(sys, 'argv', ['get_snapshot.py', directory, '--format', 'csv'] + list(arguments))
+        return get_snapshot.main()
+    return run
+
+def tables(directory):
+    return {name: sorted(get_snapshot.readRows(directory, name), key = lambda row: row['id'])
+        for name in ('subnets', 'addresses')}
+
+def subnetId(fake, description):
+    return next(subnet['id'] for subnet in fake.state.subnets.values() if subnet['description'] == description)
+
+def test_unchanged_snapshot_is_kept_on_trust(snapshot):
+    full = snapshot('snapshot')
+    assert full['mode'] == 'full' and full['refreshed'] == 20 and full['trusted'] == 0
+
+    r = snapshot('snapshot', '--incremental')
+
+    assert r['mode'] == 'incremental' and r['refreshed'] == 0 and r['trusted'] == 20
+    assert r['data']['tables']['addresses']['rows'] == full['data']['tables']['addresses']['rows']
+
+def test_address_added_to_an_unedited_subnet(fake, snapshot):
+    snapshot('snapshot')
+    fake.state.addAddress(subnetId(fake, 'Acct1 Private subnet AZ A'), {'description': 'Added'})
+
+    r = snapshot('snapshot', '--incremental')
+
+    assert r['refreshed'] == 1 and r['trusted'] == 19
+    snapshot('full')
+    assert tables('snapshot') == tables('full')
+
+def test_new_edited_and_deleted_subnets(fake, snapshot):
+    snapshot('snapshot')
+    layout = ipamscheduler.loadLayout('spoke')
+    layout['size'] = 22
+    ipamscheduler.provisionLayout(fake.client, layout, SUPERNET, 'Acct3', NAMESERVER)
+    fake.client.updateSubnet(subnetId(fake, 'Acct0 Private subnet AZ B'), {'description': 'Edited'})
+    fake.client.deleteSubnet(subnetId(fake, 'Acct2 VpcCidr'))
+
+    r = snapshot('snapshot', '--incremental')
+
+    # The new spoke and the edited subnet
+    assert r['refreshed'] == 5 + 1
+    snapshot('full')
+    assert tables('snapshot') == tables('full')
+
+def test_subnet_edited_at_the_mark_is_pulled_once(fake, snapshot):
+    snapshot('snapshot')
+    fake.client.updateSubnet(subnetId(fake, 'Acct0 Private subnet AZ B'), {'description': 'Edited'})
+
+    assert snapshot('snapshot', '--incremental')['refreshed'] == 1
+    manifest = get_snapshot.readManifest('snapshot')
+    assert str(subnetId(fake, 'Edited')) in manifest['highWaterIds']['subnets']
+    assert snapshot('snapshot', '--incremental')['refreshed'] == 0
+
+def test_stale_snapshot_is_reconciled(snapshot):
+    snapshot('snapshot')
+
+    r = snapshot('snapshot', '--incremental', '--reconcile', '0')
+
+    assert r['mode'] == 'full'
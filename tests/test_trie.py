@@ -0,0 +1,97 @@
+""" Tests of the prefix trie against brute force.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import random
+import ipaddress
+import pytest
+import ipamtrie
+
+SUPERNET = ipaddress.ip_network('10.76.0.0/16')
+
+def randomSiblings(generator, count):
+    '''
+    Pick non-overlapping subnets of random sizes inside the supernet
+    '''
+
+    siblings = []
+    while len(siblings) < count:
+        size = generator.randint(18, 28)
+        offset = generator.randrange(1 << (size - SUPERNET.prefixlen)) << (32 - size)
+        candidate = ipaddress.ip_network((int(SUPERNET.network_address) + offset, size))
+        if not any(candidate.overlaps(sibling) for sibling in siblings):
+            siblings.append(candidate)
+    return siblings
+
+def bruteFree(siblings, size, position):
+    '''
+    Find the first or last free block of a size, like phpIPAM
+    '''
+
+    candidates = list(SUPERNET.subnets(new_prefix = size))
+    if position == 'last':
+        candidates.reverse()
+    return next((str(candidate) for candidate in candidates if not any(candidate.overlaps(sibling) for sibling in siblings)), None)
+
+def load(trie, siblings):
+    trie.insert(str(SUPERNET), {'id': '76'})
+    for number, sibling in enumerate(siblings):
+        trie.insert(str(sibling), {'id': str(number)})
+    return trie
+
+@pytest.mark.parametrize('seed', range(20))
+def test_free_block_matches_brute_force(seed):
+    generator = random.Random(seed)
+    siblings = randomSiblings(generator, generator.randint(0, 30))
+    trie = load(ipamtrie.PrefixTrie(), siblings)
+
+    for size in (17, 19, 22, 24, 25, 28):
+        for position in ('first', 'last'):
+            assert trie.freeBlock(str(SUPERNET), size, position) == bruteFree(siblings, size, position)
+
+@pytest.mark.parametrize('seed', range(10))
+def test_lookups_match_brute_force(seed):
+    generator = random.Random(seed)
+    siblings = randomSiblings(generator, 20)
+    trie = load(ipamtrie.PrefixTrie(), siblings)
+
+    assert [cidr for cidr, data in trie.children(str(SUPERNET))] == [str(sibling) for sibling in sorted(siblings)]
+    for query in [ipaddress.ip_network(f"10.76.{generator.randint(0, 255)}.0/{generator.randint(17, 26)}", strict = False)
+            for number in range(20)]:
+        expected = [str(sibling) for sibling in sorted(siblings) if sibling.overlaps(query)]
+        found = [cidr for cidr, data in trie.overlaps(str(query))]
+        assert found[0] == str(SUPERNET) and found[1:] == expected
+        containing = [sibling for sibling in siblings if query.subnet_of(sibling)]
+        assert trie.longestMatch(str(query))[0] == str(containing[0] if containing else SUPERNET)
+
+def test_remove_frees_the_block():
+    trie = load(ipamtrie.PrefixTrie(), [ipaddress.ip_network('10.76.0.0/22'), ipaddress.ip_network('10.76.4.0/22')])
+    trie.remove('10.76.0.0/22')
+
+    assert trie.get('10.76.0.0/22') is None
+    assert trie.freeBlock(str(SUPERNET), 22) == '10.76.0.0/22'
+    assert trie.ids == {'76': str(SUPERNET), '1': '10.76.4.0/22'}
+    with pytest.raises(KeyError):
+        trie.remove('10.76.0.0/22')
+
+def test_allocate_takes_consecutive_blocks():
+    trie = load(ipamtrie.PrefixTrie(), [])
+
+    assert [trie.allocate(str(SUPERNET), 22) for number in range(3)] == ['10.76.0.0/22', '10.76.4.0/22', '10.76.8.0/22']
+    assert trie.allocate(str(SUPERNET), 25, 'last') == '10.76.255.128/25'
@@ -1,53 +1,158 @@
 #!/usr/bin/env python3
+""" This script updates phpIPAM locations based on a CSV file.
+
+The current locations are fetched once and indexed by id. Every CSV row is
+compared field by field against its location, and only the fields that
+actually changed are sent, in parallel PATCH calls under a concurrency limit.
+Re-syncing a mostly unchanged sheet therefore costs one GET plus a handful of
+writes.
+
+With --dry-run nothing is written and only the summary of the changes is
+printed.
+
+--
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Peet van de Sande"
+__contact__ = "pvandesande@tmhcc.com"
+__license__ = "GPLv3"
+
+import sys
 import argparse
 import json, csv
-import http.client, mimetypes
-
-import pprint
-
-parser = argparse.ArgumentParser(description = 'Update PHPipam lcations based on CSV input.')
-parser.add_argument('csv', help='UTF8 encoded CSV file with actions and updates')
-args = parser.parse_args()
-
-with open('config.json') as json_config_file:
-    config = json.load(json_config_file)
-
-# Start with a clear dictionary
-data = {}
-
-with open(args.csv, 'r', encoding='utf-8-sig') as data_file:
-    csv_reader = csv.DictReader(data_file)
-    for line in csv_reader:
-        key = line['id']
-        data[key] = line
- 
-# pp = pprint.PrettyPrinter(indent=4)
-# pp.pprint(data)
-# 
-# for location in data:
-#     pp.pprint(location)
-#     print('\n')
-# 
-#     # Use a counter for the headers
-#     count = 0
-#     	
-#     for item in json.loads(data)['data']:
-#         # Only for the 1st line write the header (keys)
-#         if count == 0:
-#             header = item.keys()
-#             csv_writer.writerow(header)
-#             count += 1
-#     
-#         csv_writer.writerow(item.values())
-# 
-# 
-# 
-# conn = http.client.HTTPSConnection(config['server'])
-# payload = ''
-# headers = {
-#   'token': config['token'],
-# }
-# conn.request('PATCH', '/api/' + config['app'] + '/tools/locations/', payload, headers)
-# res = conn.getresponse()
-# data = res.read().decode('utf-8')
-# 
+import ipamclient
+import get_locations
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 4 # Default number of parallel updates
+READONLY = ['id', 'editDate'] # Fields that are never sent
+
+def normalise(value):
+    '''
+    Make API and CSV values comparable
+
+    :param value: Value from the API or the CSV file
+    :return: Value as a string, empty for missing values
+    :rtype: str
+    '''
+
+    if value is None or value == 'null':
+        return ''
+    return str(value)
+
+def diffLocations(current, data):
+    '''
+    Compute the changed fields per location
+
+    :param dict current: Current locations by id
+    :param dict data: Wanted locations by id, from the CSV file
+    :return: Changed fields by id, and the ids that don't exist
+    :rtype: tuple
+    '''
+
+    changes = {}
+    missing = []
+    for key, line in data.items():
+        if key not in current:
+            missing.append(key)
+            continue
+        fields = {}
+        for field, value in line.items():
+            if field in READONLY or field not in current[key]:
+                continue
+            if normalise(value) != normalise(current[key][field]):
+                fields[field] = normalise(value)
+        if fields:
+            changes[key] = fields
+    return changes, missing
+
+def patchLocation(client, limiter, key, fields):
+    '''
+    Send the changed fields of one location
+
+    :param IpamClient client: phpIPAM client
+    :param RateLimiter limiter: Rate ceiling shared by all workers
+    :param str key: ID of the location
+    :param dict fields: Changed fields
+    :return: Result with success and message
+    :rtype: dict
+    '''
+
+    limiter.wait()
+    try:
+        response = client.request('PATCH', f"tools/locations/{key}/", json.dumps(fields)).json()
+    except Exception as e:
+        return {'success': 'false', 'message': str(e)}
+    return {'success': 'true' if response.get('success') else 'false', 'message': response.get('message', '')}
+
+def loadConfig():
+    '''
+    Load a configuration file
+
+    :return: Loaded config.json
+    :rtype: dict
+    '''
+
+    for filename in ('config.json', '/etc/netops/phpipam/config.json'):
+        try:
+            with open(filename) as config_file:
+                return json.load(config_file)
+        except IOError:
+            continue
+    sys.exit(json.dumps({'code': 501, 'success': 'false', 'data': {'description': "Can't find config file."}}))
+
+def main():
+    '''
+    Main script logic
+    '''
+
+    parser = argparse.ArgumentParser(description = 'Update PHPipam lcations based on CSV input.')
+    parser.add_argument('csv', help='UTF8 encoded CSV file with actions and updates')
+    parser.add_argument('--dry-run', action='store_true', help='Only show what would change')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Number of parallel updates')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum number of requests per second')
+    args = parser.parse_args()
+
+    client = ipamclient.getClient(loadConfig())
+
+    # Start with a clear dictionary
+    data = {}
+
+    with open(args.csv, 'r', encoding='utf-8-sig') as data_file:
+        csv_reader = csv.DictReader(data_file)
+        for line in csv_reader:
+            key = line['id']
+            data[key] = line
+
+    current = {str(location['id']): location for location in get_locations.iterLocations(client)}
+    changes, missing = diffLocations(current, data)
+
+    output = {
+        'rows': len(data),
+        'unchanged': len(data) - len(changes) - len(missing),
+        'changed': changes,
+        'missing': missing
+    }
+
+    if not args.dry_run:
+        limiter = ipamclient.RateLimiter(args.rate)
+        with ThreadPoolExecutor(max_workers = args.workers) as executor:
+            futures = {key: executor.submit(patchLocation, client, limiter, key, fields) for key, fields in changes.items()}
+        output['results'] = {key: future.result() for key, future in futures.items()}
+        output['failed'] = [key for key, result in output['results'].items() if result['success'] != 'true']
+
+    print(json.dumps(output))
+
+if __name__ == "__main__":
+    main()